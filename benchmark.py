@@ -0,0 +1,313 @@
+
+import image_features
+import gen_test_image
+
+import numpy as np
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import tempfile
+import time
+
+wavelet_features = [('hueWaveletFeature', (1,)), ('hueWaveletFeature', (2,)), ('hueWaveletFeature', (3,)),
+					('saturationWaveletFeature', (1,)), ('saturationWaveletFeature', (2,)), ('saturationWaveletFeature', (3,)),
+					('valueWaveletFeature', (1,)), ('valueWaveletFeature', (2,)), ('valueWaveletFeature', (3,)),
+					('sumHueWaveletFeature', ()), ('sumSaturationWaveletFeature', ()), ('sumValueWaveletFeature', ())]
+
+# Sizes benchmarked by default, from the size of the test images up to 8K
+default_sizes = [(90, 90), (640, 480), (1920, 1080), (3840, 2160), (7680, 4320)]
+
+# Input: width, height - size of the image
+# Output: image_features.Image object of random noise
+def randomImage(width, height, seed = 0):
+	return image_features.Image(gen_test_image.noiseImage(width, height, seed))
+
+# Input:
+#   kind - 'noise' or 'quadrant'
+#   width, height - size of the image
+# Output: PIL.Image object created by gen_test_image.py
+def generateImage(kind, width, height, seed = 0):
+	if kind == 'noise':
+		return gen_test_image.noiseImage(width, height, seed)
+	if kind == 'quadrant':
+		return gen_test_image.quadrantImage(width, height, gen_test_image.randomColors(random.Random(seed)))
+	raise Exception('Invalid kind in generateImage: got ' + str(kind) + ', but must be in [\'noise\', \'quadrant\']')
+
+# Input:
+#   f - function to time
+#   repeat - number of times to run f
+# Output: the fastest time in seconds of running f
+def timeCall(f, repeat = 3):
+	best = None
+	for _ in range(repeat):
+		start = time.time()
+		f()
+		elapsed = time.time() - start
+		if best is None or elapsed < best:
+			best = elapsed
+	return best
+
+# ---------------------
+# |  Memory Tracking  |
+# ---------------------
+
+# Peak memory is the peak resident set size of the process. On Linux the peak can be reset, so the peak of each
+# benchmark is measured on its own. Elsewhere only the peak of the whole process is known, and peaks are reported as None.
+
+def _readStatus(field):
+	with open('/proc/self/status') as f:
+		for line in f:
+			if line.startswith(field + ':'):
+				return int(line.split()[1]) * 1024
+	return None
+
+# Output: True if the peak resident set size was reset
+def resetPeakMemory():
+	try:
+		with open('/proc/self/clear_refs', 'w') as f:
+			f.write('5')
+		return True
+	except (IOError, OSError):
+		return False
+
+# Output: 2-tuple of the current and peak resident set size in bytes, or None if unknown
+def memoryUsage():
+	try:
+		return _readStatus('VmRSS'), _readStatus('VmHWM')
+	except (IOError, OSError):
+		return None
+
+# Input: f, args - function to run and the arguments to give it
+# Output: 3-tuple of the time in seconds f took, the peak number of bytes allocated by f (or None if unknown), and the
+#         output of f
+def measureCall(f, *args):
+	tracked = resetPeakMemory()
+	before = memoryUsage()
+
+	start = time.time()
+	rv = f(*args)
+	elapsed = time.time() - start
+
+	after = memoryUsage()
+	if not tracked or before is None or after is None:
+		return elapsed, None, rv
+	return elapsed, max(after[1] - before[0], 0), rv
+
+# -------------------
+# |  Benchmarks     |
+# -------------------
+
+# Times computing all of the wavelet features of one image when every feature does its own wavelet transform
+# (uncached) against when each channel is transformed once and shared (cached).
+# Output: dict with the uncached and cached times in seconds, and the speedup
+def benchmarkWavelets(width, height, repeat = 3):
+	im = randomImage(width, height)
+
+	# The HSV conversion is done up front so only the wavelet transforms are timed
+	im._convert(image_features.RGBtoHSV)
+
+	def uncached():
+		for name, args in wavelet_features:
+			im.wavelet_sums = {}
+			getattr(im, name)(*args)
+
+	def cached():
+		im.wavelet_sums = {}
+		for name, args in wavelet_features:
+			getattr(im, name)(*args)
+
+	uncached_time = timeCall(uncached, repeat)
+	cached_time = timeCall(cached, repeat)
+	return {'uncached': uncached_time, 'cached': cached_time, 'speedup': uncached_time / cached_time}
+
+# Times converting an image to HSV and PAD with the float64 array functions against the lookup table functions.
+# Output: dict mapping each conversion to its time in seconds, megapixels per second, bytes of the output and peak bytes,
+#         plus the speedup and memory saving of each lookup table conversion over its float64 version
+def benchmarkConversions(width, height, repeat = 3):
+	pixels = np.asarray(generateImage('noise', width, height))
+	megapixels = width * height / 1e6
+
+	conversions = [('hsv_float64', image_features.RGBtoHSVArray, ()),
+					('hsv_lookup_float32', image_features.RGBtoHSVLookup, (np.float32,)),
+					('hsv_lookup_uint16', image_features.RGBtoHSVLookup, (np.uint16,)),
+					('pad_float64', image_features.RGBtoPADArray, ()),
+					('pad_lookup_float32', image_features.RGBtoPADLookup, (np.float32,))]
+
+	rv = {}
+	for name, f, args in conversions:
+		elapsed = timeCall(lambda: f(pixels, *args), repeat)
+		_, peak, out = measureCall(f, pixels, *args)
+		rv[name] = {'seconds': elapsed, 'megapixels_per_second': megapixels / elapsed if elapsed > 0 else None,
+					'output_bytes': out.nbytes, 'peak_bytes': peak}
+		del out
+
+	for name in ('hsv_lookup_float32', 'hsv_lookup_uint16', 'pad_lookup_float32'):
+		exact = name.split('_')[0] + '_float64'
+		rv[name]['speedup'] = rv[exact]['seconds'] / rv[name]['seconds']
+		rv[name]['memory_saving'] = float(rv[exact]['output_bytes']) / rv[name]['output_bytes']
+	return rv
+
+# Benchmarks one image size. The image is written to a file so that opening and decoding it are timed the same way
+# as in production. Every feature is then timed on its own Image, so that it pays for its own color conversions,
+# and the whole feature set is timed together with image_features.FeatureExtractor.
+# Input:
+#   width, height - size of the image
+#   features - feature list given to image_features.FeatureExtractor
+#   kind - kind of image to generate, see generateImage()
+#   image_format - file format to save the image in, ex. 'png' or 'jpeg'
+# Output: dict of results. Each timed step has its time in seconds, megapixels per second, and peak bytes.
+def benchmarkSize(width, height, features = image_features.default_features, kind = 'noise', image_format = 'png'):
+	megapixels = width * height / 1e6
+
+	def result(elapsed, peak, _):
+		return {'seconds': elapsed, 'megapixels_per_second': megapixels / elapsed if elapsed > 0 else None, 'peak_bytes': peak}
+
+	tmp_dir = tempfile.mkdtemp()
+	try:
+		filename = os.path.join(tmp_dir, 'benchmark.' + image_format)
+		generateImage(kind, width, height).save(filename)
+
+		rv = {'width': width, 'height': height, 'megapixels': megapixels, 'kind': kind, 'format': image_format,
+				'file_bytes': os.path.getsize(filename), 'features': {}}
+
+		# Opening only reads the header, decoding is done when the pixels are first needed
+		measured = measureCall(image_features.newImage, filename)
+		rv['open'] = result(*measured)
+		im = measured[2]
+		rv['decode'] = result(*measureCall(image_features.Image._decode, im))
+		pil_image = im.image
+
+		extractor = image_features.FeatureExtractor(features)
+		for name, args in extractor.features:
+			im = image_features.Image(pil_image)
+			im.pixels
+			label = name + ('(' + ', '.join(map(str, args)) + ')' if len(args) > 0 else '')
+			rv['features'][label] = result(*measureCall(getattr(im, name), *args))
+
+		im = image_features.Image(pil_image)
+		im.pixels
+		rv['all_features'] = result(*measureCall(extractor.extract, im))
+	finally:
+		shutil.rmtree(tmp_dir)
+	return rv
+
+# Input:
+#   sizes - list of (width, height) 2-tuples
+#   Other arguments are given to benchmarkSize()
+# Output: dict of results that can be saved as JSON
+def benchmarkSuite(sizes = default_sizes, features = image_features.default_features, kind = 'noise', image_format = 'png'):
+	return {'version': image_features.__version__,
+			'features': suiteFeatures(features),
+			'python': platform.python_version(),
+			'numpy': np.__version__,
+			'machine': platform.machine(),
+			'time': time.time(),
+			'results': [benchmarkSize(width, height, features, kind, image_format) for width, height in sizes]}
+
+# Input: features - feature list given to image_features.FeatureExtractor
+# Output: the features as they are recorded in the results of benchmarkSuite()
+def suiteFeatures(features):
+	return [[name, list(args)] for name, args in image_features.FeatureExtractor(features).features]
+
+# Raises an exception if a suite did not time the given features, so its all_features times are not comparable
+# Input:
+#   suite - results of benchmarkSuite(), ex. loaded from JSON
+#   features - feature list given to image_features.FeatureExtractor
+def checkSuiteFeatures(suite, features):
+	# Compared as JSON, which is how suites are saved
+	features = json.loads(json.dumps(suiteFeatures(features)))
+	if suite.get('features') != features:
+		raise Exception('Invalid suite in checkSuiteFeatures: got features ' + str(suite.get('features')) + ', but must be ' + str(features))
+
+# Compares the results of two benchmark suites.
+# Output: list of 4-tuples of (width, height), the timed step, the old time, and the new time divided by the old time.
+#         Only steps that are in both suites are compared. Raises an exception if the suites timed different feature sets,
+#         since their all_features times are not comparable.
+def compareSuites(old, new):
+	if old.get('features') != new['features']:
+		raise Exception('Invalid suites in compareSuites: got features ' + str(old.get('features')) + ' and ' + str(new['features']) + ', but must be the same')
+
+	rv = []
+	old_results = dict(((r['width'], r['height']), r) for r in old['results'])
+	for new_result in new['results']:
+		size = (new_result['width'], new_result['height'])
+		if size not in old_results:
+			continue
+		old_result = old_results[size]
+
+		steps = [(step, old_result[step], new_result[step]) for step in ('open', 'decode', 'all_features')]
+		steps += [(name, old_result['features'][name], new_result['features'][name]) for name in new_result['features'] if name in old_result['features']]
+		for step, old_step, new_step in steps:
+			ratio = (new_step['seconds'] / old_step['seconds'] if old_step['seconds'] > 0 else None)
+			rv.append((size, step, old_step['seconds'], ratio))
+	return rv
+
+def _formatBytes(n):
+	return ('?' if n is None else '%.1fMB' % (n / 1048576.0))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Benchmarks image_features.py')
+
+	parser.add_argument('-s', '--sizes', metavar = 'WxH', type = str, nargs = '+', default = None, help = 'Sizes of the images to benchmark, ex. 1920x1080. Defaults to 90x90 up to 8K')
+	parser.add_argument('-k', '--kind', type = str, choices = ['noise', 'quadrant'], default = 'noise', help = 'Kind of image generated by gen_test_image.py')
+	parser.add_argument('-i', '--image_format', type = str, default = 'png', help = 'File format the generated images are decoded from')
+	parser.add_argument('-F', '--features', metavar = 'FEATURE', type = str, nargs = '+', default = None, help = 'Names of the features to benchmark. Defaults to image_features.default_features')
+
+	parser.add_argument('-o', '--out_file', metavar = 'FILENAME', type = str, default = None, help = 'File to save the results to as JSON')
+	parser.add_argument('-c', '--compare', metavar = 'FILENAME', type = str, default = None, help = 'JSON results of a previous run to compare against')
+
+	parser.add_argument('-w', '--wavelets', help = 'If given, only compares the wavelet features with and without sharing the wavelet transform', action = 'store_true')
+	parser.add_argument('--conversions', help = 'If given, only compares the float64 color conversions with the lookup table conversions', action = 'store_true')
+	parser.add_argument('-r', '--repeat', metavar = 'N', type = int, default = 3, help = 'Number of times to run each wavelet or conversion benchmark. The fastest run is reported')
+
+	args = parser.parse_args()
+
+	sizes = default_sizes
+	if args.sizes is not None:
+		sizes = [tuple(int(v) for v in size.lower().split('x')) for size in args.sizes]
+
+	if args.wavelets:
+		for width, height in sizes:
+			result = benchmarkWavelets(width, height, args.repeat)
+			print 'Wavelet features %dx%d: uncached %.4fs, cached %.4fs, speedup %.1fx' % (width, height, result['uncached'], result['cached'], result['speedup'])
+	elif args.conversions:
+		for width, height in sizes:
+			print '%dx%d' % (width, height)
+			for name, step in sorted(benchmarkConversions(width, height, args.repeat).items()):
+				print '  %-20s %9.4fs %10.2f MP/s %10s output %10s peak%s' % (name, step['seconds'], step['megapixels_per_second'] or 0.0,
+						_formatBytes(step['output_bytes']), _formatBytes(step['peak_bytes']),
+						(', %.1fx faster, %.1fx smaller' % (step['speedup'], step['memory_saving']) if 'speedup' in step else ''))
+	else:
+		features = image_features.default_features
+		if args.features is not None:
+			names = [(f if isinstance(f, basestring) else f[0]) for f in features]
+			unknown = [name for name in args.features if name not in names]
+			if len(unknown) > 0:
+				raise Exception('Invalid features in benchmark.py: got ' + str(unknown) + ', but must be in ' + str(sorted(set(names))))
+			features = [f for f, name in zip(features, names) if name in args.features]
+
+		# The previous run is checked first, so a run that cannot be compared to it fails before it is measured
+		if args.compare is not None:
+			with open(args.compare) as f:
+				old = json.load(f)
+			checkSuiteFeatures(old, features)
+
+		suite = benchmarkSuite(sizes, features, args.kind, args.image_format)
+		for result in suite['results']:
+			print '%dx%d (%.2f MP)' % (result['width'], result['height'], result['megapixels'])
+			steps = [('open', result['open']), ('decode', result['decode']), ('all_features', result['all_features'])] + sorted(result['features'].items())
+			for name, step in steps:
+				print '  %-40s %9.4fs %10.2f MP/s %10s' % (name, step['seconds'], step['megapixels_per_second'] or 0.0, _formatBytes(step['peak_bytes']))
+
+		if args.out_file is not None:
+			with open(args.out_file, 'w') as f:
+				json.dump(suite, f, indent = 2, sort_keys = True)
+
+		if args.compare is not None:
+			print 'Compared to ' + args.compare + ' (version ' + str(old.get('version')) + ')'
+			for size, step, old_seconds, ratio in compareSuites(old, suite):
+				print '  %dx%d %-40s %9.4fs -> %s' % (size[0], size[1], step, old_seconds, ('?' if ratio is None else '%.2fx' % ratio))
@@ -0,0 +1,268 @@
+
+import image_features
+
+import numpy as np
+
+import argparse
+import json
+import math
+import sys
+
+# Finds near-duplicate images by comparing the nine normalized section histograms that Image.binComparison() builds.
+# The distance between two images is the sum, over the nine sections, of the distance (see Image.binComparison()) between
+# the histograms of the same section of both images.
+#
+# Each image is stored as one float32 row of its histograms. For 'earth_mover' the rows hold the cumulative histograms
+# (of each channel for '3d'), which turns the earth mover distance into a sum of absolute differences. Queries scan the
+# rows in vectorized chunks. When the histograms are large, each section is also stored summed into at most
+# coarse_bins groups of bins. Distances between the coarse rows are a lower bound on the real distances, so a query
+# scans the coarse rows, and only computes real distances for the closest candidates until no candidate can be closer.
+#
+# An index is saved as four files sharing a prefix:
+#   <prefix>.vectors.npy - (N, 9 * dims) float32 rows
+#   <prefix>.coarse.npy - (N, 9 * coarse dims) float32 coarse rows, only if the histograms are large
+#   <prefix>.files.txt - the key of each row, one per line
+#   <prefix>.index.json - the binComparison arguments of the index
+
+# Number of rows compared at a time, which bounds the memory used by a query
+_chunk_size = 1 << 16
+
+class DuplicateIndex:
+	# Maximum number of groups each section is summed into for the coarse rows
+	coarse_bins = 8
+
+	# Input: num_bins, bin_type, norm_type, dif_type, pixel_type - see Image.binComparison()
+	def __init__(self, num_bins = 10, bin_type = 'avg', norm_type = 'sum_to_one', dif_type = 'sum_of_abs', pixel_type = 'rgb'):
+		image_features.Image._checkBinComparison(bin_type, norm_type, dif_type, pixel_type)
+
+		self.num_bins = num_bins
+		self.bin_type = bin_type
+		self.norm_type = norm_type
+		self.dif_type = dif_type
+		self.pixel_type = pixel_type
+
+		# Number of values per section in the rows
+		if bin_type == '3d' and dif_type == 'earth_mover':
+			self.dims = 3 * num_bins
+		else:
+			self.dims = (num_bins if bin_type == 'avg' else pow(num_bins, 3))
+
+		# Number of bins summed into each coarse bin, or None if there are no coarse rows
+		self.group_size = None
+		if self.dims > 2 * DuplicateIndex.coarse_bins:
+			self.group_size = int(math.ceil(self.dims / float(DuplicateIndex.coarse_bins)))
+
+		self.keys = []
+		self.vectors = np.empty((0, 9 * self.dims), dtype = np.float32)
+		self.coarse = (None if self.group_size is None else np.empty((0, 9 * DuplicateIndex.coarse_bins), dtype = np.float32))
+
+	def __len__(self):
+		return len(self.keys)
+
+	# Input: hists - (..., 9, num_bins) or (..., 9, num_bins^3) array of section histograms, see Image._sectionHistograms()
+	# Output: (..., 9 * dims) float32 array of the rows of the histograms
+	def rows(self, hists):
+		hists = image_features.normalizeHistograms(hists, self.norm_type)
+		if self.dif_type == 'earth_mover':
+			if self.bin_type == '3d':
+				cube = hists.reshape(hists.shape[:-1] + (self.num_bins, self.num_bins, self.num_bins))
+				marginals = [cube.sum(axis = (-2, -1)), cube.sum(axis = (-3, -1)), cube.sum(axis = (-3, -2))]
+				hists = np.concatenate([np.cumsum(m, axis = -1) for m in marginals], axis = -1)
+			else:
+				hists = np.cumsum(hists, axis = -1)
+		return hists.reshape(hists.shape[:-2] + (9 * self.dims,)).astype(np.float32)
+
+	# Input: rows - (..., 9 * dims) array outputted by rows()
+	# Output: (..., 9 * coarse_bins) array where each section's bins are summed in groups of group_size
+	def _coarseRows(self, rows):
+		sections = rows.reshape(rows.shape[:-1] + (9, self.dims))
+		padding = self.group_size * DuplicateIndex.coarse_bins - self.dims
+		if padding > 0:
+			sections = np.concatenate((sections, np.zeros(sections.shape[:-1] + (padding,), dtype = sections.dtype)), axis = -1)
+		groups = sections.reshape(sections.shape[:-1] + (DuplicateIndex.coarse_bins, self.group_size)).sum(axis = -1)
+		return groups.reshape(rows.shape[:-1] + (9 * DuplicateIndex.coarse_bins,))
+
+	# Input:
+	#   vectors - (N, 9 * D) array of rows
+	#   q - (9 * D,) row to compare to
+	# Output: (N,) array of the distance between q and every row
+	def _distances(self, vectors, q):
+		q = np.asarray(q, dtype = np.float32)
+		rv = np.empty(len(vectors), dtype = np.float32)
+		buf = np.empty((min(len(vectors), _chunk_size), len(q)), dtype = np.float32)
+		for i in range(0, len(vectors), _chunk_size):
+			d = np.subtract(vectors[i:i + _chunk_size], q, out = buf[:min(len(vectors) - i, _chunk_size)])
+			if self.dif_type == 'euclidean':
+				np.square(d, out = d)
+				np.sqrt(d.reshape(len(d), 9, -1).sum(axis = -1), dtype = np.float32).sum(axis = -1, out = rv[i:i + len(d)])
+			else:
+				np.abs(d, out = d)
+				d.sum(axis = -1, out = rv[i:i + len(d)])
+		return rv
+
+	# Input: image - image_features.Image object
+	# Output: row of the image
+	def imageRow(self, image):
+		return self.rows(image._sectionHistograms(self.num_bins, self.bin_type, self.pixel_type))
+
+	# Adds rows to the end of the index. The arrays double in size when they are full, so adding one image at a time
+	# takes amortized constant time.
+	def _append(self, keys, rows):
+		n = len(self.keys)
+		if n + len(keys) > len(self.vectors):
+			capacity = max(n + len(keys), 2 * len(self.vectors), 1024)
+			vectors = np.empty((capacity, self.vectors.shape[1]), dtype = np.float32)
+			vectors[:n] = self.vectors[:n]
+			self.vectors = vectors
+			if self.coarse is not None:
+				coarse = np.empty((capacity, self.coarse.shape[1]), dtype = np.float32)
+				coarse[:n] = self.coarse[:n]
+				self.coarse = coarse
+
+		self.vectors[n:n + len(keys)] = rows
+		if self.coarse is not None:
+			self.coarse[n:n + len(keys)] = self._coarseRows(rows)
+		self.keys.extend(keys)
+
+	# Input:
+	#   key - key of the image, usually its filename
+	#   image - image_features.Image object
+	def add(self, key, image):
+		self._append([key], self.imageRow(image)[np.newaxis])
+
+	# Input:
+	#   keys - list of N keys
+	#   batch - image_features.ImageBatch object of N images
+	def addBatch(self, keys, batch):
+		if len(keys) != batch.num_images:
+			raise Exception('Invalid keys in addBatch: got ' + str(len(keys)) + ' keys, but the batch has ' + str(batch.num_images) + ' images')
+		self._append(list(keys), self.rows(batch._sectionHistograms(self.num_bins, self.bin_type, self.pixel_type)))
+
+	# Finds the images closest to an image
+	# Input:
+	#   image - image_features.Image object, or a row outputted by imageRow()
+	#   k - maximum number of images to find
+	#   max_distance - if given, only images at most this distance away are found
+	# Output: list of up to k 2-tuples of the key and distance of the closest images, closest first
+	def query(self, image, k = 10, max_distance = None):
+		q = (self.imageRow(image) if isinstance(image, image_features.Image) else np.asarray(image, dtype = np.float32))
+		n = len(self.keys)
+		if n == 0 or k <= 0:
+			return []
+
+		# Candidates are kept as arrays of distances and row indices, sorted by distance
+		if self.coarse is None:
+			distances = self._distances(self.vectors[:n], q)
+			best_indices = np.argpartition(distances, min(k, n) - 1)[:k]
+			best_indices = best_indices[np.argsort(distances[best_indices], kind = 'mergesort')]
+			best_distances = distances[best_indices]
+		else:
+			# The sum of a group of differences is at most the sum of their absolute values, and at most sqrt(group_size)
+			# times their euclidean norm, so the coarse distances are lower bounds
+			bounds = self._distances(self.coarse[:n], self._coarseRows(q))
+			if self.dif_type == 'euclidean':
+				bounds /= math.sqrt(self.group_size)
+			order = np.argsort(bounds, kind = 'mergesort')
+
+			# Blocks start small, since usually only a few candidates need their real distance
+			best_distances = np.zeros(0, dtype = np.float32)
+			best_indices = np.zeros(0, dtype = np.int64)
+			start = 0
+			block_size = max(256, 4 * k)
+			while start < n:
+				# Candidates further away than this can not be found
+				limit = (best_distances[-1] if len(best_distances) == k else np.inf)
+				if max_distance is not None:
+					limit = min(limit, max_distance)
+
+				block = order[start:start + block_size]
+				start += len(block)
+				block_size = min(2 * block_size, _chunk_size)
+				if bounds[block[0]] > limit:
+					break
+
+				# Sorted so the rows are read from the (possibly memory mapped) array in order
+				block = np.sort(block[bounds[block] <= limit])
+				best_distances = np.concatenate((best_distances, self._distances(self.vectors[block], q)))
+				best_indices = np.concatenate((best_indices, block))
+				best = np.argsort(best_distances, kind = 'mergesort')[:k]
+				best_distances, best_indices = best_distances[best], best_indices[best]
+
+		return [(self.keys[i], d) for d, i in zip(best_distances.tolist(), best_indices.tolist())
+					if max_distance is None or d <= max_distance]
+
+	# Output: dict of the arguments of the index, that can be saved as JSON
+	def parameters(self):
+		return {'num_bins': self.num_bins, 'bin_type': self.bin_type, 'norm_type': self.norm_type,
+				'dif_type': self.dif_type, 'pixel_type': self.pixel_type, 'version': image_features.__version__}
+
+	# Input: prefix - prefix of the files to write
+	def save(self, prefix):
+		n = len(self.keys)
+		np.save(prefix + '.vectors.npy', self.vectors[:n])
+		if self.coarse is not None:
+			np.save(prefix + '.coarse.npy', self.coarse[:n])
+		with open(prefix + '.files.txt', 'w') as f:
+			for key in self.keys:
+				f.write(str(key) + '\n')
+		with open(prefix + '.index.json', 'w') as f:
+			json.dump(self.parameters(), f, indent = 2)
+
+# Input:
+#   prefix - prefix of the files written by DuplicateIndex.save()
+#   mmap - if True, the rows are memory mapped read-only instead of read into memory
+# Output: DuplicateIndex object. Adding images to it copies the rows into memory. Raises an exception if the index was
+#         built with a different image_features.__version__, whose rows may not match the rows of new images.
+def loadDuplicateIndex(prefix, mmap = True):
+	with open(prefix + '.index.json') as f:
+		parameters = json.load(f)
+	if parameters.get('version') != image_features.__version__:
+		raise Exception('Invalid version in loadDuplicateIndex: got ' + str(parameters.get('version')) + ' in ' + prefix + '.index.json, but must be ' + image_features.__version__ + '. Rebuild the index')
+	rv = DuplicateIndex(parameters['num_bins'], parameters['bin_type'], parameters['norm_type'], parameters['dif_type'], parameters['pixel_type'])
+
+	with open(prefix + '.files.txt') as f:
+		rv.keys = [line.rstrip('\n') for line in f]
+	rv.vectors = np.load(prefix + '.vectors.npy', mmap_mode = ('r' if mmap else None))
+	if rv.coarse is not None:
+		rv.coarse = np.load(prefix + '.coarse.npy', mmap_mode = ('r' if mmap else None))
+	return rv
+
+if __name__ == '__main__':
+	from extract_features import findImages
+
+	parser = argparse.ArgumentParser(description = 'Builds an index of images and finds near-duplicates of images in it')
+
+	parser.add_argument('index', metavar = 'PREFIX', type = str, help = 'Prefix of the index files')
+	parser.add_argument('-a', '--add', metavar = 'PATH', type = str, nargs = '+', default = [], help = 'Image files or directories of images to add to the index. The index is created if it does not exist')
+	parser.add_argument('-q', '--query', metavar = 'PATH', type = str, nargs = '+', default = [], help = 'Image files to find near-duplicates of')
+	parser.add_argument('-r', '--recursive', help = 'If given, directories are searched recursively', action = 'store_true')
+	parser.add_argument('-k', metavar = 'N', type = int, default = 5, help = 'Number of closest images to find for each query')
+	parser.add_argument('-d', '--max_distance', metavar = 'D', type = float, default = None, help = 'If given, only images at most this distance away are found')
+	parser.add_argument('-m', '--max_pixels', metavar = 'N', type = int, default = None, help = 'If given, larger images are downscaled to at most this many pixels')
+
+	# Arguments of a new index
+	parser.add_argument('--num_bins', metavar = 'N', type = int, default = 10, help = 'Number of bins of a new index')
+	parser.add_argument('--bin_type', type = str, choices = image_features.Image.binComparison_bin_types, default = 'avg')
+	parser.add_argument('--norm_type', type = str, choices = image_features.Image.binComparison_norm_types, default = 'sum_to_one')
+	parser.add_argument('--dif_type', type = str, choices = image_features.Image.binComparison_dif_types, default = 'sum_of_abs')
+	parser.add_argument('--pixel_type', type = str, choices = image_features.Image.binComparison_pixel_types, default = 'rgb')
+
+	args = parser.parse_args()
+
+	try:
+		index = loadDuplicateIndex(args.index)
+	except IOError:
+		index = DuplicateIndex(args.num_bins, args.bin_type, args.norm_type, args.dif_type, args.pixel_type)
+
+	if len(args.add) > 0:
+		for filename in findImages(args.add, args.recursive):
+			try:
+				index.add(filename, image_features.newImage(filename, cache_conversions = False, max_pixels = args.max_pixels))
+			except Exception as e:
+				sys.stderr.write('Failed to add ' + filename + ': ' + str(e) + '\n')
+		index.save(args.index)
+
+	for filename in args.query:
+		print filename
+		for key, distance in index.query(image_features.newImage(filename, max_pixels = args.max_pixels), args.k, args.max_distance):
+			print '  %.6f %s' % (distance, key)
@@ -0,0 +1,340 @@
+
+import image_features
+from feature_cache import FeatureCache
+from feature_matrix import featureSchema, keysFilename, schemaFilename
+from pixel_store import PixelStore
+
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import argparse
+import csv
+import json
+import os
+import re
+import struct
+import sys
+
+# Extensions of files that are picked up when a directory is given
+image_extensions = ['.jpg', '.jpeg', '.png', '.bmp', '.gif', '.tif', '.tiff']
+
+# Parses a feature given on the command line. Arguments are separated from the name by colons, ex. binComparison:10:3d
+# Input: feature - string
+# Output: 2-tuple of the feature name and a tuple of arguments
+def parseFeature(feature):
+	parts = feature.split(':')
+	args = []
+	for arg in parts[1:]:
+		try:
+			args.append(int(arg))
+		except ValueError:
+			args.append(arg)
+	return (parts[0], tuple(args))
+
+# Input:
+#   paths - list of image files and directories
+#   recursive - if True, directories are walked recursively
+# Output: sorted list of image files
+def findImages(paths, recursive = False):
+	images = []
+	for path in paths:
+		if not os.path.isdir(path):
+			images.append(path)
+			continue
+
+		for dirpath, dirnames, filenames in os.walk(path):
+			images.extend(os.path.join(dirpath, f) for f in filenames if os.path.splitext(f)[1].lower() in image_extensions)
+			if not recursive:
+				break
+	return sorted(images)
+
+# Runs in the worker processes.
+# Input:
+#   filenames - list of image files
+#   features - feature list given to image_features.FeatureExtractor
+#   max_pixels - see image_features.Image.__init__()
+#   cache_file - if given, path to a feature_cache.FeatureCache database used to skip features that were already computed
+#   cache_bytes - maximum size of the cache
+#   pixel_store - if given, prefix of a pixel store (see pixel_store.py) that the images are read from instead of being decoded.
+#                 The cache and max_pixels are not used.
+#   fast_conversions - if True, see image_features.enableFastConversions()
+#   sample_rate, seed - see image_features.FeatureExtractor.__init__(). The cache is not used when sampling.
+# Output: list of 3-tuples of the filename, the feature vector (None on failure), and an error message (None on success)
+def extractChunk(filenames, features, max_pixels = None, cache_file = None, cache_bytes = None, pixel_store = None, fast_conversions = False,
+					sample_rate = None, seed = 0):
+	if fast_conversions:
+		image_features.enableFastConversions()
+	else:
+		image_features.disableFastConversions()
+
+	extractor = image_features.FeatureExtractor(features, sample_rate, seed)
+	cache = (None if cache_file is None or pixel_store is not None or sample_rate is not None else FeatureCache(cache_file, cache_bytes))
+	store = (None if pixel_store is None else PixelStore(pixel_store))
+
+	rv = []
+	for filename in filenames:
+		try:
+			if store is not None:
+				row = extractor.extract(store.image(filename))
+			elif cache is None:
+				row = extractor.extract(image_features.newImage(filename, max_pixels = max_pixels))
+			else:
+				row = cache.extract(filename, extractor, max_pixels)
+			rv.append((filename, row, None))
+		except Exception as e:
+			rv.append((filename, None, str(e)))
+
+	if cache is not None:
+		cache.close()
+	return rv
+
+# -------------------
+# |  Output Writers  |
+# -------------------
+
+# Each writer appends one row per image to its output file as soon as the row is given to it, and can report which
+# images are already in the file so that an interrupted run can be resumed.
+# Rows that were only partially written when a run was interrupted are discarded when the file is reopened.
+
+# Truncates a text file to its last complete line
+# Output: list of the complete lines
+def _completeLines(filename):
+	if not os.path.exists(filename):
+		return []
+
+	with open(filename, 'rb') as f:
+		data = f.read()
+	end = data.rfind('\n') + 1
+	if end != len(data):
+		with open(filename, 'rb+') as f:
+			f.truncate(end)
+	return data[:end].splitlines()
+
+class CSVWriter:
+	def __init__(self, filename, columns):
+		lines = _completeLines(filename)
+		if len(lines) > 0:
+			# Rows of a resumed file must have the same columns as the new rows
+			header = next(csv.reader(lines[:1]))
+			if header != ['filename'] + columns:
+				raise Exception('Invalid columns in CSVWriter: got ' + str(header[1:]) + ' in ' + filename + ', but must be ' + str(columns))
+		self.done = set(row[0] for row in csv.reader(lines[1:]))
+
+		self.f = open(filename, 'ab')
+		self.writer = csv.writer(self.f)
+		if len(lines) == 0:
+			self.writer.writerow(['filename'] + columns)
+
+	def write(self, filename, row):
+		self.writer.writerow([filename] + [repr(v) for v in row])
+		self.f.flush()
+
+	def close(self):
+		self.f.close()
+
+# The first line is a header record of the columns, like the header row of CSVWriter, and each other line is the row of
+# one image
+class JSONLWriter:
+	def __init__(self, filename, columns):
+		records = [json.loads(line) for line in _completeLines(filename)]
+		if len(records) > 0:
+			# Rows of a resumed file must have the same columns as the new rows
+			header = records[0].get('columns')
+			if header != columns:
+				raise Exception('Invalid columns in JSONLWriter: got ' + str(header) + ' in ' + filename + ', but must be ' + str(columns))
+		self.done = set(record['filename'] for record in records[1:])
+
+		self.f = open(filename, 'ab')
+		if len(records) == 0:
+			self.f.write(json.dumps({'columns': columns}) + '\n')
+			self.f.flush()
+
+	def write(self, filename, row):
+		self.f.write(json.dumps({'filename': filename, 'features': row}) + '\n')
+		self.f.flush()
+
+	def close(self):
+		self.f.close()
+
+# Writes a (N, num_features) float64 or float32 .npy file. The filename of each row is written, in the same order, to a
+# text file next to it with the extension .files.txt, and if a schema is given it is written to a .schema.json file, so
+# the output can be loaded with feature_matrix.loadFeatureMatrix().
+# The .npy header is a fixed size so it can be rewritten with the final number of rows when the writer is closed.
+class NPYWriter:
+	header_size = 128
+
+	# Input:
+	#   filename, columns - see the other writers
+	#   schema - output of feature_matrix.featureSchema(), or None
+	#   dtype - '<f8' or '<f4'
+	def __init__(self, filename, columns, schema = None, dtype = '<f8'):
+		if dtype not in ('<f8', '<f4'):
+			raise Exception('Invalid dtype in NPYWriter: got ' + str(dtype) + ', but must be in [\'<f8\', \'<f4\']')
+
+		self.filename = filename
+		self.num_columns = len(columns)
+		self.dtype = dtype
+		self.row_bytes = np.dtype(dtype).itemsize * self.num_columns
+		self.files_filename = keysFilename(filename)
+
+		filenames = _completeLines(self.files_filename)
+		if os.path.exists(filename):
+			with open(filename, 'rb') as f:
+				header = f.read(NPYWriter.header_size)
+			if ("'descr': '" + dtype + "'") not in header:
+				raise Exception('Invalid dtype in NPYWriter: ' + filename + ' was not written with ' + dtype)
+			shape = re.search(r"'shape': \((\d+), (\d+)\)", header)
+			if shape is None or int(shape.group(2)) != self.num_columns:
+				raise Exception('Invalid columns in NPYWriter: got ' + (shape.group(2) if shape is not None else 'no shape') + ' columns in ' + filename + ', but must be ' + str(self.num_columns))
+
+			# Rows of a resumed file must have been extracted the same way as the new rows
+			if schema is not None and os.path.exists(schemaFilename(filename)):
+				with open(schemaFilename(filename)) as f:
+					old_schema = json.load(f)
+				# Compared as JSON, which is how the schema is stored
+				new_schema = json.loads(json.dumps(schema))
+				different = sorted(key for key in set(old_schema) | set(new_schema) if old_schema.get(key) != new_schema.get(key))
+				if len(different) > 0:
+					raise Exception('Invalid schema in NPYWriter: got different ' + ', '.join(different) + ' in ' + schemaFilename(filename) + ', but must be the same as the requested features')
+			data_rows = (os.path.getsize(filename) - NPYWriter.header_size) // self.row_bytes
+		else:
+			data_rows = 0
+		self.num_rows = min(len(filenames), max(data_rows, 0))
+
+		# Drops anything past the last row that was completely written to both files
+		with open(self.files_filename, 'ab') as f:
+			f.truncate(sum(len(name) + 1 for name in filenames[:self.num_rows]))
+		self.done = set(filenames[:self.num_rows])
+
+		self.f = open(filename, 'rb+' if os.path.exists(filename) else 'wb+')
+		self._writeHeader()
+		self.f.truncate(NPYWriter.header_size + self.row_bytes * self.num_rows)
+		self.f.seek(0, os.SEEK_END)
+
+		self.files_f = open(self.files_filename, 'ab')
+
+		if schema is not None:
+			with open(schemaFilename(filename), 'w') as f:
+				json.dump(schema, f, indent = 2)
+
+	def _writeHeader(self):
+		header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }" % (self.dtype, self.num_rows, self.num_columns)
+		header = header.ljust(NPYWriter.header_size - 10 - 1) + '\n'
+
+		self.f.seek(0)
+		self.f.write('\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header)
+		self.f.seek(0, os.SEEK_END)
+
+	def write(self, filename, row):
+		self.f.write(np.asarray(row, dtype = self.dtype).tostring())
+		self.f.flush()
+		self.files_f.write(filename + '\n')
+		self.files_f.flush()
+		self.num_rows += 1
+
+	def close(self):
+		self._writeHeader()
+		self.f.close()
+		self.files_f.close()
+
+writers = {'csv': CSVWriter, 'jsonl': JSONLWriter, 'npy': NPYWriter}
+
+# Extracts features from all images in parallel and writes them to the writer as they complete.
+# Input:
+#   filenames - list of image files
+#   writer - one of the above writers. Images already in writer.done are skipped
+#   features - feature list given to image_features.FeatureExtractor
+#   num_workers - number of worker processes
+#   chunk_size - number of images given to a worker at a time
+#   max_pixels - see image_features.Image.__init__()
+#   cache_file, cache_bytes, pixel_store, fast_conversions, sample_rate, seed - see extractChunk()
+# Output: number of images that failed
+def extractAll(filenames, writer, features, num_workers = None, chunk_size = 8, max_pixels = None, cache_file = None, cache_bytes = None, pixel_store = None,
+				fast_conversions = False, sample_rate = None, seed = 0):
+	filenames = [f for f in filenames if f not in writer.done]
+	chunks = [filenames[i:i + chunk_size] for i in range(0, len(filenames), chunk_size)]
+
+	num_failed = 0
+	with ProcessPoolExecutor(max_workers = num_workers) as executor:
+		futures = [executor.submit(extractChunk, chunk, features, max_pixels, cache_file, cache_bytes, pixel_store, fast_conversions, sample_rate, seed)
+					for chunk in chunks]
+		for future in as_completed(futures):
+			for filename, row, error in future.result():
+				if error is None:
+					writer.write(filename, row)
+				else:
+					num_failed += 1
+					sys.stderr.write('Failed to extract features from ' + filename + ': ' + error + '\n')
+	return num_failed
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Extracts image features from many images in parallel')
+
+	# Input
+	parser.add_argument('paths', metavar = 'PATH', type = str, nargs = '*', help = 'Image files or directories of images')
+	parser.add_argument('-l', '--file_list', metavar = 'FILENAME', type = str, default = None, help = 'File with one image path per line')
+	parser.add_argument('-r', '--recursive', help = 'If given, directories are searched recursively', action = 'store_true')
+	parser.add_argument('-p', '--pixel_store', metavar = 'PREFIX', type = str, default = None, help = 'Pixel store created by pixel_store.py to read the images from. Defaults to every image in it if no paths are given')
+
+	# Features
+	parser.add_argument('-F', '--features', metavar = 'FEATURE', type = str, nargs = '+', default = None,
+						help = 'Features to extract, with arguments separated by colons (ex. binComparison:10:3d). Defaults to image_features.default_features')
+	parser.add_argument('-m', '--max_pixels', metavar = 'N', type = int, default = None, help = 'If given, larger images are downscaled to at most this many pixels before computing pixel features')
+	parser.add_argument('--fast_conversions', help = 'If given, HSV and PAD are computed with lookup tables as float32, see image_features.enableFastConversions()', action = 'store_true')
+	parser.add_argument('--sample_rate', metavar = 'R', type = float, default = None,
+						help = 'If given, section averages and binComparison are estimated from this fraction of the pixels of each section. The cache is not used')
+	parser.add_argument('--seed', metavar = 'N', type = int, default = 0, help = 'Seed of the pixels sampled with --sample_rate')
+
+	# Cache
+	parser.add_argument('--cache', metavar = 'FILENAME', type = str, default = None, help = 'SQLite database of previously computed features. Only features not in it are computed')
+	parser.add_argument('--cache_size', metavar = 'MB', type = float, default = None, help = 'Maximum size of the cache. Least recently used features are evicted')
+
+	# Parallelism
+	parser.add_argument('-w', '--workers', metavar = 'N', type = int, default = None, help = 'Number of worker processes. Defaults to the number of CPUs')
+	parser.add_argument('-c', '--chunk_size', metavar = 'N', type = int, default = 8, help = 'Number of images sent to a worker at a time')
+
+	# Output
+	parser.add_argument('-f', '--out_file', metavar = 'FILENAME', type = str, required = True, help = 'File to write the features to. Rows already in the file are not recomputed')
+	parser.add_argument('-t', '--out_type', type = str, choices = sorted(writers.keys()), default = None, help = 'Format of the output file. Defaults to the extension of out_file')
+	parser.add_argument('--float32', help = 'If given, npy files are written as float32 instead of float64', action = 'store_true')
+
+	args = parser.parse_args()
+
+	filenames = findImages(args.paths, args.recursive)
+	if args.file_list is not None:
+		with open(args.file_list) as f:
+			filenames += [line.strip() for line in f if line.strip() != '']
+	if args.pixel_store is not None and len(filenames) == 0:
+		filenames = PixelStore(args.pixel_store).filenames
+
+	# Only so the schema records it, the workers set it themselves
+	if args.fast_conversions:
+		image_features.enableFastConversions()
+
+	if args.features is None:
+		features = image_features.default_features
+	else:
+		features = [parseFeature(feature) for feature in args.features]
+	extractor = image_features.FeatureExtractor(features, args.sample_rate, args.seed)
+	columns = extractor.columns
+
+	out_type = args.out_type
+	if out_type is None:
+		out_type = os.path.splitext(args.out_file)[1][1:].lower()
+	if out_type not in writers:
+		raise Exception('Invalid output type: got ' + str(out_type) + ', but must be in ' + str(sorted(writers.keys())))
+
+	if out_type == 'npy':
+		writer = NPYWriter(args.out_file, columns, featureSchema(extractor), ('<f4' if args.float32 else '<f8'))
+	else:
+		writer = writers[out_type](args.out_file, columns)
+	try:
+		num_failed = extractAll(filenames, writer, features, args.workers, args.chunk_size, args.max_pixels,
+								args.cache, (None if args.cache_size is None else int(args.cache_size * 1024 * 1024)), args.pixel_store,
+								args.fast_conversions, args.sample_rate, args.seed)
+	finally:
+		writer.close()
+
+	if num_failed > 0:
+		sys.exit(1)
@@ -0,0 +1,145 @@
+
+import image_features
+
+import hashlib
+import json
+import sqlite3
+import time
+
+# Input: filename - path to a file
+# Output: hex SHA-1 digest of the contents of the file
+def fileHash(filename):
+	h = hashlib.sha1()
+	with open(filename, 'rb') as f:
+		while True:
+			block = f.read(1 << 20)
+			if not block:
+				break
+			h.update(block)
+	return h.hexdigest()
+
+# Persistent store of feature values in a SQLite database.
+# Each value is keyed by the hash of the image file's contents, the feature name and arguments, the downscale policy
+# the image was decoded with, and image_features.__version__. Changing an image, adding a feature, or changing the
+# feature definitions therefore only recomputes what is affected.
+# When the stored values exceed max_bytes, the least recently used values are evicted.
+class FeatureCache:
+	# Input:
+	#   filename - path to the SQLite database. Created if it does not exist.
+	#   max_bytes - maximum total size of the stored values, or None for no maximum
+	def __init__(self, filename, max_bytes = None):
+		self.filename = filename
+		self.max_bytes = max_bytes
+
+		# Several worker processes may share the same database
+		self.db = sqlite3.connect(filename, timeout = 60.0)
+		self.db.execute('CREATE TABLE IF NOT EXISTS features (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS features_last_used ON features (last_used)')
+		self.db.commit()
+
+	# Input:
+	#   file_hash - output of fileHash()
+	#   name, args - feature name and arguments
+	#   max_pixels - see image_features.Image.__init__()
+	# Output: key of the feature value in the database. Values computed with image_features.enableFastConversions() are
+	#         kept separate from the exact values.
+	@staticmethod
+	def key(file_hash, name, args, max_pixels = None):
+		key = [file_hash, name, list(args), max_pixels, image_features.__version__]
+		if image_features.fast_conversions:
+			key.append('fast_conversions')
+		return json.dumps(key)
+
+	# Input: keys - list of keys
+	# Output: dict mapping the keys that are in the cache to their values
+	def get(self, keys):
+		rv = {}
+		for key in keys:
+			row = self.db.execute('SELECT value FROM features WHERE key = ?', (key,)).fetchone()
+			if row is not None:
+				rv[key] = json.loads(row[0])
+
+		if len(rv) > 0:
+			now = time.time()
+			self.db.executemany('UPDATE features SET last_used = ? WHERE key = ?', [(now, key) for key in rv])
+			self.db.commit()
+		return rv
+
+	# Input: values - dict mapping keys to feature values (lists of numbers)
+	def put(self, values):
+		now = time.time()
+		rows = []
+		for key, value in values.items():
+			value = json.dumps(value)
+			rows.append((key, value, len(key) + len(value), now))
+		self.db.executemany('INSERT OR REPLACE INTO features VALUES (?, ?, ?, ?)', rows)
+		self.db.commit()
+
+		self.evict()
+
+	# Deletes the least recently used values until the total size is at most max_bytes
+	def evict(self):
+		if self.max_bytes is None:
+			return
+
+		total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+		if total <= self.max_bytes:
+			return
+
+		to_delete = []
+		for key, size in self.db.execute('SELECT key, size FROM features ORDER BY last_used'):
+			if total <= self.max_bytes:
+				break
+			to_delete.append((key,))
+			total -= size
+		self.db.executemany('DELETE FROM features WHERE key = ?', to_delete)
+		self.db.commit()
+
+	# Output: 2-tuple of the number of stored values and their total size
+	def stats(self):
+		return tuple(self.db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM features').fetchone())
+
+	def close(self):
+		self.db.close()
+
+	# Same as extractor.extract(image_features.newImage(filename, max_pixels = max_pixels)), except features already in the
+	# cache are not recomputed, and the image is not decoded at all if every feature is cached.
+	# Input:
+	#   filename - path to an image file
+	#   extractor - image_features.FeatureExtractor object
+	#   max_pixels - see image_features.Image.__init__()
+	# Output: list of the values of all features, with the layout given by extractor.columns
+	def extract(self, filename, extractor, max_pixels = None):
+		return self._extract(fileHash(filename), lambda: image_features.newImage(filename, max_pixels = max_pixels), extractor, max_pixels)
+
+	# Same as extract(), but for an image held in memory
+	# Input: data - contents of an image file, as a string
+	def extractBytes(self, data, extractor, max_pixels = None):
+		return self._extract(hashlib.sha1(data).hexdigest(), lambda: image_features.newImageFromBytes(data, max_pixels = max_pixels), extractor, max_pixels)
+
+	# Input:
+	#   file_hash - output of fileHash() for the image
+	#   open_image - function with no arguments that outputs the image_features.Image object, only called if a feature is missing
+	#   extractor, max_pixels - see extract()
+	def _extract(self, file_hash, open_image, extractor, max_pixels):
+		keys = [FeatureCache.key(file_hash, name, args, max_pixels) for name, args in extractor.features]
+		values = self.get(keys)
+
+		missing = [(key, feature) for key, feature in zip(keys, extractor.features) if key not in values]
+		if len(missing) > 0:
+			missing_extractor = image_features.FeatureExtractor([feature for _, feature in missing])
+			computed = missing_extractor.extract(open_image())
+
+			new_values = {}
+			i = 0
+			for key, (name, args) in missing:
+				length = image_features.FeatureExtractor.featureLength(name, args)
+				new_values[key] = computed[i:i + length]
+				i += length
+			self.put(new_values)
+			values.update(new_values)
+
+		rv = []
+		for key in keys:
+			rv.extend(values[key])
+		return rv
@@ -0,0 +1,141 @@
+
+import argparse
+import base64
+import json
+import os
+import socket
+import sys
+import threading
+
+# Client of feature_server.py. It only uses the standard library, so a job that starts a new Python process to extract
+# the features of a few images does not import NumPy, PyWavelets or PIL. See the top of feature_server.py for the protocol.
+
+class FeatureClient:
+	# Input:
+	#   address - path of the server's Unix socket, or (host, port) of its TCP socket
+	#   timeout - seconds to wait for the server before raising an exception, or None to wait forever
+	def __init__(self, address, timeout = None):
+		if isinstance(address, basestring):
+			self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		else:
+			self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.settimeout(timeout)
+		self.socket.connect(address)
+		self.rfile = self.socket.makefile('rb')
+		self.wfile = self.socket.makefile('wb')
+		self.next_id = 0
+
+	def close(self):
+		self.rfile.close()
+		self.wfile.close()
+		self.socket.close()
+
+	def _send(self, request):
+		self.wfile.write(json.dumps(request) + '\n')
+		self.wfile.flush()
+
+	def _receive(self):
+		line = self.rfile.readline()
+		if line == '':
+			raise Exception('Invalid response: the server closed the connection')
+		return json.loads(line)
+
+	# Input: request - dict of a request, without an id
+	# Output: dict of its response
+	def request(self, request):
+		request = dict(request, id = self.next_id)
+		self.next_id += 1
+		self._send(request)
+		return self._receive()
+
+	# Input:
+	#   path - path to an image file, read by the server. Relative paths are made absolute.
+	#   data - contents of an image file, instead of path
+	#   features - list of (name, args) features or strings such as 'binComparison:10:3d', or None for the server's default
+	#   max_pixels - see image_features.Image.__init__(), or None for the server's default
+	# Output: list of the values of all features. Raises an exception if the server could not extract them.
+	def extract(self, path = None, data = None, features = None, max_pixels = None):
+		response = self.request(FeatureClient._extractRequest(path, data, features, max_pixels))
+		if response['error'] is not None:
+			raise Exception(response['error'])
+		return response['features']
+
+	# Sends the requests of many images at once, so the server works on them in parallel
+	# Input:
+	#   paths - list of image files, read by the server
+	#   features, max_pixels - see extract()
+	# Output: generator of 3-tuples of the path, the feature vector (None on failure) and an error message (None on success),
+	#         in the order the images finish
+	def extractMany(self, paths, features = None, max_pixels = None):
+		first_id = self.next_id
+		self.next_id += len(paths)
+
+		# Requests are sent from a second thread while responses are read, so neither side waits on a full socket buffer
+		def send():
+			for i, path in enumerate(paths):
+				self._send(dict(FeatureClient._extractRequest(path, None, features, max_pixels), id = first_id + i))
+		sender = threading.Thread(target = send)
+		sender.daemon = True
+		sender.start()
+
+		for _ in range(len(paths)):
+			response = self._receive()
+			yield paths[response['id'] - first_id], response['features'], response['error']
+		sender.join()
+
+	# Output: dict of the server's metrics, see feature_server.ServerMetrics.stats()
+	def metrics(self):
+		return self.request({'command': 'metrics'})['metrics']
+
+	@staticmethod
+	def _extractRequest(path, data, features, max_pixels):
+		if (path is None) == (data is None):
+			raise Exception('Invalid arguments in extract: must give exactly one of path and data')
+
+		request = ({'path': os.path.abspath(path)} if path is not None else {'data': base64.b64encode(data)})
+		if features is not None:
+			request['features'] = [(f if isinstance(f, basestring) else [f[0], list(f[1])]) for f in features]
+		if max_pixels is not None:
+			request['max_pixels'] = max_pixels
+		return request
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Extracts image features with a running feature_server.py, writing JSONL to stdout')
+
+	parser.add_argument('paths', metavar = 'PATH', type = str, nargs = '*', help = 'Image files')
+	parser.add_argument('-l', '--file_list', metavar = 'FILENAME', type = str, default = None, help = 'File with one image path per line')
+
+	# Address
+	group = parser.add_mutually_exclusive_group(required = True)
+	group.add_argument('-s', '--socket', metavar = 'PATH', type = str, default = None, help = 'Path of the Unix socket of the server')
+	group.add_argument('-p', '--port', metavar = 'N', type = int, default = None, help = 'Port of the server on 127.0.0.1')
+
+	parser.add_argument('-F', '--features', metavar = 'FEATURE', type = str, nargs = '+', default = None,
+						help = 'Features to extract, with arguments separated by colons (ex. binComparison:10:3d). Defaults to the server\'s default')
+	parser.add_argument('-m', '--max_pixels', metavar = 'N', type = int, default = None, help = 'If given, larger images are downscaled to at most this many pixels')
+	parser.add_argument('--metrics', help = 'If given, the server\'s metrics are written to stdout as JSON instead', action = 'store_true')
+
+	args = parser.parse_args()
+
+	client = FeatureClient(args.socket if args.socket is not None else ('127.0.0.1', args.port))
+	num_failed = 0
+	try:
+		if args.metrics:
+			sys.stdout.write(json.dumps(client.metrics(), indent = 2, sort_keys = True) + '\n')
+		else:
+			paths = list(args.paths)
+			if args.file_list is not None:
+				with open(args.file_list) as f:
+					paths += [line.strip() for line in f if line.strip() != '']
+
+			for path, row, error in client.extractMany(paths, args.features, args.max_pixels):
+				if error is None:
+					sys.stdout.write(json.dumps({'filename': path, 'features': row}) + '\n')
+				else:
+					num_failed += 1
+					sys.stderr.write('Failed to extract features from ' + path + ': ' + error + '\n')
+	finally:
+		client.close()
+
+	if num_failed > 0:
+		sys.exit(1)
@@ -0,0 +1,135 @@
+
+import image_features
+
+import numpy as np
+
+import json
+import os
+
+# A feature matrix holds the feature vectors of many images as the rows of one contiguous float32 array, instead of a
+# list of Python floats per image, which takes about eight times the memory. Each column is described by a schema.
+# A feature matrix is saved as three files sharing a base name, the same files written by extract_features.NPYWriter:
+#   <base>.npy - the (N, num_columns) array
+#   <base>.files.txt - the key of each row, usually the image filename, one per line
+#   <base>.schema.json - the features, the column names, the (name, args, index) of each column, the version of the
+#                        feature definitions, and whether they were approximated, see featureSchema()
+# The .npy file can be memory mapped, so training on millions of rows needs no parsing and only reads what is used.
+
+# Input: filename - name of the .npy file of a feature matrix
+# Output: names of the key and schema files that go with it
+def keysFilename(filename):
+	return os.path.splitext(filename)[0] + '.files.txt'
+
+def schemaFilename(filename):
+	return os.path.splitext(filename)[0] + '.schema.json'
+
+# Input: extractor - image_features.FeatureExtractor object
+# Output: dict describing the columns of the feature vectors outputted by extractor, that can be saved as JSON
+def featureSchema(extractor):
+	return {'version': image_features.__version__,
+			'fast_conversions': image_features.fast_conversions,
+			'sample_rate': extractor.sample_rate,
+			'seed': extractor.seed,
+			'features': [[name, list(args)] for name, args in extractor.features],
+			'columns': extractor.columns,
+			'schema': [[name, list(args), index] for name, args, index in extractor.schema]}
+
+class FeatureMatrix:
+	# Input:
+	#   features - feature list given to image_features.FeatureExtractor
+	#   capacity - number of rows to preallocate. The array doubles in size when it is full.
+	#   dtype - dtype of the values
+	def __init__(self, features = image_features.default_features, capacity = 1024, dtype = np.float32):
+		self.extractor = image_features.FeatureExtractor(features)
+		self.columns = self.extractor.columns
+		self.schema = self.extractor.schema
+
+		self.keys = []
+		self.values = np.empty((capacity, len(self.columns)), dtype = dtype)
+
+	def __len__(self):
+		return len(self.keys)
+
+	# Output: (N, num_columns) view of the rows added so far
+	def array(self):
+		return self.values[:len(self.keys)]
+
+	# Makes room for n more rows
+	# Output: view of the next n rows
+	def _reserve(self, n):
+		start = len(self.keys)
+		if start + n > len(self.values):
+			values = np.empty((max(start + n, 2 * len(self.values)), len(self.columns)), dtype = self.values.dtype)
+			values[:start] = self.values[:start]
+			self.values = values
+		return self.values[start:start + n]
+
+	# Computes the features of an image straight into the next row
+	# Input:
+	#   key - key of the row, usually the image filename
+	#   image - image_features.Image object
+	def extract(self, key, image):
+		self.extractor.extractInto(image, self._reserve(1)[0])
+		self.keys.append(key)
+
+	# Input:
+	#   keys - list of N keys
+	#   rows - (N, num_columns) array of feature vectors with the layout of self.columns, ex. the output of
+	#          image_features.ImageBatch.extract()
+	def addRows(self, keys, rows):
+		rows = np.asarray(rows)
+		if rows.shape != (len(keys), len(self.columns)):
+			raise Exception('Invalid rows in addRows: got shape ' + str(rows.shape) + ', but must be ' + str((len(keys), len(self.columns))))
+		self._reserve(len(keys))[:] = rows
+		self.keys.extend(keys)
+
+	# Input:
+	#   name, args - feature name and arguments
+	#   index - index in the feature's output, ex. the section of a section feature
+	# Output: (N,) view of the column
+	def column(self, name, args = (), index = 0):
+		key = (name, tuple(args), index)
+		for i, column in enumerate(self.schema):
+			if column == key:
+				return self.array()[:, i]
+		raise Exception('Invalid column in column: ' + str(key) + ' is not in the feature matrix')
+
+	# Input:
+	#   filename - name of the .npy file to write. The key and schema files are written next to it.
+	#   layout - 'rows' to store each feature vector contiguously, or 'columns' to store each column contiguously
+	#            (Fortran order), which is faster for reading a few columns of many rows
+	def save(self, filename, layout = 'rows'):
+		if layout not in ('rows', 'columns'):
+			raise Exception('Invalid layout in save: got ' + str(layout) + ', but must be in [\'rows\', \'columns\']')
+
+		arr = self.array()
+		np.save(filename, (np.asfortranarray(arr) if layout == 'columns' else arr))
+		with open(keysFilename(filename), 'w') as f:
+			for key in self.keys:
+				f.write(str(key) + '\n')
+		with open(schemaFilename(filename), 'w') as f:
+			json.dump(featureSchema(self.extractor), f, indent = 2)
+
+# Input:
+#   filename - name of the .npy file of a feature matrix saved by FeatureMatrix.save() or extract_features.NPYWriter
+#   mmap - if True, the values are memory mapped read-only instead of read into memory
+# Output: FeatureMatrix object. Adding rows to it copies the values into memory.
+def loadFeatureMatrix(filename, mmap = True):
+	with open(schemaFilename(filename)) as f:
+		schema = json.load(f)
+	with open(keysFilename(filename)) as f:
+		keys = [line.rstrip('\n') for line in f]
+
+	values = np.load(filename, mmap_mode = ('r' if mmap else None))
+	if values.shape != (len(keys), len(schema['columns'])):
+		raise Exception('Invalid feature matrix in loadFeatureMatrix: ' + filename + ' has shape ' + str(values.shape) +
+						', but its key and schema files have ' + str((len(keys), len(schema['columns']))))
+
+	# JSON turns the tuples in feature arguments into lists
+	def tuples(v):
+		return (tuple(tuples(x) for x in v) if isinstance(v, list) else v)
+
+	rv = FeatureMatrix([(name, tuples(args)) for name, args in schema['features']], capacity = 0, dtype = values.dtype)
+	rv.keys = keys
+	rv.values = values
+	return rv
@@ -0,0 +1,438 @@
+
+import image_features
+from extract_features import parseFeature
+from feature_cache import FeatureCache
+
+from concurrent.futures import ProcessPoolExecutor
+
+import argparse
+import base64
+import collections
+import hashlib
+import json
+import multiprocessing
+import os
+import Queue
+import signal
+import SocketServer
+import sys
+import threading
+import time
+
+# A long running feature extraction server, so that jobs extracting the features of a few images at a time do not each
+# pay for starting Python, importing NumPy, PyWavelets and PIL, and starting worker processes.
+# The server listens on a Unix socket or a localhost port, and keeps a pool of worker processes and the feature caches
+# (an in-memory cache of recent results, and optionally a feature_cache.FeatureCache database) for as long as it runs.
+#
+# The protocol is one JSON object per line in each direction. A request is one of:
+#   {"id": ..., "path": "/abs/image.jpg", "features": [...], "max_pixels": N}
+#   {"id": ..., "data": "<base64 encoded image file>", "features": [...], "max_pixels": N}
+#   {"id": ..., "command": "metrics"}
+#   {"id": ..., "command": "ping"}
+# "features" is a list of [name, args] pairs or strings such as "binComparison:10:3d" (see extract_features.parseFeature()),
+# and defaults to image_features.default_features. "id" and "max_pixels" are optional. Paths are read by the server.
+# Each request gets exactly one response with the same "id":
+#   {"id": ..., "features": [values], "error": null}, or {"id": ..., "features": null, "error": "message"}
+#   {"id": ..., "metrics": {...}}, see ServerMetrics.stats()
+#   {"id": ..., "pong": true}
+# Requests on one connection are worked on at the same time, so responses may come back in a different order.
+# feature_client.py is a client that does not import any of the extraction code.
+
+# -------------
+# |  Workers  |
+# -------------
+
+# Objects kept by each worker process between requests
+_worker_extractors = {}
+_worker_cache = None
+
+# Runs in the worker processes
+# Input:
+#   path, data - path to the image file, or None and the contents of the image file
+#   features - feature list given to image_features.FeatureExtractor
+#   max_pixels - see image_features.Image.__init__()
+#   cache_file, cache_bytes - see extract_features.extractChunk()
+#   fast_conversions - if True, see image_features.enableFastConversions()
+# Output: 4-tuple of the feature vector (None on failure), an error message (None on success), and the times the
+#         extraction started and ended
+def _extractRequest(path, data, features, max_pixels, cache_file, cache_bytes, fast_conversions):
+	global _worker_cache
+	start = time.time()
+
+	if fast_conversions:
+		image_features.enableFastConversions()
+	else:
+		image_features.disableFastConversions()
+
+	try:
+		key = json.dumps(features)
+		if key not in _worker_extractors:
+			_worker_extractors[key] = image_features.FeatureExtractor(features)
+		extractor = _worker_extractors[key]
+
+		if cache_file is not None and _worker_cache is None:
+			_worker_cache = FeatureCache(cache_file, cache_bytes)
+
+		if _worker_cache is not None:
+			row = (_worker_cache.extract(path, extractor, max_pixels) if data is None else _worker_cache.extractBytes(data, extractor, max_pixels))
+		else:
+			image = (image_features.newImage(path, max_pixels = max_pixels) if data is None else
+					 image_features.newImageFromBytes(data, max_pixels = max_pixels))
+			row = extractor.extract(image)
+		rv = (row, None)
+	except Exception as e:
+		rv = (None, str(e))
+	return rv + (start, time.time())
+
+# Runs in the worker processes, so that they are started before the first request
+def _ping():
+	return os.getpid()
+
+# -------------
+# |  Metrics  |
+# -------------
+
+# Counts of the requests handled by a server, the number waiting for a worker, and their latencies.
+# Latencies are kept for the last window requests, so the percentiles follow the current load.
+class ServerMetrics:
+	def __init__(self, window = 1000):
+		self.lock = threading.Lock()
+		self.started = time.time()
+
+		self.requests = 0
+		self.failed = 0
+		self.memory_cache_hits = 0
+		self.pending = 0
+		self.max_pending = 0
+
+		# Seconds from receiving a request to responding, waiting for a worker, and extracting in the worker
+		self.latency = collections.deque(maxlen = window)
+		self.queue = collections.deque(maxlen = window)
+		self.extract = collections.deque(maxlen = window)
+
+	# Called when a request is given to the workers
+	def submitted(self):
+		with self.lock:
+			self.pending += 1
+			self.max_pending = max(self.max_pending, self.pending)
+
+	# Called when a request is responded to
+	# Input:
+	#   latency - seconds since the request was received
+	#   failed - True if the response is an error
+	#   timing - None if the request was not given to the workers, else the seconds it waited for and spent in a worker
+	#   memory_cache_hit - True if the response came from the in-memory cache
+	def finished(self, latency, failed, timing = None, memory_cache_hit = False):
+		with self.lock:
+			self.requests += 1
+			self.failed += int(failed)
+			self.memory_cache_hits += int(memory_cache_hit)
+			self.latency.append(latency)
+			if timing is not None:
+				self.pending -= 1
+				self.queue.append(timing[0])
+				self.extract.append(timing[1])
+
+	# Input: values - sequence of seconds
+	# Output: dict of their count, mean and percentiles, or None if there are none
+	@staticmethod
+	def _summary(values):
+		if len(values) == 0:
+			return None
+		values = sorted(values)
+		def percentile(q):
+			return values[min(int(q / 100.0 * len(values)), len(values) - 1)]
+		return {'count': len(values), 'mean': sum(values) / len(values), 'p50': percentile(50), 'p90': percentile(90),
+				'p99': percentile(99), 'max': values[-1]}
+
+	# Output: dict of the metrics that can be saved as JSON. pending is the queue depth: the number of requests given to
+	#         the workers that are not finished yet.
+	def stats(self):
+		with self.lock:
+			uptime = time.time() - self.started
+			return {'uptime_seconds': uptime,
+					'requests': self.requests,
+					'failed': self.failed,
+					'memory_cache_hits': self.memory_cache_hits,
+					'requests_per_second': (self.requests / uptime if uptime > 0 else 0.0),
+					'pending': self.pending,
+					'max_pending': self.max_pending,
+					'latency_seconds': ServerMetrics._summary(self.latency),
+					'queue_seconds': ServerMetrics._summary(self.queue),
+					'extract_seconds': ServerMetrics._summary(self.extract)}
+
+# ------------
+# |  Server  |
+# ------------
+
+class FeatureServer:
+	# Input:
+	#   num_workers - number of worker processes. Defaults to the number of CPUs
+	#   max_pending - maximum number of requests given to the workers at a time. When it is reached, the server stops
+	#                 reading requests until one finishes, so clients are slowed down instead of filling memory.
+	#   max_pixels - default of the max_pixels of a request, see image_features.Image.__init__()
+	#   cache_file, cache_bytes - see extract_features.extractChunk()
+	#   memory_cache_size - number of recent responses kept in memory, keyed by the image's path, modification time and
+	#                       size, or by the hash of its data, and the features
+	#   fast_conversions - if True, see image_features.enableFastConversions()
+	#   metrics_window - see ServerMetrics
+	def __init__(self, num_workers = None, max_pending = 64, max_pixels = None, cache_file = None, cache_bytes = None, memory_cache_size = 1024,
+				 fast_conversions = False, metrics_window = 1000):
+		if max_pending < 1:
+			raise Exception('Invalid max_pending in FeatureServer: got ' + str(max_pending) + ', but must be at least 1')
+
+		self.max_pixels = max_pixels
+		self.cache_file = cache_file
+		self.cache_bytes = cache_bytes
+		self.fast_conversions = fast_conversions
+		self.metrics = ServerMetrics(metrics_window)
+
+		self.slots = threading.Semaphore(max_pending)
+		self.memory_cache_size = memory_cache_size
+		self.memory_cache = collections.OrderedDict()
+		self.memory_cache_lock = threading.Lock()
+		# Keys of the feature lists that are known to be valid
+		self.valid_features = set()
+
+		# Starts the workers now instead of on the first request
+		self.num_workers = (multiprocessing.cpu_count() if num_workers is None else num_workers)
+		self.workers = ProcessPoolExecutor(max_workers = self.num_workers)
+		for future in [self.workers.submit(_ping) for _ in range(self.num_workers)]:
+			future.result()
+
+	def close(self):
+		self.workers.shutdown(wait = True)
+
+	# Input: features - the "features" of a request
+	# Output: feature list given to image_features.FeatureExtractor. Raises an exception if a feature is invalid.
+	def _parseFeatures(self, features):
+		if features is None:
+			return image_features.default_features
+
+		# JSON turns the tuples in feature arguments into lists
+		def tuples(v):
+			return (tuple(tuples(x) for x in v) if isinstance(v, list) else v)
+
+		features = [(parseFeature(str(f)) if isinstance(f, basestring) else (str(f[0]), tuples(list(f[1])))) for f in features]
+		key = json.dumps(features)
+		if key not in self.valid_features:
+			image_features.FeatureExtractor(features)
+			self.valid_features.add(key)
+		return features
+
+	# Input: key - key of a response in the in-memory cache, or None
+	# Output: the cached feature vector, or None
+	def _cached(self, key):
+		if key is None or self.memory_cache_size == 0:
+			return None
+		with self.memory_cache_lock:
+			row = self.memory_cache.pop(key, None)
+			if row is not None:
+				self.memory_cache[key] = row
+			return row
+
+	def _cache(self, key, row):
+		if key is None or self.memory_cache_size == 0:
+			return
+		with self.memory_cache_lock:
+			self.memory_cache.pop(key, None)
+			self.memory_cache[key] = row
+			while len(self.memory_cache) > self.memory_cache_size:
+				self.memory_cache.popitem(last = False)
+
+	# Handles one request. Blocks while max_pending requests are already given to the workers.
+	# Input:
+	#   request - dict of the request, see the top of this file
+	#   respond - function that is given the dict of the response, exactly once, possibly from another thread
+	def handle(self, request, respond):
+		received = time.time()
+		request_id = request.get('id')
+		command = request.get('command', 'extract')
+
+		if command == 'metrics':
+			rv = self.metrics.stats()
+			rv['workers'] = self.num_workers
+			respond({'id': request_id, 'metrics': rv})
+			return
+		if command == 'ping':
+			respond({'id': request_id, 'pong': True})
+			return
+
+		def fail(message):
+			self.metrics.finished(time.time() - received, True)
+			respond({'id': request_id, 'features': None, 'error': message})
+
+		try:
+			if command != 'extract':
+				raise Exception('Invalid command: got ' + str(command) + ', but must be in [\'extract\', \'metrics\', \'ping\']')
+			if ('path' in request) == ('data' in request):
+				raise Exception('Invalid request: must have exactly one of path and data')
+
+			features = self._parseFeatures(request.get('features'))
+			max_pixels = request.get('max_pixels', self.max_pixels)
+			if 'path' in request:
+				path, data = str(request['path']), None
+				stat = os.stat(path)
+				key = json.dumps([os.path.abspath(path), stat.st_mtime, stat.st_size, features, max_pixels])
+			else:
+				path, data = None, base64.b64decode(request['data'])
+				key = json.dumps([hashlib.sha1(data).hexdigest(), features, max_pixels])
+		except Exception as e:
+			fail(str(e))
+			return
+
+		row = self._cached(key)
+		if row is not None:
+			self.metrics.finished(time.time() - received, False, memory_cache_hit = True)
+			respond({'id': request_id, 'features': row, 'error': None})
+			return
+
+		def finished(future):
+			try:
+				row, error, start, end = future.result()
+			except Exception as e:
+				row, error, start, end = None, str(e), received, received
+
+			if error is None:
+				self._cache(key, row)
+			self.metrics.finished(time.time() - received, error is not None, (start - received, end - start))
+			self.slots.release()
+			respond({'id': request_id, 'features': row, 'error': error})
+
+		self.slots.acquire()
+		self.metrics.submitted()
+		try:
+			future = self.workers.submit(_extractRequest, path, data, features, max_pixels, self.cache_file, self.cache_bytes, self.fast_conversions)
+		except Exception as e:
+			self.metrics.finished(time.time() - received, True, (0.0, 0.0))
+			self.slots.release()
+			respond({'id': request_id, 'features': None, 'error': str(e)})
+			return
+		future.add_done_callback(finished)
+
+	# Serves requests until interrupted
+	# Input: address - path of a Unix socket, or (host, port) of a TCP socket
+	def serve(self, address):
+		if isinstance(address, basestring):
+			if os.path.exists(address):
+				os.remove(address)
+			server = _ThreadingUnixServer(address, _RequestHandler)
+		else:
+			server = _ThreadingTCPServer(address, _RequestHandler)
+		server.feature_server = self
+
+		try:
+			server.serve_forever()
+		finally:
+			server.server_close()
+			if isinstance(address, basestring) and os.path.exists(address):
+				os.remove(address)
+
+# Reads requests from a connection, and writes their responses as they finish from a second thread, so a client that
+# is slow to read its responses does not hold up the workers. Runs in its own thread.
+class _RequestHandler(SocketServer.StreamRequestHandler):
+	def handle(self):
+		responses = Queue.Queue()
+
+		def write():
+			while True:
+				response = responses.get()
+				if response is None:
+					return
+				try:
+					self.wfile.write(json.dumps(response) + '\n')
+					self.wfile.flush()
+				except Exception:
+					# The client went away, the remaining responses are dropped
+					pass
+
+		writer = threading.Thread(target = write)
+		writer.daemon = True
+		writer.start()
+
+		outstanding = [0]
+		done = threading.Condition()
+		def respond(response):
+			responses.put(response)
+			with done:
+				outstanding[0] -= 1
+				done.notify_all()
+
+		for line in iter(self.rfile.readline, ''):
+			if line.strip() == '':
+				continue
+			with done:
+				outstanding[0] += 1
+			try:
+				request = json.loads(line)
+				if not isinstance(request, dict):
+					raise Exception('Invalid request: got ' + line.strip()[:100] + ', but must be a JSON object')
+			except Exception as e:
+				respond({'id': None, 'features': None, 'error': str(e)})
+				continue
+			self.server.feature_server.handle(request, respond)
+
+		# The connection is closed once every request read from it is responded to
+		with done:
+			while outstanding[0] > 0:
+				done.wait()
+		responses.put(None)
+		writer.join()
+
+class _ThreadingUnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	daemon_threads = True
+
+class _ThreadingTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description = 'Serves image feature extraction requests over a Unix socket or a localhost port, see feature_client.py')
+
+	# Address
+	group = parser.add_mutually_exclusive_group(required = True)
+	group.add_argument('-s', '--socket', metavar = 'PATH', type = str, default = None, help = 'Path of the Unix socket to listen on')
+	group.add_argument('-p', '--port', metavar = 'N', type = int, default = None, help = 'Port to listen on, on 127.0.0.1 only')
+
+	# Workers
+	parser.add_argument('-w', '--workers', metavar = 'N', type = int, default = None, help = 'Number of worker processes. Defaults to the number of CPUs')
+	parser.add_argument('-q', '--max_pending', metavar = 'N', type = int, default = 64, help = 'Maximum number of requests given to the workers at a time')
+	parser.add_argument('-m', '--max_pixels', metavar = 'N', type = int, default = None, help = 'Default maximum number of pixels, larger images are downscaled')
+	parser.add_argument('--fast_conversions', help = 'If given, HSV and PAD are computed with lookup tables as float32, see image_features.enableFastConversions()', action = 'store_true')
+
+	# Caches
+	parser.add_argument('--cache', metavar = 'FILENAME', type = str, default = None, help = 'SQLite database of previously computed features. Only features not in it are computed')
+	parser.add_argument('--cache_size', metavar = 'MB', type = float, default = None, help = 'Maximum size of the cache. Least recently used features are evicted')
+	parser.add_argument('--memory_cache', metavar = 'N', type = int, default = 1024, help = 'Number of recent responses kept in memory')
+
+	# Metrics
+	parser.add_argument('--metrics_interval', metavar = 'SECONDS', type = float, default = None, help = 'If given, the metrics are written to stderr as JSON this often')
+
+	args = parser.parse_args()
+
+	server = FeatureServer(args.workers, args.max_pending, args.max_pixels, args.cache,
+						   (None if args.cache_size is None else int(args.cache_size * 1024 * 1024)), args.memory_cache, args.fast_conversions)
+
+	# SIGTERM stops the server the same way as Ctrl-C, so the socket file is removed. It is set after the workers are
+	# started, so they keep the default handler.
+	def terminate(signum, frame):
+		raise KeyboardInterrupt()
+	signal.signal(signal.SIGTERM, terminate)
+
+	if args.metrics_interval is not None:
+		def report():
+			while True:
+				time.sleep(args.metrics_interval)
+				sys.stderr.write(json.dumps(server.metrics.stats()) + '\n')
+		reporter = threading.Thread(target = report)
+		reporter.daemon = True
+		reporter.start()
+
+	address = (args.socket if args.socket is not None else ('127.0.0.1', args.port))
+	sys.stderr.write('Serving on ' + str(address) + ' with ' + str(server.num_workers) + ' workers\n')
+	try:
+		server.serve(address)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.close()
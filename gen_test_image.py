@@ -1,9 +1,299 @@
 
 from PIL import Image as PIL_Image
 
+import numpy as np
+
+import image_features
+
+from concurrent.futures import ProcessPoolExecutor
+
 import argparse
 import random
-import math
+import json
+import os
+
+# Input: rng - random.Random object to draw from, or None to use the random module
+# Output: list of nine random RGB colors as 3-tuples
+def randomColors(rng = None):
+	rng = (random if rng is None else rng)
+	return [(rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255)) for _ in range(9)]
+
+# Creates an image that is divided into 3 equal sections in each dimension, where each of the 9 sections is a single color.
+# Input:
+#   width, height - size of the image
+#   colors - list of nine RGB colors as 3-tuples. Sections are ordered by x then y, the same as image_features.Image
+# Output: PIL.Image object
+def quadrantImage(width, height, colors):
+	arr = np.empty((height, width, 3), dtype = np.uint8)
+	wsecs, hsecs = image_features.sectionRanges(width, height, 3)
+
+	q = 0
+	for ws in wsecs:
+		for hs in hsecs:
+			arr[hs[0]:hs[1], ws[0]:ws[1]] = colors[q]
+			q += 1
+	return PIL_Image.fromarray(arr, 'RGB')
+
+# Input:
+#   length - number of pixels along the direction of the stripes
+#   num - number of stripes
+# Output: list of num (start, end) ranges of equal size, divided the same way as the sections
+def _stripeRanges(length, num):
+	return image_features.sectionRanges(length, 1, num)[0]
+
+# Input:
+#   width, height - size of the image
+#   profile - (length, 3) uint8 array of the color of each column (axis 'x') or each row (axis 'y')
+#   axis - 'x' if every column is a single color, 'y' if every row is
+# Output: PIL.Image object
+def _profileImage(width, height, profile, axis):
+	if axis == 'x':
+		arr = np.broadcast_to(profile[np.newaxis, :, :], (height, width, 3))
+	else:
+		arr = np.broadcast_to(profile[:, np.newaxis, :], (height, width, 3))
+	return PIL_Image.fromarray(np.ascontiguousarray(arr), 'RGB')
+
+# Input:
+#   width, height - size of the image
+#   colors - list of RGB colors as 3-tuples, one for each stripe
+#   axis - 'x' for vertical stripes across the width, 'y' for horizontal stripes across the height
+# Output: (length, 3) uint8 array of the color of each column or row
+def stripeProfile(width, height, colors, axis = 'x'):
+	length = (width if axis == 'x' else height)
+	profile = np.empty((length, 3), dtype = np.uint8)
+	for color, (start, end) in zip(colors, _stripeRanges(length, len(colors))):
+		profile[start:end] = color
+	return profile
+
+# Creates an image of equal width stripes, each a single color.
+# Input: the same as stripeProfile()
+# Output: PIL.Image object
+def stripeImage(width, height, colors, axis = 'x'):
+	if axis not in ('x', 'y'):
+		raise Exception('Invalid axis in stripeImage: got ' + str(axis) + ', but must be in [\'x\', \'y\']')
+	return _profileImage(width, height, stripeProfile(width, height, colors, axis), axis)
+
+# Input:
+#   width, height - size of the image
+#   start, end - RGB colors as 3-tuples of the first and last column or row
+#   axis - 'x' for a gradient across the width, 'y' for a gradient across the height
+# Output: (length, 3) uint8 array of the color of each column or row, linearly interpolated and rounded
+def gradientProfile(width, height, start, end, axis = 'x'):
+	length = (width if axis == 'x' else height)
+	t = np.arange(length, dtype = np.float64)[:, np.newaxis] / float(max(length - 1, 1))
+	start = np.array(start, dtype = np.float64)
+	end = np.array(end, dtype = np.float64)
+	return np.rint(start + (end - start) * t).astype(np.uint8)
+
+# Creates an image that changes linearly from one color to another.
+# Input: the same as gradientProfile()
+# Output: PIL.Image object
+def gradientImage(width, height, start, end, axis = 'x'):
+	if axis not in ('x', 'y'):
+		raise Exception('Invalid axis in gradientImage: got ' + str(axis) + ', but must be in [\'x\', \'y\']')
+	return _profileImage(width, height, gradientProfile(width, height, start, end, axis), axis)
+
+# Creates an image where every pixel is an independent uniformly random RGB color.
+# Input:
+#   width, height - size of the image
+#   seed - seed of the random number generator, the same seed always creates the same image
+# Output: PIL.Image object
+def noiseImage(width, height, seed = None):
+	arr = np.random.RandomState(seed).randint(0, 256, size = (height, width, 3)).astype(np.uint8)
+	return PIL_Image.fromarray(arr, 'RGB')
+
+# -----------------------
+# |  Expected Features  |
+# -----------------------
+
+# Features whose expected values are written next to each image of a corpus. They are computed from the colors of each
+# section and how many pixels have them, without converting any pixels, and are the same as image_features.Image gives
+# (up to float rounding) as long as the image is saved in a lossless format and fast conversions are not enabled.
+expected_features = [('size', ()),
+					 ('aspectRatio', ()),
+					 ('sumOfSizes', ()),
+					 ('averageBrightness', ()),
+					 ('averageHueOfMiddle', ()),
+					 ('averageSaturationOfMiddle', ()),
+					 ('averageRedOfEachSection', ()),
+					 ('averageGreenOfEachSection', ()),
+					 ('averageBlueOfEachSection', ()),
+					 ('averageHueOfEachSection', ()),
+					 ('averageSaturationOfEachSection', ()),
+					 ('averageValueOfEachSection', ()),
+					 ('binComparison', (10,)),
+					 ('binComparison', (4, '3d')),
+					 ('binComparison', (10, 'avg', 'sum_to_one', 'earth_mover', 'hsv'))]
+
+# Input: colors, counts - (k, 3) uint8 array of colors and (k,) array of how many pixels have each
+# Output: the distinct colors and their total counts
+def _mergeColors(colors, counts):
+	packed = (colors[:, 0].astype(np.int64) << 16) | (colors[:, 1].astype(np.int64) << 8) | colors[:, 2].astype(np.int64)
+	packed, inverse = np.unique(packed, return_inverse = True)
+	colors = np.stack(((packed >> 16) & 255, (packed >> 8) & 255, packed & 255), axis = -1).astype(np.uint8)
+	return colors, np.bincount(inverse, weights = counts).astype(np.int64)
+
+# Input:
+#   width, height - size of the image
+#   colors - list of nine RGB colors of the sections of a quadrantImage()
+# Output: list of the nine (colors, counts) of each section, ordered by x then y
+def quadrantSectionColors(width, height, colors):
+	wsecs, hsecs = image_features.sectionRanges(width, height, 3)
+	return [(np.array([colors[3 * i + j]], dtype = np.uint8), np.array([(ws[1] - ws[0]) * (hs[1] - hs[0])], dtype = np.int64))
+			for i, ws in enumerate(wsecs) for j, hs in enumerate(hsecs)]
+
+# Input: width, height, profile, axis - the same as _profileImage()
+# Output: list of the nine (colors, counts) of each section, ordered by x then y
+def profileSectionColors(width, height, profile, axis):
+	wsecs, hsecs = image_features.sectionRanges(width, height, 3)
+	rv = []
+	for ws in wsecs:
+		for hs in hsecs:
+			along, across = ((ws, hs) if axis == 'x' else (hs, ws))
+			colors = profile[along[0]:along[1]]
+			rv.append(_mergeColors(colors, np.full(len(colors), across[1] - across[0], dtype = np.int64)))
+	return rv
+
+# Input:
+#   width, height - size of the image
+#   sections - list of the nine (colors, counts) of each section, ex. the output of quadrantSectionColors(). May be None if
+#              only size features are computed.
+#   features - list of (name, args) features to compute, all in expected_features or binComparison with any arguments
+# Output: list of [name, args, values] of each feature, where values is the same list image_features.Image outputs
+def expectedFeatureValues(width, height, sections, features = expected_features):
+	# HSV of each distinct color, with the same per pixel conversion as image_features
+	hsvs = [np.array([image_features.RGBtoHSV(c) for c in colors.tolist()], dtype = np.float64).reshape(-1, 3) for colors, _ in (sections or [])]
+	def average(values, counts):
+		# Empty sections of images smaller than 3 pixels average to 0, the same as image_features
+		if counts.sum() == 0:
+			return 0.0
+		return float(np.dot(counts, values)) / float(counts.sum())
+
+	total = float(width * height)
+	rv = []
+	for name, args in features:
+		if name == 'size':
+			values = [width, height]
+		elif name == 'aspectRatio':
+			values = [float(width) / float(height)]
+		elif name == 'sumOfSizes':
+			values = [width + height]
+		elif name == 'averageBrightness':
+			values = [sum(float(np.dot(counts, hsv[:, 2])) for (_, counts), hsv in zip(sections, hsvs)) / total]
+		elif name in ('averageHueOfMiddle', 'averageSaturationOfMiddle'):
+			values = [average(hsvs[4][:, (0 if name == 'averageHueOfMiddle' else 1)], sections[4][1])]
+		elif name in ('averageRedOfEachSection', 'averageGreenOfEachSection', 'averageBlueOfEachSection'):
+			chan = ['Red', 'Green', 'Blue'].index(name[len('average'):-len('OfEachSection')])
+			values = [average(colors[:, chan].astype(np.float64), counts) for colors, counts in sections]
+		elif name in ('averageHueOfEachSection', 'averageSaturationOfEachSection', 'averageValueOfEachSection'):
+			chan = ['Hue', 'Saturation', 'Value'].index(name[len('average'):-len('OfEachSection')])
+			values = [average(hsv[:, chan], counts) for (_, counts), hsv in zip(sections, hsvs)]
+		elif name == 'binComparison':
+			num_bins, bin_type, pixel_type = image_features._binComparisonKey(*args)
+			norm_type = (args[2] if len(args) > 2 else 'sum_to_one')
+			dif_type = (args[3] if len(args) > 3 else 'sum_of_abs')
+			size = (num_bins if bin_type == 'avg' else num_bins ** 3)
+			hists = np.array([np.bincount(image_features.binIndices((colors if pixel_type == 'rgb' else image_features.RGBtoHSVArray(colors)), num_bins, bin_type, pixel_type),
+										  weights = counts, minlength = size)
+							  for colors, counts in sections])
+			bins = image_features.normalizeHistograms(hists, norm_type)
+			values = []
+			for i in range(9):
+				values.extend(image_features.histogramDistance(bins[i], bins[i + 1:], dif_type, num_bins, bin_type).tolist())
+		else:
+			raise Exception('Invalid feature in expectedFeatureValues: got ' + str(name) + ', but must be in ' + str(sorted(set(n for n, _ in expected_features))))
+		rv.append([name, list(args), values])
+	return rv
+
+# -------------
+# |  Corpora  |
+# -------------
+
+corpus_kinds = ['quadrant', 'stripe', 'gradient', 'noise']
+
+# Input:
+#   kind - one of corpus_kinds
+#   width, height - size of the image
+#   seed - seed of the random colors and layout, the same seed always creates the same image
+# Output: 3-tuple of
+#   PIL.Image object
+#   dict of the parameters the image was created with
+#   list of the nine (colors, counts) of each section, or None for noise images
+def corpusImage(kind, width, height, seed):
+	rng = np.random.RandomState(seed)
+	def color():
+		return tuple(int(v) for v in rng.randint(0, 256, size = 3))
+
+	if kind == 'quadrant':
+		colors = [color() for _ in range(9)]
+		return quadrantImage(width, height, colors), {'colors': colors}, quadrantSectionColors(width, height, colors)
+	if kind == 'stripe':
+		axis = ('x', 'y')[rng.randint(2)]
+		colors = [color() for _ in range(rng.randint(2, 13))]
+		profile = stripeProfile(width, height, colors, axis)
+		return _profileImage(width, height, profile, axis), {'colors': colors, 'axis': axis}, profileSectionColors(width, height, profile, axis)
+	if kind == 'gradient':
+		axis = ('x', 'y')[rng.randint(2)]
+		start, end = color(), color()
+		profile = gradientProfile(width, height, start, end, axis)
+		return _profileImage(width, height, profile, axis), {'start': start, 'end': end, 'axis': axis}, profileSectionColors(width, height, profile, axis)
+	if kind == 'noise':
+		noise_seed = int(rng.randint(2 ** 31))
+		return noiseImage(width, height, noise_seed), {'noise_seed': noise_seed}, None
+	raise Exception('Invalid kind in corpusImage: got ' + str(kind) + ', but must be in ' + str(corpus_kinds))
+
+# Input: filename - name of an image written by generateCorpus()
+# Output: name of the JSON file of its parameters and expected features
+def expectedFilename(filename):
+	return os.path.splitext(filename)[0] + '.json'
+
+# Creates and saves the index-th image of a corpus, and its expected features. Runs in a worker process.
+# Input: the same as generateCorpus(), and index - index of the image in the corpus
+# Output: filename of the image
+def _writeCorpusImage(out_dir, index, kinds, sizes, seed, image_format, features):
+	# Every image has its own seed, so the corpus does not depend on how the images are divided among the workers
+	image_seed = [seed, index]
+	rng = np.random.RandomState(image_seed)
+	kind = kinds[index % len(kinds)]
+	width, height = sizes[rng.randint(len(sizes))]
+
+	im, params, sections = corpusImage(kind, width, height, image_seed)
+	filename = os.path.join(out_dir, kind + '_' + str(index).zfill(6) + '.' + image_format)
+	im.save(filename)
+
+	# Noise images only have the features that do not depend on the pixels
+	expected = expectedFeatureValues(width, height, sections, (features if sections is not None else
+														  [f for f in features if f[0] in ('size', 'aspectRatio', 'sumOfSizes')]))
+	with open(expectedFilename(filename), 'w') as f:
+		json.dump({'kind': kind, 'width': width, 'height': height, 'seed': image_seed, 'params': params, 'features': expected}, f)
+	return filename
+
+# Creates a corpus of synthetic images in parallel. Each image is saved with a JSON file next to it (see expectedFilename())
+# holding its kind, size, seed and parameters, and the expected values of features, so the corpus can be used to check
+# the output of image_features at scale.
+# Input:
+#   out_dir - directory to save the images in, created if needed
+#   count - number of images
+#   kinds - list of kinds of images in corpus_kinds, used in turn
+#   sizes - list of (width, height) sizes, one is picked at random for each image
+#   seed - seed of the corpus, the same seed always creates the same images
+#   num_workers - number of processes to create the images in
+#   image_format - file extension of the images. Must be lossless for the expected features to hold.
+#   features - list of (name, args) features to write the expected values of, see expectedFeatureValues()
+# Output: list of the filenames of the images, in order
+def generateCorpus(out_dir, count, kinds = corpus_kinds, sizes = [(640, 480)], seed = 0, num_workers = None, image_format = 'png',
+				   features = expected_features):
+	for kind in kinds:
+		if kind not in corpus_kinds:
+			raise Exception('Invalid kind in generateCorpus: got ' + str(kind) + ', but must be in ' + str(corpus_kinds))
+	if image_format.lower() in ('jpg', 'jpeg'):
+		raise Exception('Invalid image_format in generateCorpus: got ' + str(image_format) + ', but must be lossless, ex. png, bmp or tiff')
+	if not os.path.isdir(out_dir):
+		os.makedirs(out_dir)
+
+	with ProcessPoolExecutor(max_workers = num_workers) as executor:
+		futures = [executor.submit(_writeCorpusImage, out_dir, i, kinds, sizes, seed, image_format, features) for i in range(count)]
+		return [future.result() for future in futures]
 
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description = 'Create a image that can be used to test image_features.py')
@@ -23,41 +313,42 @@ if __name__ == '__main__':
 	parser.add_argument('-q9', '--quad9', metavar = 'COLOR', type = int, nargs = 3, default = [0, 0, 0], help = 'RGB color of quadrant 9')
 
 	parser.add_argument('-rand','--rand_color', help = 'If given, all quadrants will have random colors', action = 'store_true')
+	parser.add_argument('-noise', '--noise', help = 'If given, every pixel is a random color instead of using quadrants', action = 'store_true')
+	parser.add_argument('-seed', '--seed', metavar = 'N', type = int, default = None, help = 'Seed for the random colors')
 
 	# Output
 	parser.add_argument('-f', '--out_file', metavar = 'FILENAME', type = str, nargs = 1, default = [None], help = 'File to save the image to')
- 
-	args = parser.parse_args()
-
-	width = args.size[0]
-	height = args.size[1]
-
-	colors = map(tuple,[args.quad1, args.quad2, args.quad3,
-						args.quad4, args.quad5, args.quad6,
-						args.quad7, args.quad8, args.quad9])
 
-	if args.rand_color:
-		for i in range(len(colors)):
-			colors[i] = (random.randint(0, 255), random.randint(0, 255), random.randint(0, 255))
+	# Corpus of many images
+	parser.add_argument('--corpus', metavar = 'DIR', type = str, default = None, help = 'If given, a corpus of many random images and their expected features is saved in DIR instead')
+	parser.add_argument('-n', '--count', metavar = 'N', type = int, default = 100, help = 'Number of images in the corpus')
+	parser.add_argument('-k', '--kinds', metavar = 'KIND', type = str, nargs = '+', default = corpus_kinds, choices = corpus_kinds, help = 'Kinds of images in the corpus')
+	parser.add_argument('--sizes', metavar = 'WxH', type = str, nargs = '+', default = None, help = 'Sizes of the images in the corpus, ex. 640x480 1920x1080. Defaults to the size given by -s')
+	parser.add_argument('-w', '--workers', metavar = 'N', type = int, default = None, help = 'Number of processes to create the corpus in')
+	parser.add_argument('--format', metavar = 'EXT', type = str, default = 'png', help = 'Lossless format of the images in the corpus, ex. png, bmp or tiff')
 
-	im = PIL_Image.new("RGB", (width, height), "black")
+	args = parser.parse_args()
 
-	wsecs = [int(math.ceil(float(width)  / 3.0 * v)) for v in range(3)]
-	hsecs = [int(math.ceil(float(height) / 3.0 * v)) for v in range(3)]
+	if args.corpus is not None:
+		sizes = ([tuple(int(v) for v in s.lower().split('x')) for s in args.sizes] if args.sizes is not None else [tuple(args.size)])
+		filenames = generateCorpus(args.corpus, args.count, args.kinds, sizes, (0 if args.seed is None else args.seed), args.workers, args.format)
+		print 'Saved', len(filenames), 'images in', args.corpus
+	else:
+		width = args.size[0]
+		height = args.size[1]
 
-	wsecs = [(wsecs[0], wsecs[1]), (wsecs[1], wsecs[2]), (wsecs[2], width)]
-	hsecs = [(hsecs[0], hsecs[1]), (hsecs[1], hsecs[2]), (hsecs[2], height)]
+		colors = map(tuple,[args.quad1, args.quad2, args.quad3,
+							args.quad4, args.quad5, args.quad6,
+							args.quad7, args.quad8, args.quad9])
 
-	pix = im.load()
+		if args.rand_color:
+			colors = randomColors(random.Random(args.seed))
 
-	q = 0
-	for ws in wsecs:
-		for hs in hsecs:
-			for w in xrange(*ws):
-				for h in xrange(*hs):
-					pix[w, h] = colors[q]
-			q += 1
+		if args.noise:
+			im = noiseImage(width, height, args.seed)
+		else:
+			im = quadrantImage(width, height, colors)
 
-	out_file = args.out_file[0]
-	if out_file != None:
-		im.save(out_file)
+		out_file = args.out_file[0]
+		if out_file != None:
+			im.save(out_file)
@@ -4,13 +4,227 @@ from PIL import Image as PIL_Image
 import numpy as np
 import pywt
 
+import contextlib
+import io
+import json
 import math
 import os
+import re
+import threading
+import time
+
+# Version of the feature definitions. Changed whenever the output of a feature changes, so cached features are recomputed.
+__version__ = '0.2'
 
 # TODO:
-# 	- Add benchmarking for various image sizes
 # 	- Add useful features
 
+# ---------------
+# |  Profiling  |
+# ---------------
+
+# Marks a function as an internal stage that is timed while profiling is enabled. The function itself is returned unchanged,
+# so there is no overhead when profiling is disabled.
+# Input:
+#   name - name of the stage
+#   cached - for stages that cache their output, function taking the same arguments that returns True if the call would
+#            only return the cached output
+def _stage(name, cached = None):
+	def mark(f):
+		f.profiling_stage = name
+		f.profiling_cached = cached
+		return f
+	return mark
+
+# Collects the wall time, number of pixels and bytes of arrays outputted by every profiled call.
+# Times are inclusive, so the time of a feature includes the time of the stages it runs. Pixels and bytes are only counted
+# for calls that computed their output, not for calls that returned a cached output.
+class Profiler:
+	def __init__(self):
+		# Images using threads (see Image.__init__()) record calls from several threads at once
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		# Maps names to dicts of the number of calls and total seconds, pixels and bytes
+		self.totals = {}
+
+	# Input:
+	#   name - name of the feature ('feature:<method name>') or stage ('stage:<stage name>')
+	#   seconds - wall time of the call
+	#   pixels - number of pixels the call worked on
+	#   nbytes - size of the arrays outputted by the call
+	def record(self, name, seconds, pixels, nbytes):
+		with self.lock:
+			if name not in self.totals:
+				self.totals[name] = {'calls': 0, 'seconds': 0.0, 'pixels': 0, 'bytes': 0}
+			total = self.totals[name]
+			total['calls'] += 1
+			total['seconds'] += seconds
+			total['pixels'] += pixels
+			total['bytes'] += nbytes
+
+	# Output: dict mapping names to their totals, plus the average seconds per call and megapixels per second
+	def stats(self):
+		rv = {}
+		for name, total in self.totals.items():
+			rv[name] = dict(total)
+			rv[name]['seconds_per_call'] = total['seconds'] / total['calls']
+			rv[name]['megapixels_per_second'] = (total['pixels'] / 1e6 / total['seconds'] if total['seconds'] > 0 else None)
+		return rv
+
+	# Output: string with one line per name, slowest first
+	def report(self):
+		lines = []
+		for name, s in sorted(self.stats().items(), key = lambda item: -item[1]['seconds']):
+			lines.append('%-45s %6d calls %10.4fs %12d pixels %12d bytes' % (name, s['calls'], s['seconds'], s['pixels'], s['bytes']))
+		return '\n'.join(lines)
+
+	# Writes stats() to a file as JSON
+	def dump(self, filename):
+		with open(filename, 'w') as f:
+			json.dump(self.stats(), f, indent = 2, sort_keys = True)
+
+# Profiler that calls are recorded to, or None if profiling is disabled
+profiler = None
+
+# List of (owner, key, original function) of everything wrapped by enableProfiling(). The owner is either a class, or
+# a dict (the module globals, pixel_array_functions or fast_array_functions).
+_profiled_originals = []
+
+def _arrayBytes(v):
+	if isinstance(v, np.ndarray):
+		return v.nbytes
+	if isinstance(v, (list, tuple)):
+		return sum(_arrayBytes(x) for x in v)
+	if isinstance(v, dict):
+		return sum(_arrayBytes(x) for x in v.values())
+	return 0
+
+def _pixelCount(args):
+	for arg in args:
+		if isinstance(arg, Image):
+			return arg.width * arg.height
+		if isinstance(arg, np.ndarray) and arg.ndim >= 2:
+			return arg.shape[0] * arg.shape[1]
+	return 0
+
+def _profiledFunction(name, f):
+	cached = getattr(f, 'profiling_cached', None)
+	def wrapper(*args, **kwargs):
+		# Checked before the call, which fills the cache
+		hit = (cached is not None and cached(*args, **kwargs))
+		start = time.time()
+		rv = f(*args, **kwargs)
+		elapsed = time.time() - start
+		if profiler is not None:
+			if hit:
+				profiler.record(name, elapsed, 0, 0)
+			else:
+				profiler.record(name, elapsed, _pixelCount(args), _arrayBytes(rv))
+		return rv
+	wrapper.__name__ = f.__name__
+	wrapper.__doc__ = f.__doc__
+	return wrapper
+
+# Starts recording every Image feature call and internal stage to the given profiler.
+# The profiled functions are swapped in for the originals, and swapped back out by disableProfiling().
+# Input: new_profiler - Profiler object, or None to create one
+# Output: the Profiler object
+def enableProfiling(new_profiler = None):
+	global profiler
+	disableProfiling()
+	profiler = (Profiler() if new_profiler is None else new_profiler)
+
+	module = globals()
+	for attr, f in list(module.items()):
+		if hasattr(f, 'profiling_stage'):
+			_profiled_originals.append((module, attr, f))
+			module[attr] = _profiledFunction('stage:' + f.profiling_stage, f)
+
+	# arrayFunction() looks up the array functions in pixel_array_functions and fast_array_functions rather than by name
+	for functions in (pixel_array_functions, fast_array_functions):
+		for pixel_f, f in list(functions.items()):
+			if hasattr(f, 'profiling_stage'):
+				_profiled_originals.append((functions, pixel_f, f))
+				functions[pixel_f] = module[f.__name__]
+
+	for cls in (Image, FeatureExtractor):
+		for attr, f in list(cls.__dict__.items()):
+			if hasattr(f, 'profiling_stage'):
+				name = 'stage:' + f.profiling_stage
+			elif cls is Image and callable(f) and not attr.startswith('_') and attr not in Image.unprofiled_methods:
+				name = 'feature:' + attr
+			else:
+				continue
+			_profiled_originals.append((cls, attr, f))
+			setattr(cls, attr, _profiledFunction(name, f))
+	return profiler
+
+# Stops recording and restores the original functions
+def disableProfiling():
+	global profiler
+	for owner, key, f in _profiled_originals:
+		if isinstance(owner, dict):
+			owner[key] = f
+		else:
+			setattr(owner, key, f)
+	del _profiled_originals[:]
+	profiler = None
+
+# Context manager that profiles everything run inside of it.
+# Ex.
+#   with image_features.profiling() as p:
+#       image_features.newImage('a.jpg').binComparison(10)
+#   print p.report()
+@contextlib.contextmanager
+def profiling(new_profiler = None):
+	p = enableProfiling(new_profiler)
+	try:
+		yield p
+	finally:
+		disableProfiling()
+
+# ---------------
+# |  Threading  |
+# ---------------
+
+# Number of rows in each strip when the work on an image is split between threads, see Image.__init__()
+_strip_rows = 256
+
+# Maps numbers of threads to the thread pool shared by every image using that many threads
+_thread_pools = {}
+_thread_pools_lock = threading.Lock()
+
+# Marks the threads of the pools, so work started from inside a pool thread runs in that thread instead of waiting for
+# a free thread in the same pool
+_pool_thread = threading.local()
+
+def _threadPool(num_threads):
+	with _thread_pools_lock:
+		if num_threads not in _thread_pools:
+			# Only images using threads need the futures backport
+			from concurrent.futures import ThreadPoolExecutor
+			_thread_pools[num_threads] = ThreadPoolExecutor(max_workers = num_threads)
+		return _thread_pools[num_threads]
+
+# Input:
+#   num_threads - number of threads to use. If 1, or if called from a pool thread, f is applied in the calling thread.
+#   f - function to apply. NumPy and PyWavelets release the GIL, so array work runs in parallel.
+#   items - list of independent inputs to f
+# Output: list of f applied to each item, in the same order as items
+def _parallelMap(num_threads, f, items):
+	if num_threads <= 1 or len(items) <= 1 or getattr(_pool_thread, 'active', False):
+		return [f(item) for item in items]
+
+	def run(item):
+		_pool_thread.active = True
+		try:
+			return f(item)
+		finally:
+			_pool_thread.active = False
+	return list(_threadPool(num_threads).map(run, items))
+
 # ----------------------
 # |  Helper Functions  |
 # ----------------------
@@ -57,38 +271,513 @@ def RGBtoPAD(vs):
 			-0.31 * vs[2] + 0.60 * vs[1], # Arousal
 			0.76 * vs[2]  + 0.32 * vs[1]) # Dominance
 
-# Creates a new image_feature.Image object from the given file.
+# Array versions of the above pixel functions. Each one performs the exact same floating point operations as its
+# scalar counterpart, but over every pixel of an image at once.
+# Input: (H, W, 3) uint8 array of RGB pixels. Any array whose last dimension is the 3 channels works, ex. (N, H, W, 3).
+# Output: array of the same shape with the converted pixels
+
+@_stage('rgb_to_hsv')
+def RGBtoHSVArray(arr):
+	rgb = arr.astype(np.float64) / 255.0
+	r = rgb[..., 0]
+	g = rgb[..., 1]
+	b = rgb[..., 2]
+
+	cmax = rgb.max(axis = -1)
+	cmin = rgb.min(axis = -1)
+
+	delta = cmax - cmin
+	safe_delta = np.where(delta == 0.0, 1.0, delta)
+
+	h = np.select([delta == 0.0, cmax == r, cmax == g],
+					[0.0, (g - b) / safe_delta, (b - r) / safe_delta + 2],
+					(r - g) / safe_delta + 4)
+	h = h * 60
+	h = np.where(h < 0, h + 360, h)
+
+	s = np.where(cmax == 0.0, 0.0, delta / np.where(cmax == 0.0, 1.0, cmax))
+	v = cmax
+
+	# Hue is truncated to an integer just like RGBtoHSV()
+	return np.stack((np.trunc(h), s, v), axis = -1)
+
+def RGBtoRGBArray(arr):
+	return arr
+
+def RGBtoPADArray(arr):
+	return HSVtoPADArray(RGBtoHSVArray(arr))
+
+# Input: (H, W, 3) array outputted by RGBtoHSVArray()
+# Output: (H, W, 3) array of the PAD representation of each pixel
+@_stage('hsv_to_pad')
+def HSVtoPADArray(hsv):
+	return np.stack((0.69 * hsv[..., 2]  + 0.22 * hsv[..., 1], # Pleasure
+					-0.31 * hsv[..., 2] + 0.60 * hsv[..., 1], # Arousal
+					0.76 * hsv[..., 2]  + 0.32 * hsv[..., 1]), axis = -1) # Dominance
+
+# Maps each pixel function to its array version
+pixel_array_functions = {RGBtoRGB: RGBtoRGBArray,
+							RGBtoHSV: RGBtoHSVArray,
+							RGBtoPAD: RGBtoPADArray}
+
+# ------------------------------------
+# |  Lookup Table Color Conversions  |
+# ------------------------------------
+
+# Pixels are always 8-bit RGB, so saturation, value and PAD only depend on the largest and smallest channel of a pixel,
+# and can be looked up in tables computed once for all 256 * 256 pairs with the same floating point operations as
+# RGBtoHSV(). Hue is computed with integer arithmetic. Converting an image then takes a few uint8 and int32 operations and
+# table lookups per pixel, instead of a dozen float64 operations, and the planes are float32 or uint16 instead of float64.
+#
+# Accuracy compared to RGBtoHSV() and RGBtoPAD(), checked over all 2^24 RGB colors:
+#   - saturation, value and PAD are the exact float64 values rounded to float32 (relative error at most 2^-24). The uint16
+#     fixed point saturation and value are within 1 / 131070.
+#   - hue is computed exactly as floor(60 * x / delta). RGBtoHSV() rounds just below the hue before truncating it for
+#     0.8% of colors, all of which have a whole number hue, so for those colors hue is 1 degree higher. Hue is never
+#     off by more than 1 degree.
+# Features computed with the lookup tables differ from the float64 ones by less than 1e-4 relative, except for hue
+# features, where averages move by hundredths of a degree and hue histograms and wavelets by up to 1% relative.
+
+# Maps dtypes to the (256 * 256, 5) table of the saturation, value and PAD of every [max channel, min channel] pair
+_lookup_tables = {}
+
+def _lookupTable(dtype):
+	if dtype not in _lookup_tables:
+		cmax = np.arange(256)[:, np.newaxis] / 255.0
+		cmin = np.arange(256)[np.newaxis, :] / 255.0
+
+		# Computed for every pair, but only pairs where cmin <= cmax are used
+		s = np.where(cmax == 0.0, 0.0, (cmax - cmin) / np.where(cmax == 0.0, 1.0, cmax))
+		v = np.broadcast_to(cmax, s.shape)
+		pad = HSVtoPADArray(np.stack((np.zeros(s.shape), s, v), axis = -1))
+
+		if dtype == np.uint16:
+			# Fixed point, where 65535 is 1.0. PAD is not available.
+			table = np.stack((np.round(s * 65535), np.round(v * 65535)), axis = -1)
+		else:
+			table = np.concatenate((np.stack((s, v), axis = -1), pad), axis = -1)
+		# Flattened so that each value is looked up with take(), which is faster than indexing with two arrays
+		_lookup_tables[dtype] = table.astype(dtype).reshape(256 * 256, table.shape[-1])
+	return _lookup_tables[dtype]
+
+# Number of pixels converted at a time, which bounds the memory used by the integer temporaries
+_lookup_chunk_size = 1 << 18
+
+# Input:
+#   arr - array of RGB pixels, where the last dimension is the 3 channels
+#   rv - output array of the same shape
+# Output: generator of 2-tuples of (N, 3) chunks of the pixels and the matching chunks of rv to write to
+def _lookupChunks(arr, rv):
+	pixels = arr.reshape(-1, 3)
+	out = rv.reshape(-1, 3)
+	for i in range(0, len(pixels), _lookup_chunk_size):
+		yield pixels[i:i + _lookup_chunk_size], out[i:i + _lookup_chunk_size]
+
+# Input: cmax, cmin - arrays of the largest and smallest channel of each pixel
+# Output: int32 array of the index of each pixel in the flattened lookup tables
+def _tableIndex(cmax, cmin):
+	return (cmax.astype(np.int32) << 8) | cmin
+
+# Input:
+#   arr - (H, W, 3) uint8 array of RGB pixels. Any array whose last dimension is the 3 channels works.
+#   dtype - np.float32 or np.float64, or np.uint16 for fixed point saturation and value where 65535 is 1.0
+# Output: array of the same shape as arr of the HSV representation of each pixel. Hue is a whole number of degrees.
+@_stage('rgb_to_hsv_lookup')
+def RGBtoHSVLookup(arr, dtype = np.float32):
+	if dtype not in (np.float32, np.float64, np.uint16):
+		raise Exception('Invalid dtype in RGBtoHSVLookup: got ' + str(dtype) + ', but must be in [np.float32, np.float64, np.uint16]')
+
+	table = _lookupTable(dtype)
+	rv = np.empty(arr.shape, dtype = dtype)
+	for pixels, out in _lookupChunks(arr, rv):
+		r = pixels[:, 0].astype(np.int16)
+		g = pixels[:, 1].astype(np.int16)
+		b = pixels[:, 2].astype(np.int16)
+		cmax = np.maximum(np.maximum(r, g), b)
+		delta = cmax - np.minimum(np.minimum(r, g), b)
+
+		# The hue in sixths of a circle times delta, in [0, 6 * delta)
+		x = np.where(cmax == r, g - b, np.where(cmax == g, b - r + 2 * delta, r - g + 4 * delta))
+		x += np.where(x < 0, 6 * delta, 0)
+		out[:, 0] = 60 * x.astype(np.int32) // np.maximum(delta, 1)
+
+		index = _tableIndex(cmax, cmax - delta)
+		out[:, 1] = table[:, 0].take(index)
+		out[:, 2] = table[:, 1].take(index)
+	return rv
+
+# Input: see RGBtoHSVLookup(), but dtype must be np.float32 or np.float64
+# Output: array of the same shape as arr of the PAD representation of each pixel
+@_stage('rgb_to_pad_lookup')
+def RGBtoPADLookup(arr, dtype = np.float32):
+	if dtype not in (np.float32, np.float64):
+		raise Exception('Invalid dtype in RGBtoPADLookup: got ' + str(dtype) + ', but must be in [np.float32, np.float64]')
+
+	table = _lookupTable(dtype)
+	rv = np.empty(arr.shape, dtype = dtype)
+	for pixels, out in _lookupChunks(arr, rv):
+		r = pixels[:, 0]
+		g = pixels[:, 1]
+		b = pixels[:, 2]
+		index = _tableIndex(np.maximum(np.maximum(r, g), b), np.minimum(np.minimum(r, g), b))
+		for chan in range(3):
+			out[:, chan] = table[:, 2 + chan].take(index)
+	return rv
+
+# Maps pixel functions to the lookup table version used instead of their array version when fast conversions are enabled
+fast_array_functions = {RGBtoHSV: RGBtoHSVLookup,
+						RGBtoPAD: RGBtoPADLookup}
+
+# If True, images are converted to HSV and PAD with the lookup tables as float32. See enableFastConversions().
+fast_conversions = False
+
+# Makes every Image and ImageBatch created afterwards convert pixels to HSV and PAD with the lookup tables, as float32.
+# This is several times faster and halves the memory of the conversions, within the accuracy given above.
+# Cached features should not be mixed between the two, see feature_cache.FeatureCache.key().
+def enableFastConversions():
+	global fast_conversions
+	fast_conversions = True
+
+def disableFastConversions():
+	global fast_conversions
+	fast_conversions = False
+
+# Input: pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+# Output: the function that applies pixel_f to an array of pixels, either its array version or its lookup table version
+def arrayFunction(pixel_f):
+	if fast_conversions and pixel_f in fast_array_functions:
+		return fast_array_functions[pixel_f]
+	return pixel_array_functions[pixel_f]
+
+# Maps the names of color spaces to the pixel function that converts to them
+pixel_spaces = {'rgb': RGBtoRGB,
+				'hsv': RGBtoHSV,
+				'pad': RGBtoPAD}
+
+# Input:
+#   arr - (..., 3) array of pixels. Either RGB pixels as uint8, or HSV pixels as outputted by RGBtoHSVArray().
+#   num_bins - number of bins to divide each channel into
+#   bin_type - 'avg' or '3d', see Image.binComparison()
+#   pixel_type - 'rgb' or 'hsv', the format of arr
+# Output: (...) int array of the index of the bin each pixel falls in
+@_stage('bin_indices')
+def binIndices(arr, num_bins, bin_type, pixel_type):
+	if pixel_type == 'rgb':
+		if bin_type == 'avg':
+			return np.floor(arr.sum(axis = -1, dtype = np.int64) / 3.0 * num_bins / 256.0).astype(np.int64)
+		chan_index = arr.astype(np.int64) * num_bins // 256
+	if pixel_type == 'hsv':
+		# Scales each channel to [0, 1]. The maximum value of a channel is put in the last bin.
+		scaled = arr / np.array([360.0, 1.0, 1.0])
+		if bin_type == 'avg':
+			return np.minimum(np.floor(scaled.mean(axis = -1) * num_bins), num_bins - 1).astype(np.int64)
+		chan_index = np.minimum(np.floor(scaled * num_bins), num_bins - 1).astype(np.int64)
+
+	return chan_index[..., 0] + chan_index[..., 1] * num_bins + chan_index[..., 2] * num_bins * num_bins
+
+# Input:
+#   hists - array of histograms, where the last dimension is the bins
+#   norm_type - 'sum_to_one', 'euclidean' or 'none', see Image.binComparison()
+# Output: array of the normalized histograms. Empty histograms are left as all zeros.
+def normalizeHistograms(hists, norm_type):
+	if norm_type == 'sum_to_one':
+		norm = hists.sum(axis = -1, keepdims = True).astype(np.float64)
+	elif norm_type == 'euclidean':
+		norm = np.sqrt(np.square(hists, dtype = np.float64).sum(axis = -1, keepdims = True))
+	elif norm_type == 'none':
+		return hists
+	return hists / np.where(norm == 0.0, 1.0, norm)
+
+# Input:
+#   a, b - arrays of histograms, where the last dimension is the bins. The other dimensions are broadcast against each other.
+#   dif_type - 'sum_of_abs', 'euclidean' or 'earth_mover', see Image.binComparison()
+#   num_bins, bin_type - the binning used to create the histograms
+# Output: array of the distance between each pair of histograms
+def histogramDistance(a, b, dif_type, num_bins, bin_type):
+	d = a - b
+	if dif_type == 'sum_of_abs':
+		return np.abs(d).sum(axis = -1)
+	if dif_type == 'euclidean':
+		return np.sqrt(np.square(d).sum(axis = -1))
+	if dif_type == 'earth_mover':
+		# In one dimension the earth mover distance is the sum of the absolute difference of the cumulative histograms.
+		# '3d' histograms use the sum of the distances between the histogram of each channel.
+		if bin_type == '3d':
+			d = d.reshape(d.shape[:-1] + (num_bins, num_bins, num_bins))
+			marginals = [d.sum(axis = (-2, -1)), d.sum(axis = (-3, -1)), d.sum(axis = (-3, -2))]
+		else:
+			marginals = [d]
+		return sum(np.abs(np.cumsum(m, axis = -1)).sum(axis = -1) for m in marginals)
+
+# Input:
+#   width, height - size of an image
+#   num - number of times to divide each dimension. Ex. providing a value of 3 creates 9 sections.
+# Output: two lists of 2-tuples. Each tuple is a range (inclusive lower-bound exclusive upper bound) of indices for a section.
+#         The first list is for the X/width dimension and the second list is for the Y/height dimension.
+def sectionRanges(width, height, num):
+	# Compute the lower bounds of each section
+	w_sections = [int(math.ceil(float(width  / float(num) * v))) for v in range(num)]
+	h_sections = [int(math.ceil(float(height / float(num) * v))) for v in range(num)]
+
+	# Add the upper bound of each section
+	w_sections = [(w_sections[i], (width  if i + 1 == num else w_sections[i + 1])) for i in range(num)]
+	h_sections = [(h_sections[i], (height if i + 1 == num else h_sections[i + 1])) for i in range(num)]
+
+	return w_sections, h_sections
+
+# Input: hs - list of ranges of rows, ex. the second output of sectionRanges()
+# Output: list of 2-tuples of the index of a range in hs and a strip of at most _strip_rows rows within it, covering every
+#         row in order. Reductions over the strips combine the strips of each range in this order, so their results only
+#         depend on the size of the image, no matter how many threads are used or how the pixels are read.
+def sectionStrips(hs):
+	return [(i, (start, min(start + _strip_rows, hr[1]))) for i, hr in enumerate(hs) for start in range(hr[0], hr[1], _strip_rows)]
+
+# Input:
+#   values - (rows, W, 3) array of a strip of pixels within one row of sections, see sectionStrips()
+#   x_starts - first column of each section, ex. [wr[0] for wr in ws]
+#   ufunc - NumPy ufunc to reduce with: np.add, np.minimum or np.maximum
+#   dtype - dtype to reduce in, or None for the dtype of values
+#   square - if True, the squares of values are reduced
+# Output: (len(x_starts), 3) array of the reduction of each section's part of the strip. Empty sections, which images
+#         narrower than the number of sections have, are zero.
+def reduceStripSections(values, x_starts, ufunc, dtype = None, square = False):
+	if square:
+		values = np.square(values, dtype = dtype)
+	columns = ufunc.reduce(values, axis = 0, dtype = dtype)
+
+	# reduceat outputs the value at the start of an empty range instead of reducing nothing, and fails on a range that
+	# starts at the end, so only the non-empty sections are reduced
+	x_starts = np.asarray(x_starts)
+	non_empty = (x_starts != np.append(x_starts[1:], values.shape[1]))
+	rv = np.zeros((len(x_starts),) + columns.shape[1:], dtype = columns.dtype)
+	rv[non_empty] = ufunc.reduceat(columns, x_starts[non_empty], axis = 0, dtype = dtype)
+	return rv
+
+# Input:
+#   arr - (rows, W, 3) array of a strip of pixels within one row of sections, see binIndices()
+#   x_section - length W array of the section of each column
+#   num_sections - number of sections in a row
+#   num_bins, bin_type, pixel_type - see Image.binComparison()
+# Output: (num_sections, num_bins) or (num_sections, num_bins^3) array of the number of pixels of each section's part of
+#         the strip in each bin. Every pixel is labeled with its section and bin, and all histograms are counted with a
+#         single bincount.
+def countStripSections(arr, x_section, num_sections, num_bins, bin_type, pixel_type):
+	total_bins = (num_bins if bin_type == 'avg' else pow(num_bins, 3))
+	bin_index = binIndices(arr, num_bins, bin_type, pixel_type)
+	return np.bincount((x_section * total_bins + bin_index).ravel(), minlength = num_sections * total_bins).reshape(num_sections, total_bins)
+
+# Input:
+#   width, height - size of an image
+#   max_pixels - maximum number of pixels allowed, or None for no maximum
+# Output: 2-tuple of the largest width and height with the same aspect ratio that have at most max_pixels pixels
+def downscaledSize(width, height, max_pixels = None):
+	if max_pixels is None or width * height <= max_pixels:
+		return width, height
+
+	scale = math.sqrt(float(max_pixels) / float(width * height))
+	return max(1, int(width * scale)), max(1, int(height * scale))
+
+# Input:
+#   arr - array to transform
+#   axes - the two axes of arr to transform over
+# Output: the level 3 db1 wavelet decomposition of arr, as outputted by pywt.wavedec2
+@_stage('wavedec2')
+def waveletDecomposition(arr, axes = (-2, -1)):
+	return pywt.wavedec2(arr, 'db1', level = 3, axes = axes)
+
+# Creates a new image_feature.Image object from the given file. Only the header of the file is read, the pixel data is
+# decoded the first time a feature needs it.
 # Input:
 #   filename - path to an image file. JPG and PNG file formats are tested and confirmed, but aany file format supported by PIL should work
+#   cache_conversions, max_pixels, num_threads - see Image.__init__()
+# Output:
+#   image_features.Image object
+def newImage(filename, cache_conversions = True, max_pixels = None, num_threads = 1):
+	return Image(PIL_Image.open(filename), cache_conversions = cache_conversions, max_pixels = max_pixels, num_threads = num_threads)
+
+# Creates a new image_feature.Image object from an encoded image that is already in memory, ex. received over a network.
+# Input:
+#   data - contents of an image file as a string, or a file-like object to read them from
+#   cache_conversions, max_pixels, num_threads - see Image.__init__()
+# Output:
+#   image_features.Image object
+def newImageFromBytes(data, cache_conversions = True, max_pixels = None, num_threads = 1):
+	if isinstance(data, basestring):
+		data = io.BytesIO(data)
+	return Image(PIL_Image.open(data), cache_conversions = cache_conversions, max_pixels = max_pixels, num_threads = num_threads)
+
+# Creates a new image_feature.Image object that uses an array of already decoded pixels. The array is not copied, so it
+# can be a view into a memory-mapped file (see pixel_store.py).
+# Input:
+#   pixels - (H, W, 3) uint8 array of RGB pixels
+#   cache_conversions, num_threads - see Image.__init__()
+#   full_size - 2-tuple of the width and height reported by the size features, if the pixels were downscaled from a
+#               larger image. Defaults to the size of pixels.
 # Output:
 #   image_features.Image object
-def newImage(filename):
-	return Image(PIL_Image.open(filename))
+def newImageFromArray(pixels, cache_conversions = True, full_size = None, num_threads = 1):
+	return Image(None, cache_conversions = cache_conversions, pixels = pixels, full_size = full_size, num_threads = num_threads)
 
 class Image:
+	# Public methods that are not features, and so are not profiled
+	unprofiled_methods = ['clearConversions', 'crop', 'edit', 'sampleSections', 'show', 'printAll']
+
 	# Input:
-	#   pil_image - PIL.Image object.
-	def __init__(self, pil_image):
-		# Converts image to RGB
-		self.image = pil_image.convert('RGB')
+	#   pil_image - PIL.Image object, or None if pixels is given.
+	#   cache_conversions - If True, the HSV and PAD representations of the image are computed once, the first time a
+	#                       feature needs them, and kept until clearConversions() is called. If False, they are recomputed
+	#                       by every feature, which keeps memory usage to the RGB pixels only.
+	#   max_pixels - If given, images with more pixels than this are downscaled (keeping their aspect ratio) before any
+	#                pixel features are computed. JPEGs are decoded directly at a reduced scale when possible.
+	#                The size features always use the full size of the image.
+	#   pixels, full_size - see newImageFromArray()
+	#   num_threads - If greater than 1, color conversions, section statistics, histograms and tile wavelet transforms are
+	#                 split into strips of rows, sections or tiles that are computed by a shared pool of this many threads,
+	#                 so a single very large image uses several cores. The work is split the same way for any number of
+	#                 threads, so the features are the same as with num_threads = 1.
+	def __init__(self, pil_image, cache_conversions = True, max_pixels = None, pixels = None, full_size = None, num_threads = 1):
+		if num_threads < 1:
+			raise Exception('Invalid num_threads in Image: got ' + str(num_threads) + ', but must be at least 1')
+		self.num_threads = num_threads
+
+		# Not converted to RGB until the pixels are needed, see _decode()
+		self.image = pil_image
+
+		if pixels is None:
+			# Size of the image, which is known from the header alone
+			self.full_width, self.full_height = pil_image.size
+
+			# Size of the pixel data used by the pixel features
+			self.width, self.height = downscaledSize(self.full_width, self.full_height, max_pixels)
+		else:
+			self.height, self.width = pixels.shape[:2]
+			self.full_width, self.full_height = ((self.width, self.height) if full_size is None else full_size)
+
+		self._pixels = pixels
+
+		# Maps pixel functions to the (H, W, 3) array of every pixel converted by that function
+		self.cache_conversions = cache_conversions
+		self.conversions = {}
+
+		# Maps (num, pixel_f) to the per section statistics computed by _sectionStatistics()
+		self.section_statistics = {}
+
+		# Maps (wr, hr, pixel_f, chan) to the wavelet coefficient sums computed by _waveletSums()
+		self.wavelet_sums = {}
+
+		# Maps num to the per tile wavelet coefficient sums computed by _tileWaveletSums()
+		self.tile_wavelet_sums = {}
 
-		# TODO only load pixel data as necessary
-		self.pix = self.image.load()
+		# Maps (num_bins, bin_type, pixel_type) to the histograms computed by _sectionHistograms()
+		self.section_histograms = {}
 
-		self.width, self.height = self.image.size
+		# Maps pixel functions to the integral image computed by _integralImage(). Cached if cache_conversions is set.
+		self.integral_images = {}
+
+	# (H, W, 3) uint8 array of the RGB pixels, so pixel (x, y) is self.pixels[y, x]. Decoded on first use.
+	@property
+	def pixels(self):
+		if self._pixels is None:
+			self._pixels = self._decode()
+		return self._pixels
+
+	# Frees the cached HSV and PAD representations and integral images of the image. They are recomputed the next time they are needed.
+	def clearConversions(self):
+		self.conversions = {}
+		self.integral_images = {}
+
+	# ---------------------
+	# |  Derived Images   |
+	# ---------------------
+
+	# Creates an image of a rectangular part of this image. The pixels and any cached HSV and PAD representations are
+	# views of this image's arrays, so nothing is decoded or converted again.
+	# Input: box - 4-tuple of the left, upper, right and lower pixel coordinates of the crop, the same as PIL's crop
+	# Output: image_features.Image object. Its full size is the size of the crop, scaled up if this image was downscaled.
+	def crop(self, box):
+		left, upper, right, lower = box
+		if not (0 <= left < right <= self.width and 0 <= upper < lower <= self.height):
+			raise Exception('Invalid box in crop: got ' + str(box) + ', but must be a non-empty box within (0, 0, ' + str(self.width) + ', ' + str(self.height) + ')')
+
+		full_size = (max(1, int(round((right - left) * self.full_width / float(self.width)))),
+					max(1, int(round((lower - upper) * self.full_height / float(self.height)))))
+		rv = Image(None, cache_conversions = self.cache_conversions, pixels = self.pixels[upper:lower, left:right], full_size = full_size,
+					num_threads = self.num_threads)
+		rv.conversions = dict((pixel_f, arr[upper:lower, left:right]) for pixel_f, arr in self.conversions.items())
+		return rv
+
+	# Creates an image of an edited version of this image's pixels. Everything this image has computed per section
+	# (color conversions, section statistics, histograms and tile wavelet sums) is reused for the sections where no
+	# pixels changed, and only recomputed for the sections that did. Whole image results are recomputed when needed.
+	# Input:
+	#   pixels - (H, W, 3) uint8 array of the edited RGB pixels, the same size as this image
+	#   box - if given, 4-tuple of the left, upper, right and lower pixel coordinates outside of which no pixels changed.
+	#         Otherwise the changed pixels are found by comparing pixels to this image's pixels.
+	# Output: image_features.Image object
+	def edit(self, pixels, box = None):
+		if pixels.shape != self.pixels.shape:
+			raise Exception('Invalid pixels in edit: got shape ' + str(pixels.shape) + ', but must be ' + str(self.pixels.shape))
+
+		rv = Image(None, cache_conversions = self.cache_conversions, pixels = pixels, full_size = (self.full_width, self.full_height),
+					num_threads = self.num_threads)
+
+		def changedSections(num):
+			ws, hs = self._getSections(num)
+			if box is None:
+				return [i for i, (wr, hr) in enumerate((wr, hr) for wr in ws for hr in hs) if changed[hr[0]:hr[1], wr[0]:wr[1]].any()]
+			return [i for i, (wr, hr) in enumerate((wr, hr) for wr in ws for hr in hs)
+						if wr[0] < box[2] and box[0] < wr[1] and hr[0] < box[3] and box[1] < hr[1]]
+
+		def sectionRange(num, i):
+			ws, hs = self._getSections(num)
+			return ws[i // num], hs[i % num]
+
+		if box is None:
+			changed = (pixels != self.pixels).any(axis = -1)
+		changed_sections = changedSections(3)
+
+		# Only the changed sections are converted. Every changed pixel is in one of them.
+		for pixel_f, arr in self.conversions.items():
+			arr = arr.copy()
+			for i in changed_sections:
+				wr, hr = sectionRange(3, i)
+				arr[hr[0]:hr[1], wr[0]:wr[1]] = arrayFunction(pixel_f)(pixels[hr[0]:hr[1], wr[0]:wr[1]])
+			rv.conversions[pixel_f] = arr
+
+		for (num, pixel_f), stats in self.section_statistics.items():
+			stats = dict((name, values.copy()) for name, values in stats.items())
+			for i in changedSections(num):
+				wr, hr = sectionRange(num, i)
+				for name, values in rv._regionStatistics(pixel_f, wr, hr, stats.keys()).items():
+					stats[name][i] = values
+			rv.section_statistics[(num, pixel_f)] = stats
+
+		for (num_bins, bin_type, pixel_type), hists in self.section_histograms.items():
+			hists = hists.copy()
+			for i in changed_sections:
+				hists[i] = rv._regionHistogram(num_bins, bin_type, pixel_type, *sectionRange(3, i))
+			rv.section_histograms[(num_bins, bin_type, pixel_type)] = hists
+
+		for num, sums in self.tile_wavelet_sums.items():
+			sums = sums.copy()
+			for i in changedSections(num):
+				sums[i] = rv._regionWaveletSum(*sectionRange(num, i))
+			rv.tile_wavelet_sums[num] = sums
+
+		return rv
 
 	# ---------------------
 	# |   Size Features   |
 	# ---------------------
 
 	def aspectRatio(self):
-		return [float(self.width) / float(self.height)]
+		return [float(self.full_width) / float(self.full_height)]
 
 	def sumOfSizes(self):
-		return [self.width + self.height]
+		return [self.full_width + self.full_height]
 
 	def size(self):
-		return [self.width, self.height]
+		return [self.full_width, self.full_height]
 
 	# ----------------------
 	# |    RGB Features    |
@@ -130,17 +819,17 @@ class Image:
 
 	# Averages the V of the HSV represenation of each pixel over the entire image
 	def averageBrightness(self):
-		return [sum(RGBtoHSV(self.pix[x, y])[2] for x in range(self.width) for y in range(self.height)) / float(self.width * self.height)]
+		return [self._channel(RGBtoHSV, 2).sum(dtype = np.float64).item() / float(self.width * self.height)]
 
 	# Divides each dimension into 3 equal sections, and then averages the Hue of only the middle section
 	def averageHueOfMiddle(self):
 		ws, hs = self._getSections(3)
-		return [sum(RGBtoHSV(self.pix[x, y])[0] for x in xrange(*ws[1]) for y in xrange(*hs[1])) / float(ws[1][1] - ws[1][0]) / float(hs[1][1] - hs[1][0])]
+		return [self._channel(RGBtoHSV, 0)[hs[1][0]:hs[1][1], ws[1][0]:ws[1][1]].sum(dtype = np.float64).item() / float(ws[1][1] - ws[1][0]) / float(hs[1][1] - hs[1][0])]
 
 	# Divides each dimension into 3 equal sections, and then averages the Saturation of only the middle section
 	def averageSaturationOfMiddle(self):
 		ws, hs = self._getSections(3)
-		return [sum(RGBtoHSV(self.pix[x, y])[1] for x in xrange(*ws[1]) for y in xrange(*hs[1])) / float(ws[1][1] - ws[1][0]) / float(hs[1][1] - hs[1][0])]
+		return [self._channel(RGBtoHSV, 1)[hs[1][0]:hs[1][1], ws[1][0]:ws[1][1]].sum(dtype = np.float64).item() / float(ws[1][1] - ws[1][0]) / float(hs[1][1] - hs[1][0])]
 
 	# Averages the desired channel of the HSV representation of each pixel for each of the nine sections.
 	def averageHueOfEachSection(self):
@@ -219,25 +908,40 @@ class Image:
 	# 	dif_type - Method to compute the difference between section's histograms
 	# 		'sum_of_abs' - Sums up the abosulte difference between each element of the histogram
 	# 		'euclidean' - Computes the euclidean distance between two histograms
-	# 		'earth_mover' - Computes the earth mover distance between two histograms
+	# 		'earth_mover' - Computes the earth mover distance between two histograms. '3d' histograms use the sum of the
+	# 		                earth mover distances between the histograms of each channel.
 	# 	norm_type - Method to normalize the histograms
 	# 		'sum_to_one' - Divides each element of the histogram by the number of pixels in the section
 	# 		'euclidean' - Makes the magnitude of each histogram one
 	# 		'none' - No normalization is done
-	# 	pixel_type - Format of each pixel: ['rgb']
-	# TODO allow for different binning methods, different difference methods, and normalization methods.
-	# TODO allow for pixel_type to be either 'rgb' or 'hsv'
+	# 	pixel_type - Format of each pixel
+	# 		'rgb' - Bins the RGB channels, which range from 0 to 255
+	# 		'hsv' - Bins the HSV channels, with hue scaled from [0, 360] and saturation and value from [0, 1]
+	# TODO allow for different binning methods
 
 	binComparison_bin_types = ['avg', '3d']
-	binComparison_norm_types = ['sum_to_one', 'none']
-	binComparison_dif_types = ['sum_of_abs']
-	binComparison_pixel_types = 'rgb'
+	binComparison_norm_types = ['sum_to_one', 'euclidean', 'none']
+	binComparison_dif_types = ['sum_of_abs', 'euclidean', 'earth_mover']
+	binComparison_pixel_types = ['rgb', 'hsv']
 
 	def binComparison(self, num_bins,
 							bin_type = 'avg',
 							norm_type = 'sum_to_one',
 							dif_type = 'sum_of_abs',
 							pixel_type = 'rgb'):
+		Image._checkBinComparison(bin_type, norm_type, dif_type, pixel_type)
+
+		bins = normalizeHistograms(self._sectionHistograms(num_bins, bin_type, pixel_type), norm_type)
+
+		# Compute differences of bins, comparing each section to all of the sections after it at once
+		rv = []
+		for i in range(9):
+			rv.extend(histogramDistance(bins[i], bins[i + 1:], dif_type, num_bins, bin_type).tolist())
+		return rv
+
+	# Raises an exception if any of the arguments of binComparison() is invalid
+	@staticmethod
+	def _checkBinComparison(bin_type, norm_type, dif_type, pixel_type):
 		if bin_type not in Image.binComparison_bin_types:
 			raise Exception('Invalid bin_type in binComparison: got ' + str(bin_type) + ', but must be in ' + str(Image.binComparison_bin_types))
 		if norm_type not in Image.binComparison_norm_types:
@@ -247,52 +951,6 @@ class Image:
 		if pixel_type not in Image.binComparison_pixel_types:
 			raise Exception('Invalid pixel_type in binComparison: got ' + str(pixel_type) + ', but must be in ' + str(Image.binComparison_pixel_types))
 
-		# Creates bins
-		bins = []
-		
-		ws, hs = self._getSections(3)
-		for wr in ws:
-			for hr in hs:
-				if bin_type == 'avg':
-					this_bin = [0] * num_bins
-				if bin_type == '3d':
-					this_bin = [0] * pow(num_bins, 3)
-
-				for x in xrange(wr[0], wr[1]):
-					for y in xrange(hr[0], hr[1]):
-						v = self.pix[x, y]
-
-						if bin_type == 'avg':
-							avg_v = float(sum(v)) / float(len(v))
-							b = int(math.floor(avg_v * num_bins / 256.0))
-						if bin_type == '3d':
-							r = int(math.floor(v[0] * num_bins / 256.0))
-							g = int(math.floor(v[1] * num_bins / 256.0))
-							b = int(math.floor(v[2] * num_bins / 256.0))
-
-							b = r + g * num_bins + b * num_bins * num_bins
-
-						this_bin[b] += 1
-				bins.append(this_bin)
-
-		if norm_type == 'sum_to_one':
-			# Normalize bins so the sum of them is 1.0
-			for i in range(9):
-				sum_bin = float(sum(bins[i]))
-				bins[i] = [v / sum_bin for v in bins[i]]
-		elif norm_type == 'none':
-			pass
-
-		# Compute differences of bins
-		rv = []
-		for i in range(9):
-			for j in range(9):
-				if j <= i:
-					continue
-				if dif_type == 'sum_of_abs':
-					rv.append(sum(abs(a - b) for a, b in zip(bins[i], bins[j])))
-		return rv
-
 	# ---------------------
 	# |  Wavelet Features |
 	# ---------------------
@@ -330,23 +988,237 @@ class Image:
 	def valueDepthOfField(self):
 		return self._depthOfField(2)
 
+	# ---------------------
+	# |  Region Features  |
+	# ---------------------
+
+	# These use an integral image of the color space, which is built the first time the color space is used. After that,
+	# the sum over any rectangular region takes constant time, no matter the size of the region.
+
+	# Input:
+	#   wr - Range of pixels in the x dimension (inclusive lower-bound exclusive upper bound).
+	#   hr - Range of pixels in the y dimension (inclusive lower-bound exclusive upper bound).
+	#   space - color space to use: 'rgb', 'hsv', or 'pad'
+	# Output: A list of length 3 of the sum of each channel over the region.
+	def sumOfRegion(self, wr, hr, space):
+		if space not in pixel_spaces:
+			raise Exception('Invalid space in sumOfRegion: got ' + str(space) + ', but must be in ' + str(sorted(pixel_spaces.keys())))
+
+		s = self._integralImage(pixel_spaces[space])
+		return (s[hr[1], wr[1]] - s[hr[0], wr[1]] - s[hr[1], wr[0]] + s[hr[0], wr[0]]).tolist()
+
+	# Same as sumOfRegion(), but outputs the average of each channel over the region.
+	def averageOfRegion(self, wr, hr, space):
+		count = float((wr[1] - wr[0]) * (hr[1] - hr[0]))
+		if count <= 0:
+			raise Exception('Invalid region in averageOfRegion: got ' + str(wr) + ', ' + str(hr) + ', which contains no pixels')
+		return [v / count for v in self.sumOfRegion(wr, hr, space)]
+
+	# Divides each dimension into n equal sections, then averages the desired channel of each of the n * n sections.
+	# averageChannelOfGrid(3, 'rgb', 0) gives the same result as averageRedOfEachSection().
+	# Input:
+	#   n - number of times to divide each dimension
+	#   space - color space to use: 'rgb', 'hsv', or 'pad'
+	#   chan - index of the channel in the color space
+	# Output: A list of length n * n, ordered the same as the other section features.
+	def averageChannelOfGrid(self, n, space, chan):
+		if space not in pixel_spaces:
+			raise Exception('Invalid space in averageChannelOfGrid: got ' + str(space) + ', but must be in ' + str(sorted(pixel_spaces.keys())))
+		if n < 1 or n > self.width or n > self.height:
+			raise Exception('Invalid n in averageChannelOfGrid: got ' + str(n) + ', but must be between 1 and ' + str(min(self.width, self.height)))
+
+		s = self._integralImage(pixel_spaces[space])[..., chan]
+		ws, hs = self._getSections(n)
+
+		# Bounds of every section, ordered by x then y
+		x0, x1 = [np.repeat([wr[i] for wr in ws], n) for i in range(2)]
+		y0, y1 = [np.tile([hr[i] for hr in hs], n) for i in range(2)]
+
+		sums = s[y1, x1] - s[y0, x1] - s[y1, x0] + s[y0, x0]
+		return (sums / ((x1 - x0) * (y1 - y0)).astype(np.float64)).tolist()
+
+	# Statistics that can be computed by gridStatistics(), besides percentiles, which are given as 'p' followed by the
+	# percentile, ex. 'p50' for the median
+	grid_statistics = ['mean', 'min', 'max', 'std', 'sum']
+
+	# Divides each dimension into n sections, then computes every requested statistic of every channel of each of the
+	# n * n sections at once, see _sectionStatistics().
+	# Input:
+	#   n - number of times to divide each dimension
+	#   space - color space to use: 'rgb', 'hsv', or 'pad'
+	#   statistics - list of statistics, see grid_statistics
+	# Output: (n * n, 3) structured array with a float64 field for each statistic, where row i holds the ith section
+	#         (ordered the same as the other section features) and column j holds channel j.
+	#         Ex. gridStatistics(3, 'rgb', ['mean'])['mean'][:, 0] is the same as averageRedOfEachSection().
+	def gridStatistics(self, n, space, statistics = ('mean', 'min', 'max')):
+		if space not in pixel_spaces:
+			raise Exception('Invalid space in gridStatistics: got ' + str(space) + ', but must be in ' + str(sorted(pixel_spaces.keys())))
+		if n < 1 or n > self.width or n > self.height:
+			raise Exception('Invalid n in gridStatistics: got ' + str(n) + ', but must be between 1 and ' + str(min(self.width, self.height)))
+		for statistic in statistics:
+			if statistic not in Image.grid_statistics and (re.match(r'^p[0-9]+(\.[0-9]+)?$', statistic) is None or float(statistic[1:]) > 100):
+				raise Exception('Invalid statistic in gridStatistics: got ' + str(statistic) + ', but must be in ' + str(Image.grid_statistics) + ' or a percentile such as \'p50\'')
+
+		names = set()
+		for statistic in statistics:
+			names.update({'mean': ['sum'], 'std': ['sum', 'sum_of_squares']}.get(statistic, [statistic]))
+		stats = self._sectionStatistics(pixel_spaces[space], n, sorted(names))
+
+		ws, hs = self._getSections(n)
+		# Empty sections have all statistics 0
+		counts = np.array([float(max((wr[1] - wr[0]) * (hr[1] - hr[0]), 1)) for wr in ws for hr in hs])[:, np.newaxis]
+
+		rv = np.zeros((n * n, 3), dtype = [(statistic, np.float64) for statistic in statistics])
+		for statistic in statistics:
+			if statistic == 'mean':
+				rv[statistic] = stats['sum'] / counts
+			elif statistic == 'std':
+				mean = stats['sum'] / counts
+				rv[statistic] = np.sqrt(np.maximum(stats['sum_of_squares'] / counts - mean * mean, 0.0))
+			else:
+				rv[statistic] = stats[statistic]
+		return rv
+
+	# Feature version of gridStatistics()
+	# Input:
+	#   n, space - see gridStatistics()
+	#   chan - index of the channel in the color space
+	#   statistic - one of the statistics of gridStatistics()
+	# Output: A list of length n * n of the statistic of the channel in each section
+	def statisticOfGrid(self, n, space, chan, statistic):
+		return self.gridStatistics(n, space, [statistic])[statistic][:, chan].tolist()
+
+	# ------------------------
+	# | Approximate Features |
+	# ------------------------
+
+	# Draws a random sample of the pixels of each of the nine sections, to estimate the section averages and binComparison
+	# from a small part of the image, see SectionSample.
+	# Input:
+	#   rate - fraction of the pixels of each section to sample, at least 2 pixels per section
+	#   tolerance - If given, rate is only used for a first sample, which estimates how many pixels each section needs for the
+	#               confidence interval of the average of every channel of space to be at most tolerance either side of the
+	#               estimate. Since the standard deviations are themselves estimates, the intervals can end up slightly wider.
+	#               A section is never sampled more times than it has pixels.
+	#   space - color space that tolerance is given in: 'rgb', 'hsv', or 'pad'
+	#   confidence - confidence level that tolerance is given for
+	#   seed - seed of the sample. The same seed always gives the same sample of the same image.
+	# Output: image_features.SectionSample object
+	def sampleSections(self, rate = 0.01, tolerance = None, space = 'rgb', confidence = 0.95, seed = 0):
+		if not 0.0 < rate <= 1.0:
+			raise Exception('Invalid rate in sampleSections: got ' + str(rate) + ', but must be in (0, 1]')
+		if space not in pixel_spaces:
+			raise Exception('Invalid space in sampleSections: got ' + str(space) + ', but must be in ' + str(sorted(pixel_spaces.keys())))
+
+		ws, hs = self._getSections(3)
+		section_sizes = np.array([(wr[1] - wr[0]) * (hr[1] - hr[0]) for wr in ws for hr in hs])
+		sample = SectionSample(self, np.maximum(np.ceil(rate * section_sizes).astype(np.int64), 2), seed)
+		if tolerance is None:
+			return sample
+
+		if tolerance <= 0.0:
+			raise Exception('Invalid tolerance in sampleSections: got ' + str(tolerance) + ', but must be positive')
+		_, errors = sample._meanAndError(pixel_spaces[space])
+		deviations = errors.max(axis = 1) * np.sqrt(sample.sizes)
+		needed = np.ceil(np.square(normalQuantile(0.5 + confidence / 2.0) * deviations / tolerance)).astype(np.int64)
+		return SectionSample(self, np.minimum(np.maximum(needed, sample.sizes), section_sizes), seed)
+
 	# ---------------------
 	# |  Helper Fuctions  |
 	# ---------------------
 
+	# Decodes the pixel data of the image, downscaling it to self.width by self.height if needed.
+	# Output: (H, W, 3) uint8 array of the RGB pixels
+	@_stage('decode')
+	def _decode(self):
+		image = self.image
+		if image.size != (self.width, self.height):
+			# Lets JPEGs be decoded at 1/2, 1/4 or 1/8 scale, which is no smaller than the requested size
+			image.draft('RGB', (self.width, self.height))
+		image = image.convert('RGB')
+		if image.size != (self.width, self.height):
+			image = image.resize((self.width, self.height), PIL_Image.BILINEAR)
+
+		self.image = image
+		return np.asarray(image, dtype = np.uint8)
+
+	# Input:
+	#         pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	#         chan - the index of the 3-tuple outputted by pixel_f to select.
+	# Output: (H, W) array of the selected channel of pixel_f applied to every pixel of the image.
+	def _channel(self, pixel_f, chan):
+		return self._convert(pixel_f)[..., chan]
+
+	# Input: pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	# Output: (H, W, 3) array of pixel_f applied to every pixel of the image. Cached if cache_conversions is set.
+	@_stage('conversion', cached = lambda self, pixel_f: pixel_f is RGBtoRGB or pixel_f in self.conversions)
+	def _convert(self, pixel_f):
+		if pixel_f is RGBtoRGB:
+			return self.pixels
+		if pixel_f in self.conversions:
+			return self.conversions[pixel_f]
+
+		if pixel_f is RGBtoPAD:
+			# Reuses the HSV conversion, which is also cached
+			arr = self._applyInStrips(HSVtoPADArray, self._convert(RGBtoHSV))
+		else:
+			arr = self._applyInStrips(arrayFunction(pixel_f), self.pixels)
+
+		if self.cache_conversions:
+			self.conversions[pixel_f] = arr
+		return arr
+
+	# Input:
+	#         f - function that takes an (H, W, 3) array of pixels and returns an array of the converted pixels
+	#         arr - (self.height, self.width, 3) array of pixels
+	# Output: f(arr). If num_threads is greater than 1, f is applied to strips of rows of arr in parallel.
+	def _applyInStrips(self, f, arr):
+		if self.num_threads <= 1:
+			return f(arr)
+
+		first = f(arr[:_strip_rows])
+		rv = np.empty(arr.shape[:2] + first.shape[2:], dtype = first.dtype)
+		rv[:_strip_rows] = first
+
+		def applyStrip(start):
+			rv[start:start + _strip_rows] = f(arr[start:start + _strip_rows])
+		_parallelMap(self.num_threads, applyStrip, range(_strip_rows, self.height, _strip_rows))
+		return rv
+
+	# Input:
+	#         hs - list of ranges of rows, ex. the second output of _getSections()
+	#         f - function that takes a range of rows and returns an array
+	#         ufunc - NumPy ufunc used to combine the outputs of f, ex. np.add
+	# Output: list with, for each range in hs, the outputs of f for the strips of the range (see sectionStrips()), combined
+	#         in order with ufunc, or zeros for an empty range. The strips are computed in parallel if num_threads is greater than 1.
+	def _reduceStrips(self, hs, f, ufunc):
+		strips = sectionStrips(hs)
+		values = _parallelMap(self.num_threads, lambda strip: f(strip[1]), strips)
+
+		rv = [None] * len(hs)
+		for (i, _), value in zip(strips, values):
+			rv[i] = (value if rv[i] is None else ufunc(rv[i], value))
+
+		# Empty ranges, which images shorter than the number of sections have, have no strips and are zero
+		empty = np.zeros_like(next(value for value in rv if value is not None))
+		return [(empty if value is None else value) for value in rv]
+
+	# Input:
+	#         pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	#         wr, hr - Ranges of pixels in the x and y dimensions.
+	# Output: (len(hr), len(wr), 3) array of pixel_f applied to the pixels in the region. If cache_conversions is set this is
+	#         a view of the cached conversion of the whole image, otherwise only the region is converted.
+	def _convertRegion(self, pixel_f, wr, hr):
+		if self.cache_conversions or pixel_f is RGBtoRGB or pixel_f in self.conversions:
+			return self._convert(pixel_f)[hr[0]:hr[1], wr[0]:wr[1]]
+		return arrayFunction(pixel_f)(self.pixels[hr[0]:hr[1], wr[0]:wr[1]])
+
 	# Input: num - number of times to divide each dimension. Ex. providing a value of 3 creates 9 sections.
 	# Output: two lists of 2-tuples. Each tuple is a range (inclusive lower-bound exclusive upper bound) of indices for a section.
 	#         The first list is for the X/width dimension and the second list is for the Y/height dimension.
+	@_stage('sections')
 	def _getSections(self, num):
-		# Compute the lower bounds of each section
-		w_sections = [int(math.ceil(float(self.width  / float(num) * v))) for v in range(num)]
-		h_sections = [int(math.ceil(float(self.height / float(num) * v))) for v in range(num)]
-
-		# Add the upper bound of each section
-		w_sections = [(w_sections[i], (self.width  if i + 1 == num else w_sections[i + 1])) for i in range(num)]
-		h_sections = [(h_sections[i], (self.height if i + 1 == num else h_sections[i + 1])) for i in range(num)]
-
-		return w_sections, h_sections
+		return sectionRanges(self.width, self.height, num)
 
 	# Input:
 	#         pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
@@ -354,22 +1226,106 @@ class Image:
 	# Output: A list of length 9, where each element is the average the desired pixel channel for a section of the image.
 	def _averageChannelOfEachSection(self, pixel_f, chan):
 		ws, hs = self._getSections(3)
-		return [sum(pixel_f(self.pix[x, y])[chan]
-						for x in xrange(wr[0], wr[1]) for y in xrange(hr[0], hr[1]))
-				/ float((wr[1] - wr[0]) * (hr[1] - hr[0]))
-					for wr in ws for hr in hs]
+		sections = [(wr, hr) for wr in ws for hr in hs]
+		sums = self._sectionStatistics(pixel_f, 3, ['sum'])['sum']
+		# Empty sections of images smaller than 3 pixels in a dimension average to 0
+		return [sums[i, chan].item() / float(max((wr[1] - wr[0]) * (hr[1] - hr[0]), 1))
+					for i, (wr, hr) in enumerate(sections)]
 
 	# Input:
-	#         total_f - function applied to the selected channel of all pixels in each section.
+	#         total_f - function applied to the selected channel of all pixels in each section. The builtins max and min are
+	#                   reduced with np.max and np.min, any other function is given the flattened section.
 	#         pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
 	#         chan - the index of the 3-tuple outputted by pixel_f to be averaged.
 	# Output: A list of length 9, where each element is the average the desired pixel channel for a section of the image.
 	def _functionChannelOfEachSection(self, total_f, pixel_f, chan):
+		if total_f is max or total_f is min:
+			return self._sectionStatistics(pixel_f)[total_f.__name__][:, chan].tolist()
+
 		ws, hs = self._getSections(3)
-		return [total_f(pixel_f(self.pix[x, y])[chan]
-						for x in xrange(wr[0], wr[1]) for y in xrange(hr[0], hr[1]))
+		plane = self._channel(pixel_f, chan)
+		return [total_f(plane[hr[0]:hr[1], wr[0]:wr[1]].T.ravel().tolist())
 					for wr in ws for hr in hs]
 
+	# Input:
+	#         pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	#         num - number of times to divide each dimension
+	#         names - statistics to compute: 'sum', 'sum_of_squares', 'min', 'max', or a percentile such as 'p50'
+	# Output: A dict with (at least) the requested statistics. Each value is a (num * num, 3) array where row i holds the
+	#         statistic of all three channels of pixel_f over the ith section.
+	#         Each of 'sum', 'sum_of_squares', 'min' and 'max' is computed for every section and channel with one reduction
+	#         over each strip of rows (see _reduceStrips()), and all requested percentiles of a section are found with one
+	#         sort. The results are cached.
+	@_stage('section_statistics', cached = lambda self, pixel_f, num = 3, names = ('sum', 'min', 'max'):
+				all(name in self.section_statistics.get((num, pixel_f), {}) for name in names))
+	def _sectionStatistics(self, pixel_f, num = 3, names = ('sum', 'min', 'max')):
+		stats = self.section_statistics.setdefault((num, pixel_f), {})
+		missing = [name for name in names if name not in stats]
+		if len(missing) == 0:
+			return stats
+
+		arr = self._convert(pixel_f)
+		ws, hs = self._getSections(num)
+		x_starts = [wr[0] for wr in ws]
+		exact_type = (np.int64 if arr.dtype == np.uint8 else np.float64)
+
+		# Reduces the rows, then the columns of each section, giving a (num, num, 3) array indexed by [y section, x section],
+		# which is reordered by x then y like the other section features
+		def reduceSections(ufunc, dtype = None, square = False):
+			reduceStrip = lambda rows: reduceStripSections(arr[rows[0]:rows[1]], x_starts, ufunc, dtype, square)
+			return np.array(self._reduceStrips(hs, reduceStrip, ufunc)).transpose(1, 0, 2).reshape(num * num, 3)
+
+		percentiles = []
+		for name in missing:
+			if name == 'sum':
+				stats[name] = reduceSections(np.add, exact_type)
+			elif name == 'sum_of_squares':
+				stats[name] = reduceSections(np.add, exact_type, square = True)
+			elif name == 'min':
+				stats[name] = reduceSections(np.minimum)
+			elif name == 'max':
+				stats[name] = reduceSections(np.maximum)
+			else:
+				percentiles.append(name)
+
+		if len(percentiles) > 0:
+			qs = [float(name[1:]) for name in percentiles]
+			def sectionPercentiles(section):
+				values = arr[section[1][0]:section[1][1], section[0][0]:section[0][1]].reshape(-1, 3)
+				return (np.percentile(values, qs, axis = 0) if len(values) > 0 else np.zeros((len(qs), 3)))
+			values = np.array(_parallelMap(self.num_threads, sectionPercentiles, [(wr, hr) for wr in ws for hr in hs]))
+			for i, name in enumerate(percentiles):
+				stats[name] = values[:, i]
+		return stats
+
+	# Input:
+	#         pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	#         wr, hr - Ranges of pixels in the x and y dimensions.
+	#         names - statistics to compute, see _sectionStatistics()
+	# Output: dict mapping each name to an array of length 3 of the statistic of each channel of pixel_f over the region
+	def _regionStatistics(self, pixel_f, wr, hr, names = ('sum', 'min', 'max')):
+		arr = self._convertRegion(pixel_f, wr, hr)
+		exact_type = (np.int64 if arr.dtype == np.uint8 else np.float64)
+
+		rv = {}
+		if arr.size == 0:
+			# Empty sections have all statistics 0, the same as _sectionStatistics()
+			for name in names:
+				rv[name] = np.zeros(3, dtype = (exact_type if name in ('sum', 'sum_of_squares') else arr.dtype if name in ('min', 'max') else np.float64))
+			return rv
+		for name in names:
+			if name == 'sum':
+				rv[name] = arr.sum(axis = (0, 1), dtype = exact_type)
+			elif name == 'sum_of_squares':
+				rv[name] = np.square(arr, dtype = exact_type).sum(axis = (0, 1))
+			elif name == 'min':
+				rv[name] = arr.min(axis = (0, 1))
+			elif name == 'max':
+				rv[name] = arr.max(axis = (0, 1))
+			else:
+				rv[name] = np.percentile(arr.reshape(-1, 3), float(name[1:]), axis = 0)
+		return rv
+
 	# Input:
 	#         wr - Range of pixels in the x dimension to use.
 	#         hr - Range of pixels in the y dimension to use.
@@ -377,11 +1333,74 @@ class Image:
 	#         chan - the index of the 3-tuple outputted by pixel_f to be averaged.
 	# Output: returns three 3-tuple of the three wavelet coefficients (as numpy arrays) for the layers in ascending order.
 	def _waveletTransform(self, wr, hr, pixel_f, chan):
-		arr = np.array([[pixel_f(self.pix[x, y])[chan] for y in xrange(hr[0], hr[1])] for x in xrange(wr[0], wr[1])])
-		coeffs = pywt.wavedec2(arr, 'db1', level = 3)
+		# Transposed so the array is indexed [x][y]
+		arr = self._channel(pixel_f, chan)[hr[0]:hr[1], wr[0]:wr[1]].T
+		coeffs = waveletDecomposition(arr)
 		LL, (LH1, HL1, HH1), (LH2, HL2, HH2), (LH3, HL3, HH3) = coeffs
 		return (LH1, HL1, HH1), (LH2, HL2, HH2), (LH3, HL3, HH3)
 
+	# Input:
+	#         pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	# Output: (H + 1, W + 1, 3) array where element [y, x] is the sum of each channel of pixel_f over all pixels above and to
+	#         the left of pixel (x, y). RGB sums are kept as integers so they are exact.
+	@_stage('integral_image', cached = lambda self, pixel_f: pixel_f in self.integral_images)
+	def _integralImage(self, pixel_f):
+		if pixel_f in self.integral_images:
+			return self.integral_images[pixel_f]
+
+		arr = self._convert(pixel_f)
+		s = np.zeros((self.height + 1, self.width + 1, 3), dtype = (np.int64 if arr.dtype == np.uint8 else np.float64))
+		np.cumsum(arr, axis = 0, out = s[1:, 1:])
+		np.cumsum(s[1:, 1:], axis = 1, out = s[1:, 1:])
+
+		if self.cache_conversions:
+			self.integral_images[pixel_f] = s
+		return s
+
+	# Input:
+	#         num_bins, bin_type, pixel_type - see binComparison()
+	# Output: (9, num_bins) or (9, num_bins^3) array of the number of pixels in each bin for each of the nine sections.
+	#         The histograms of each strip of rows are counted together (see countStripSections()). The result is cached.
+	@_stage('histogram', cached = lambda self, num_bins, bin_type, pixel_type: (num_bins, bin_type, pixel_type) in self.section_histograms)
+	def _sectionHistograms(self, num_bins, bin_type, pixel_type):
+		key = (num_bins, bin_type, pixel_type)
+		if key not in self.section_histograms:
+			arr = self._convert(RGBtoRGB if pixel_type == 'rgb' else RGBtoHSV)
+
+			ws, hs = self._getSections(3)
+			x_section = np.repeat(np.arange(3), [wr[1] - wr[0] for wr in ws])
+			countStrip = lambda rows: countStripSections(arr[rows[0]:rows[1]], x_section, 3, num_bins, bin_type, pixel_type)
+
+			# Indexed by [y section, x section], and reordered by x then y like the other section features
+			counts = np.array(self._reduceStrips(hs, countStrip, np.add))
+			self.section_histograms[key] = counts.transpose(1, 0, 2).reshape(9, counts.shape[2])
+		return self.section_histograms[key]
+
+	# Input:
+	#         num_bins, bin_type, pixel_type - see binComparison()
+	#         wr, hr - Ranges of pixels in the x and y dimensions.
+	# Output: array of the number of pixels of the region in each bin
+	def _regionHistogram(self, num_bins, bin_type, pixel_type, wr, hr):
+		total_bins = (num_bins if bin_type == 'avg' else pow(num_bins, 3))
+		arr = self._convertRegion(RGBtoRGB if pixel_type == 'rgb' else RGBtoHSV, wr, hr)
+		return np.bincount(binIndices(arr, num_bins, bin_type, pixel_type).ravel(), minlength = total_bins)
+
+	# Input:
+	#         wr - Range of pixels in the x dimension to use.
+	#         hr - Range of pixels in the y dimension to use.
+	#         pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	#         chan - the index of the 3-tuple outputted by pixel_f to be transformed.
+	# Output: list of three 2-tuples, one for each layer in ascending order. Each tuple is the sum of the layer's three wavelet
+	#         coefficients and the sum of their absolute values.
+	#         The transform is only done the first time a region and channel is requested. Only the sums are cached.
+	@_stage('wavelet_sums', cached = lambda self, wr, hr, pixel_f, chan: (tuple(wr), tuple(hr), pixel_f, chan) in self.wavelet_sums)
+	def _waveletSums(self, wr, hr, pixel_f, chan):
+		key = (tuple(wr), tuple(hr), pixel_f, chan)
+		if key not in self.wavelet_sums:
+			self.wavelet_sums[key] = [(sum(c.sum(dtype = np.float64).item() for c in coeffs), sum(np.abs(c).sum(dtype = np.float64).item() for c in coeffs))
+										for coeffs in self._waveletTransform(wr, hr, pixel_f, chan)]
+		return self.wavelet_sums[key]
+
 	# Input:
 	#         chan - The index of the HSV channel to use
 	#         layer - The wavelet transform layer to use, must be 1, 2, or 3
@@ -391,45 +1410,54 @@ class Image:
 		if layer not in [1, 2, 3]:
 			raise Exception('Invalid layer value')
 
-		coeffs = self._waveletTransform((0, self.width), (0, self.height), RGBtoHSV, chan)
-
-		LH, HL, HH = coeffs[layer - 1]
-
-		total = sum(v for row in LH for v in row) + \
-				sum(v for row in HL for v in row) + \
-				sum(v for row in HH for v in row)
-
-		norm = sum(abs(v) for row in LH for v in row) + \
-				sum(abs(v) for row in HL for v in row) + \
-				sum(abs(v) for row in HH for v in row)
+		total, norm = self._waveletSums((0, self.width), (0, self.height), RGBtoHSV, chan)[layer - 1]
 		if norm == 0.0:
 			return [0.0]
 		else:
 			return [total / norm]
 
+	# Input:
+	#         num - number of times to divide each dimension.
+	# Output:
+	#         (num * num, 3) array, where row i holds the sum of the third level wavelet coefficients of the ith section for each HSV channel.
+	#         Each section is a view of the cached HSV array, and all three channels of a section are transformed by a single
+	#         wavedec2 call. The sections are transformed in parallel if num_threads is greater than 1. The result is cached.
+	@_stage('tile_wavelet_sums', cached = lambda self, num: num in self.tile_wavelet_sums)
+	def _tileWaveletSums(self, num):
+		if num not in self.tile_wavelet_sums:
+			# Converted once before the threads use it
+			if self.cache_conversions:
+				self._convert(RGBtoHSV)
+
+			ws, hs = self._getSections(num)
+			self.tile_wavelet_sums[num] = np.array(_parallelMap(self.num_threads, lambda section: self._regionWaveletSum(*section),
+																[(wr, hr) for wr in ws for hr in hs]))
+		return self.tile_wavelet_sums[num]
+
+	# Input:
+	#         wr, hr - Ranges of pixels in the x and y dimensions.
+	# Output: array of length 3 of the sum of the third level wavelet coefficients of the region for each HSV channel
+	def _regionWaveletSum(self, wr, hr):
+		# Images smaller than the grid have empty tiles, which PyWavelets never returns from
+		if wr[0] == wr[1] or hr[0] == hr[1]:
+			return np.zeros(3)
+		coeffs = waveletDecomposition(self._convertRegion(RGBtoHSV, wr, hr), axes = (0, 1))
+		return sum(c.sum(axis = (0, 1), dtype = np.float64) for c in coeffs[3])
+
 	# Input:
 	#         chan - The index of the HSV channel to use
 	# Output:
 	#         The sum of the third level wavelet coefficients of the middle 4 sections (when breaking the image into 16 sections) divided by the sum of coefficients over the whole image.
 	def _depthOfField(self, chan):
-		ws, hs = self._getSections(4)
-
-		wt_level3 = [self._waveletTransform(wr, hr, RGBtoHSV, chan)[2] for wr in ws for hr in hs]
-		middle_sum = 0.0
-		all_sum = 0.0
-		for i in range(len(wt_level3)):
-			LH, HL, HH = wt_level3[i]
-			this_sum = sum(v for row in LH for v in row) + \
-						sum(v for row in HL for v in row) + \
-						sum(v for row in HH for v in row)
-
-			if i in (6, 7, 10, 11):
-				middle_sum += this_sum
-			all_sum += this_sum
+		tile_sums = self._tileWaveletSums(4)[:, chan]
+
+		# Sections are ordered by x then y, so these are the sections with x and y in the middle two ranges
+		middle_sum = tile_sums[[5, 6, 9, 10]].sum().item()
+		all_sum = tile_sums.sum().item()
 		if all_sum == 0.0:
 			return [0.0]
 		else:
-			return [this_sum / all_sum]
+			return [middle_sum / all_sum]
 
 	# ----------------------
 	# | Debugging Fuctions |
@@ -438,15 +1466,511 @@ class Image:
 	# Displays the Image
 	def show(self):
 		# TODO figure out why not working
+		if self.image is None:
+			self.image = PIL_Image.fromarray(np.ascontiguousarray(self.pixels), 'RGB')
 		self.image.show()
 
 	# Prints all Pixel data
 	def printAll(self):
 		for x in range(self.width):
 			for y in range(self.height):
-				print x, y, '->', self.pix[x, y]
+				print x, y, '->', tuple(self.pixels[y, x].tolist())
 		print self.width, self.height
 
+# Input: the arguments of Image.binComparison()
+# Output: the (num_bins, bin_type, pixel_type) that the histograms of Image.binComparison() given the same arguments are
+#         cached under. Raises an exception if any argument is invalid.
+def _binComparisonKey(num_bins, bin_type = 'avg', norm_type = 'sum_to_one', dif_type = 'sum_of_abs', pixel_type = 'rgb'):
+	Image._checkBinComparison(bin_type, norm_type, dif_type, pixel_type)
+	return num_bins, bin_type, pixel_type
+
+# Input: p - probability, in (0, 1)
+# Output: the value that a standard normal random variable is below with probability p
+def normalQuantile(p):
+	if not 0.0 < p < 1.0:
+		raise Exception('Invalid p in normalQuantile: got ' + str(p) + ', but must be in (0, 1)')
+	low, high = -40.0, 40.0
+	for _ in range(100):
+		middle = (low + high) / 2.0
+		if 0.5 * (1.0 + math.erf(middle / math.sqrt(2.0))) < p:
+			low = middle
+		else:
+			high = middle
+	return (low + high) / 2.0
+
+# A stratified random sample of the pixels of an image. Each of the nine sections is sampled separately, with replacement,
+# and only the sampled pixels are converted, so estimates take time proportional to the sample size rather than the image.
+# Created by Image.sampleSections().
+class SectionSample:
+	# Input:
+	#   image - image_features.Image object
+	#   sizes - number of pixels to sample from each section, ordered like the other section features. At least 2 each.
+	#   seed - seed of the random number generator that picks the pixels
+	def __init__(self, image, sizes, seed = 0):
+		self.image = image
+		self.sizes = np.asarray(sizes, dtype = np.int64)
+		self.seed = seed
+		if self.sizes.shape != (9,) or (self.sizes < 2).any():
+			raise Exception('Invalid sizes in SectionSample: got ' + str(sizes) + ', but must be 9 sizes of at least 2')
+
+		ws, hs = image._getSections(3)
+		sections = [(wr, hr) for wr in ws for hr in hs]
+		self.section_sizes = np.array([(wr[1] - wr[0]) * (hr[1] - hr[0]) for wr, hr in sections])
+
+		# Coordinates of the sampled pixels, grouped by section
+		rng = np.random.RandomState(seed)
+		self.xs = np.concatenate([rng.randint(wr[0], wr[1], n) for (wr, _), n in zip(sections, self.sizes)])
+		self.ys = np.concatenate([rng.randint(hr[0], hr[1], n) for (_, hr), n in zip(sections, self.sizes)])
+		self.starts = np.concatenate([[0], np.cumsum(self.sizes)[:-1]])
+		self.section = np.repeat(np.arange(9), self.sizes)
+
+		# Maps pixel functions to the (n, 3) array of the sampled pixels converted by them
+		self.conversions = {RGBtoRGB: image.pixels[self.ys, self.xs]}
+
+	# Input: pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	# Output: (n, 3) array of the sampled pixels converted by pixel_f, taken from the image's cached conversion if it has one
+	def _convert(self, pixel_f):
+		if pixel_f not in self.conversions:
+			if pixel_f in self.image.conversions:
+				self.conversions[pixel_f] = self.image.conversions[pixel_f][self.ys, self.xs]
+			elif pixel_f is RGBtoPAD:
+				self.conversions[pixel_f] = HSVtoPADArray(self._convert(RGBtoHSV))
+			else:
+				self.conversions[pixel_f] = arrayFunction(pixel_f)(self.conversions[RGBtoRGB][np.newaxis])[0]
+		return self.conversions[pixel_f]
+
+	# Input: pixel_f - function that takes a single 3-tuple RGB pixel and outputs a 3-tuple.
+	# Output: two (9, 3) arrays of the sample mean and its standard error for each section and channel
+	def _meanAndError(self, pixel_f):
+		values = self._convert(pixel_f).astype(np.float64)
+		n = self.sizes[:, np.newaxis].astype(np.float64)
+		mean = np.add.reduceat(values, self.starts, axis = 0) / n
+		variance = np.add.reduceat(np.square(values - mean[self.section]), self.starts, axis = 0) / (n - 1.0)
+		return mean, np.sqrt(variance / n)
+
+	# Input: num_bins, bin_type, pixel_type - see Image.binComparison()
+	# Output: (9, num_bins) or (9, num_bins^3) array of the sampled number of pixels in each bin for each section
+	def _sampleHistograms(self, num_bins, bin_type, pixel_type):
+		total_bins = (num_bins if bin_type == 'avg' else pow(num_bins, 3))
+		bin_index = binIndices(self._convert(RGBtoRGB if pixel_type == 'rgb' else RGBtoHSV), num_bins, bin_type, pixel_type)
+		return np.bincount(self.section * total_bins + bin_index, minlength = 9 * total_bins).reshape(9, total_bins)
+
+	# Estimates of Image.averageRedOfEachSection() and the other section averages
+	# Input:
+	#   space - color space to use: 'rgb', 'hsv', or 'pad'
+	#   confidence - confidence level of the intervals
+	# Output: (9, 3) structured array with float64 fields 'estimate', 'low' and 'high', where row i holds the ith section and
+	#         column j holds channel j. The intervals use the normal approximation of the sample mean.
+	def averageOfEachSection(self, space, confidence = 0.95):
+		if space not in pixel_spaces:
+			raise Exception('Invalid space in averageOfEachSection: got ' + str(space) + ', but must be in ' + str(sorted(pixel_spaces.keys())))
+		mean, error = self._meanAndError(pixel_spaces[space])
+		half_width = normalQuantile(0.5 + confidence / 2.0) * error
+
+		rv = np.zeros((9, 3), dtype = [('estimate', np.float64), ('low', np.float64), ('high', np.float64)])
+		rv['estimate'], rv['low'], rv['high'] = mean, mean - half_width, mean + half_width
+		return rv
+
+	# Estimates of Image.binComparison()
+	# Input:
+	#   num_bins, bin_type, norm_type, dif_type, pixel_type - see Image.binComparison()
+	#   confidence - confidence level of the intervals
+	#   num_resamples - number of bootstrap resamples the intervals are found from
+	# Output: structured array of length 36 with float64 fields 'estimate', 'low' and 'high', ordered like binComparison().
+	#         The intervals are percentiles of the distances between bootstrap resamples of the sampled histograms, which
+	#         are drawn from a multinomial distribution instead of resampling pixels. The resamples have a seed derived
+	#         from the sample's, so the intervals are also reproducible.
+	def binComparison(self, num_bins, bin_type = 'avg', norm_type = 'sum_to_one', dif_type = 'sum_of_abs', pixel_type = 'rgb',
+							confidence = 0.95, num_resamples = 200):
+		Image._checkBinComparison(bin_type, norm_type, dif_type, pixel_type)
+
+		counts = self._sampleHistograms(num_bins, bin_type, pixel_type)
+		scale = (self.section_sizes / self.sizes.astype(np.float64))[:, np.newaxis]
+		rng = np.random.RandomState([self.seed, 1])
+		resamples = np.stack([rng.multinomial(n, section_counts / float(n), size = num_resamples) for n, section_counts in zip(self.sizes, counts)], axis = 1)
+
+		# Compares each section to all of the sections after it at once, as in Image.binComparison()
+		def distances(hists):
+			bins = normalizeHistograms(hists * scale, norm_type)
+			return np.concatenate([histogramDistance(bins[..., i:i + 1, :], bins[..., i + 1:, :], dif_type, num_bins, bin_type) for i in range(9)], axis = -1)
+
+		# Sampling noise makes histograms look more different than they are, so the distances are biased upward. The bias
+		# is estimated from how much further apart the resamples are than the sample, and subtracted from the estimate and
+		# the interval (the basic bootstrap interval). Distances are never negative.
+		estimate = distances(counts)
+		resampled = distances(resamples)
+		alpha = (1.0 - confidence) / 2.0
+		low, high = np.percentile(resampled, [100.0 * alpha, 100.0 * (1.0 - alpha)], axis = 0)
+
+		rv = np.zeros(36, dtype = [('estimate', np.float64), ('low', np.float64), ('high', np.float64)])
+		rv['estimate'] = np.maximum(2.0 * estimate - resampled.mean(axis = 0), 0.0)
+		rv['low'] = np.maximum(2.0 * estimate - high, 0.0)
+		rv['high'] = np.maximum(2.0 * estimate - low, 0.0)
+		return rv
+
+	# Input: name, args - feature name and arguments, the same as the Image method
+	# Output: estimate of the feature in the same format as the Image method, or None if it is not estimated from a sample.
+	#         The section averages and binComparison are estimated.
+	def estimateFeature(self, name, args = ()):
+		average = re.match('^average(.+)OfEachSection$', name)
+		if average is not None and average.group(1) in ImageBatch.channels:
+			pixel_f, chan = ImageBatch.channels[average.group(1)]
+			return self._meanAndError(pixel_f)[0][:, chan].tolist()
+		if name == 'binComparison':
+			return self.binComparison(*args)['estimate'].tolist()
+		return None
+
+# -------------------------
+# |  Feature Extraction   |
+# -------------------------
+
+# Every feature that needs no arguments, plus the wavelet features for each layer and a 10 bin comparison.
+default_features = ['aspectRatio', 'sumOfSizes', 'size',
+					'averageRedOfEachSection', 'averageGreenOfEachSection', 'averageBlueOfEachSection',
+					'maxRedOfEachSection', 'maxGreenOfEachSection', 'maxBlueOfEachSection',
+					'minRedOfEachSection', 'minGreenOfEachSection', 'minBlueOfEachSection',
+					'averageBrightness', 'averageHueOfMiddle', 'averageSaturationOfMiddle',
+					'averageHueOfEachSection', 'averageSaturationOfEachSection', 'averageValueOfEachSection',
+					'maxHueOfEachSection', 'maxSaturationOfEachSection', 'maxValueOfEachSection',
+					'minHueOfEachSection', 'minSaturationOfEachSection', 'minValueOfEachSection',
+					'averagePleasureOfEachSection', 'averageArousalOfEachSection', 'averageDominanceOfEachSection',
+					'maxPleasureOfEachSection', 'maxArousalOfEachSection', 'maxDominanceOfEachSection',
+					'minPleasureOfEachSection', 'minArousalOfEachSection', 'minDominanceOfEachSection',
+					('binComparison', (10,)),
+					('hueWaveletFeature', (1,)), ('hueWaveletFeature', (2,)), ('hueWaveletFeature', (3,)),
+					('saturationWaveletFeature', (1,)), ('saturationWaveletFeature', (2,)), ('saturationWaveletFeature', (3,)),
+					('valueWaveletFeature', (1,)), ('valueWaveletFeature', (2,)), ('valueWaveletFeature', (3,)),
+					'sumHueWaveletFeature', 'sumSaturationWaveletFeature', 'sumValueWaveletFeature',
+					'hueDepthOfField', 'saturationDepthOfField', 'valueDepthOfField']
+
+# Computes a fixed list of features of an image and concatenates them into a single feature vector.
+# The work shared between the features (color conversions, per section statistics and wavelet transforms) is done once per image
+# before any of the features are evaluated, so every feature only reads the shared results.
+class FeatureExtractor:
+	# Words in a feature name that mark which pixel functions the feature needs
+	channel_words = [(RGBtoRGB, ['Red', 'Green', 'Blue']),
+						(RGBtoHSV, ['Hue', 'Saturation', 'Value', 'Brightness', 'Wavelet', 'DepthOfField']),
+						(RGBtoPAD, ['Pleasure', 'Arousal', 'Dominance'])]
+
+	# Input:
+	#   features - list of features to compute. Each feature is either the name of an Image method,
+	#              or a 2-tuple of the name and a tuple of arguments to pass to the method.
+	#   sample_rate - If given, the section averages and binComparison are estimated from a sample of this fraction of the
+	#                 pixels of each section (see Image.sampleSections()). The other features are computed exactly.
+	#   seed - seed of the sample
+	def __init__(self, features = default_features, sample_rate = None, seed = 0):
+		self.features = []
+		for feature in features:
+			if isinstance(feature, basestring):
+				name, args = feature, ()
+			else:
+				name, args = feature[0], tuple(feature[1])
+
+			if name.startswith('_') or not callable(getattr(Image, name, None)):
+				raise Exception('Invalid feature in FeatureExtractor: ' + str(name) + ' is not a feature of Image')
+			self.features.append((name, args))
+
+		# Column names of the feature vector, in the order they are outputted by extract(), and the 3-tuple of the feature
+		# name, arguments and index in the feature's output of each column. For section features the index is the section.
+		self.columns = []
+		self.schema = []
+		for name, args in self.features:
+			label = name + ('(' + ', '.join(map(str, args)) + ')' if len(args) > 0 else '')
+			length = FeatureExtractor.featureLength(name, args)
+			if length == 1:
+				self.columns.append(label)
+			else:
+				self.columns.extend(label + '[' + str(i) + ']' for i in range(length))
+			self.schema.extend((name, args, i) for i in range(length))
+
+		# Plans the shared work
+		self.pixel_functions = []
+		self.section_pixel_functions = []
+		for pixel_f, words in FeatureExtractor.channel_words:
+			needed = [name for name, _ in self.features if any(word in name for word in words)]
+			if len(needed) > 0:
+				self.pixel_functions.append(pixel_f)
+			if any(name.endswith('OfEachSection') for name in needed):
+				self.section_pixel_functions.append(pixel_f)
+
+		# Region features build an integral image of the color space given as an argument
+		self.integral_pixel_functions = []
+		for name, args in self.features:
+			if name in ('sumOfRegion', 'averageOfRegion', 'averageChannelOfGrid'):
+				pixel_f = pixel_spaces[args[2] if name != 'averageChannelOfGrid' else args[1]]
+				if pixel_f not in self.integral_pixel_functions:
+					self.integral_pixel_functions.append(pixel_f)
+
+		# Section averages and binComparison are estimated from a sample if sample_rate is given. The arguments of
+		# binComparison are checked now, since the sample's binComparison() only checks them once an image is sampled.
+		self.sample_rate = sample_rate
+		self.seed = seed
+		for name, args in self.features:
+			if name == 'binComparison':
+				_binComparisonKey(*args)
+
+		# HSV channels whose whole image wavelet transform is needed
+		self.wavelet_channels = sorted(set(chan for name, _ in self.features if 'WaveletFeature' in name
+												for chan, word in enumerate(['hue', 'saturation', 'value']) if word in name.lower()))
+
+	# Input:
+	#   name - name of an Image feature
+	#   args - arguments given to the feature
+	# Output: number of values the feature outputs
+	@staticmethod
+	def featureLength(name, args = ()):
+		if name.endswith('OfEachSection'):
+			return 9
+		if name == 'binComparison':
+			return 36
+		if name in ('averageChannelOfGrid', 'statisticOfGrid'):
+			return args[0] * args[0]
+		if name == 'size':
+			return 2
+		if name in ('sumOfRegion', 'averageOfRegion'):
+			return 3
+		return 1
+
+	# Input: image - image_features.Image object
+	# Output: list of the values of all features, with the layout given by self.columns
+	def extract(self, image):
+		rv = []
+		for values in self._featureValues(image):
+			rv.extend(values)
+		return rv
+
+	# Same as extract(), but writes the values into an existing array instead of a list
+	# Input:
+	#   image - image_features.Image object
+	#   out - array of length len(self.columns), ex. a row of a feature_matrix.FeatureMatrix
+	# Output: out
+	def extractInto(self, image, out):
+		i = 0
+		for values in self._featureValues(image):
+			out[i:i + len(values)] = values
+			i += len(values)
+		return out
+
+	# Output: list of the output of each feature
+	@_stage('extract')
+	def _featureValues(self, image):
+		# Conversions are shared between features even if the image does not cache them
+		cache_conversions = image.cache_conversions
+		image.cache_conversions = True
+		try:
+			if self.sample_rate is not None:
+				# The other features are computed exactly, converting the image only when they first need it
+				sample = image.sampleSections(self.sample_rate, seed = self.seed)
+				rv = []
+				for name, args in self.features:
+					estimate = sample.estimateFeature(name, args)
+					rv.append(getattr(image, name)(*args) if estimate is None else estimate)
+				return rv
+
+			for pixel_f in self.pixel_functions:
+				image._convert(pixel_f)
+			for pixel_f in self.section_pixel_functions:
+				image._sectionStatistics(pixel_f)
+			for pixel_f in self.integral_pixel_functions:
+				image._integralImage(pixel_f)
+			# The channels are transformed in parallel if the image uses threads
+			_parallelMap(image.num_threads, lambda chan: image._waveletSums((0, image.width), (0, image.height), RGBtoHSV, chan), self.wavelet_channels)
+			if any(name.endswith('DepthOfField') for name, _ in self.features):
+				image._tileWaveletSums(4)
+
+			rv = [getattr(image, name)(*args) for name, args in self.features]
+		finally:
+			image.cache_conversions = cache_conversions
+			if not cache_conversions:
+				image.clearConversions()
+		return rv
+
+# Computes features of many images of the same size at once. The pixels of all images are stacked into a single
+# (N, H, W, 3) array, and every feature is computed for all N images with one set of array operations, so the Python
+# overhead is paid once per batch instead of once per image.
+# Supports the size, section, brightness, middle, binComparison, wavelet and depth of field features of Image.
+class ImageBatch:
+	# Maps the channel in the name of a feature to its pixel function and channel index
+	channels = {'Red': (RGBtoRGB, 0), 'Green': (RGBtoRGB, 1), 'Blue': (RGBtoRGB, 2),
+				'Hue': (RGBtoHSV, 0), 'Saturation': (RGBtoHSV, 1), 'Value': (RGBtoHSV, 2),
+				'Pleasure': (RGBtoPAD, 0), 'Arousal': (RGBtoPAD, 1), 'Dominance': (RGBtoPAD, 2)}
+
+	# Input:
+	#   images - either an (N, H, W, 3) uint8 array of RGB pixels, or a list of image_features.Image or PIL.Image objects
+	#            that all have the same size.
+	def __init__(self, images):
+		if isinstance(images, np.ndarray):
+			self.pixels = images
+			self.full_sizes = np.array([[images.shape[2], images.shape[1]]] * images.shape[0]).reshape(images.shape[0], 2)
+		else:
+			images = [(im if isinstance(im, Image) else Image(im)) for im in images]
+			if len(set((im.width, im.height) for im in images)) > 1:
+				raise Exception('Invalid images in ImageBatch: all images must be the same size, got ' + str(sorted(set((im.width, im.height) for im in images))))
+			self.pixels = np.stack([im.pixels for im in images])
+			self.full_sizes = np.array([[im.full_width, im.full_height] for im in images]).reshape(len(images), 2)
+
+		self.num_images, self.height, self.width = self.pixels.shape[:3]
+
+		# Same as the caches of Image, but each entry holds all N images
+		self.conversions = {}
+		self.section_statistics = {}
+		self.section_histograms = {}
+		self.wavelet_sums = None
+		self.tile_wavelet_sums = {}
+
+	# Input:
+	#   features - list of features, in the same format as FeatureExtractor
+	# Output: (N, number of columns) array, where row i is the feature vector of image i with the layout of FeatureExtractor(features).columns
+	def extract(self, features = default_features):
+		extractor = FeatureExtractor(features)
+		return np.hstack([self.feature(name, args) for name, args in extractor.features])
+
+	# Input:
+	#   name, args - feature name and arguments, the same as the Image method
+	# Output: (N, length of the feature) array of the feature for every image
+	def feature(self, name, args = ()):
+		section = re.match('^(average|max|min)(.+)OfEachSection$', name)
+		if section is not None and section.group(2) in ImageBatch.channels:
+			pixel_f, chan = ImageBatch.channels[section.group(2)]
+			stats = self._sectionStatistics(pixel_f)
+			if section.group(1) == 'average':
+				return stats['sum'][:, :, chan] / self._sectionCounts(3)
+			return stats[section.group(1)][:, :, chan].astype(np.float64)
+
+		wavelet = re.match('^(hue|saturation|value)WaveletFeature$', name)
+		if wavelet is not None:
+			return self._hsvWaveletFeature(['hue', 'saturation', 'value'].index(wavelet.group(1)), *args)
+
+		sum_wavelet = re.match('^sum(Hue|Saturation|Value)WaveletFeature$', name)
+		if sum_wavelet is not None:
+			chan = ['Hue', 'Saturation', 'Value'].index(sum_wavelet.group(1))
+			return sum(self._hsvWaveletFeature(chan, layer) for layer in [1, 2, 3])
+
+		depth = re.match('^(hue|saturation|value)DepthOfField$', name)
+		if depth is not None:
+			tile_sums = self._tileWaveletSums(4)[:, :, ['hue', 'saturation', 'value'].index(depth.group(1))]
+			middle_sum = tile_sums[:, [5, 6, 9, 10]].sum(axis = 1)
+			all_sum = tile_sums.sum(axis = 1)
+			return np.where(all_sum == 0.0, 0.0, middle_sum / np.where(all_sum == 0.0, 1.0, all_sum))[:, np.newaxis]
+
+		if name == 'aspectRatio':
+			return (self.full_sizes[:, 0] / self.full_sizes[:, 1].astype(np.float64))[:, np.newaxis]
+		if name == 'sumOfSizes':
+			return self.full_sizes.sum(axis = 1)[:, np.newaxis].astype(np.float64)
+		if name == 'size':
+			return self.full_sizes.astype(np.float64)
+		if name == 'averageBrightness':
+			return (self._convert(RGBtoHSV)[..., 2].sum(axis = (1, 2), dtype = np.float64) / float(self.width * self.height))[:, np.newaxis]
+		if name in ('averageHueOfMiddle', 'averageSaturationOfMiddle'):
+			ws, hs = self._getSections(3)
+			middle = self._convert(RGBtoHSV)[:, hs[1][0]:hs[1][1], ws[1][0]:ws[1][1], (0 if name == 'averageHueOfMiddle' else 1)]
+			return (middle.sum(axis = (1, 2), dtype = np.float64) / float(ws[1][1] - ws[1][0]) / float(hs[1][1] - hs[1][0]))[:, np.newaxis]
+		if name == 'binComparison':
+			return self.binComparison(*args)
+
+		raise Exception('Unsupported feature in ImageBatch: ' + str(name))
+
+	# Same as Image.binComparison(), but outputs an (N, 36) array
+	def binComparison(self, num_bins,
+							bin_type = 'avg',
+							norm_type = 'sum_to_one',
+							dif_type = 'sum_of_abs',
+							pixel_type = 'rgb'):
+		Image._checkBinComparison(bin_type, norm_type, dif_type, pixel_type)
+
+		bins = normalizeHistograms(self._sectionHistograms(num_bins, bin_type, pixel_type), norm_type)
+		return np.hstack([histogramDistance(bins[:, i:i + 1], bins[:, i + 1:], dif_type, num_bins, bin_type) for i in range(9)]).astype(np.float64)
+
+	# ---------------------
+	# |  Helper Fuctions  |
+	# ---------------------
+
+	def _getSections(self, num):
+		return sectionRanges(self.width, self.height, num)
+
+	# Output: (num * num,) array of the number of pixels in each section, with empty sections counted as 1 so they average to 0
+	def _sectionCounts(self, num):
+		ws, hs = self._getSections(num)
+		return np.array([float(max((wr[1] - wr[0]) * (hr[1] - hr[0]), 1)) for wr in ws for hr in hs])
+
+	def _convert(self, pixel_f):
+		if pixel_f is RGBtoRGB:
+			return self.pixels
+		if pixel_f not in self.conversions:
+			if pixel_f is RGBtoPAD:
+				self.conversions[pixel_f] = HSVtoPADArray(self._convert(RGBtoHSV))
+			else:
+				self.conversions[pixel_f] = arrayFunction(pixel_f)(self.pixels)
+		return self.conversions[pixel_f]
+
+	# Output: dict with the keys 'sum', 'min', and 'max'. Each value is an (N, 9, 3) array of the statistic of each channel
+	#         of each section of each image. Empty sections are 0, the same as Image._sectionStatistics().
+	def _sectionStatistics(self, pixel_f):
+		if pixel_f not in self.section_statistics:
+			arr = self._convert(pixel_f)
+			ws, hs = self._getSections(3)
+
+			sections = [arr[:, hr[0]:hr[1], wr[0]:wr[1]] for wr in ws for hr in hs]
+			empty = np.zeros((self.num_images, 3), dtype = arr.dtype)
+			self.section_statistics[pixel_f] = {'sum': np.stack([s.sum(axis = (1, 2), dtype = (None if s.dtype == np.uint8 else np.float64)) for s in sections], axis = 1),
+												'min': np.stack([(s.min(axis = (1, 2)) if s.shape[1] * s.shape[2] > 0 else empty) for s in sections], axis = 1),
+												'max': np.stack([(s.max(axis = (1, 2)) if s.shape[1] * s.shape[2] > 0 else empty) for s in sections], axis = 1)}
+		return self.section_statistics[pixel_f]
+
+	# Output: (N, 9, number of bins) array of the histogram of each section of each image, counted with a single bincount
+	def _sectionHistograms(self, num_bins, bin_type, pixel_type):
+		key = (num_bins, bin_type, pixel_type)
+		if key not in self.section_histograms:
+			total_bins = (num_bins if bin_type == 'avg' else pow(num_bins, 3))
+			bin_index = binIndices(self._convert(RGBtoRGB if pixel_type == 'rgb' else RGBtoHSV), num_bins, bin_type, pixel_type)
+
+			ws, hs = self._getSections(3)
+			x_section = np.repeat(np.arange(3), [wr[1] - wr[0] for wr in ws])
+			y_section = np.repeat(np.arange(3), [hr[1] - hr[0] for hr in hs])
+			section = x_section[np.newaxis, :] * 3 + y_section[:, np.newaxis]
+
+			label = (np.arange(self.num_images)[:, np.newaxis, np.newaxis] * 9 + section) * total_bins + bin_index
+			counts = np.bincount(label.ravel(), minlength = self.num_images * 9 * total_bins)
+			self.section_histograms[key] = counts.reshape(self.num_images, 9, total_bins)
+		return self.section_histograms[key]
+
+	# Output: list of three 2-tuples, one for each layer in ascending order, of (N, 3) arrays of the sum and absolute sum
+	#         of the layer's wavelet coefficients for each HSV channel of each image. All images and channels are
+	#         transformed by a single wavedec2 call.
+	def _waveletSums(self):
+		if self.wavelet_sums is None:
+			coeffs = waveletDecomposition(self._convert(RGBtoHSV), axes = (1, 2))
+			self.wavelet_sums = [(sum(c.sum(axis = (1, 2), dtype = np.float64) for c in layer), sum(np.abs(c).sum(axis = (1, 2), dtype = np.float64) for c in layer))
+									for layer in coeffs[1:]]
+		return self.wavelet_sums
+
+	# Output: (N, 1) array, see Image._hsvWaveletFeature()
+	def _hsvWaveletFeature(self, chan, layer):
+		if layer not in [1, 2, 3]:
+			raise Exception('Invalid layer value')
+
+		total, norm = self._waveletSums()[layer - 1]
+		total = total[:, chan]
+		norm = norm[:, chan]
+		return np.where(norm == 0.0, 0.0, total / np.where(norm == 0.0, 1.0, norm))[:, np.newaxis]
+
+	# Output: (N, num * num, 3) array, see Image._tileWaveletSums()
+	def _tileWaveletSums(self, num):
+		if num not in self.tile_wavelet_sums:
+			hsv = self._convert(RGBtoHSV)
+			ws, hs = self._getSections(num)
+
+			sums = []
+			for wr in ws:
+				for hr in hs:
+					if wr[0] == wr[1] or hr[0] == hr[1]:
+						sums.append(np.zeros((len(hsv), 3)))
+						continue
+					coeffs = waveletDecomposition(hsv[:, hr[0]:hr[1], wr[0]:wr[1]], axes = (1, 2))
+					sums.append(sum(c.sum(axis = (1, 2), dtype = np.float64) for c in coeffs[3]))
+			self.tile_wavelet_sums[num] = np.stack(sums, axis = 1)
+		return self.tile_wavelet_sums[num]
+
 if __name__ == '__main__':
 	# Runs debugging unit tests for the Image class
 
@@ -475,6 +1999,112 @@ if __name__ == '__main__':
 			raise Exception('Error in RGBtoHSV(): got RGBtoHSV(' + str(test['rgb']) + ') = ' + str(comp_hsv) + '; expected ' + str(test['hsv']))
 	print 'Passed RGBtoHSV() tests'
 
+	# Test an image smaller than the sections, whose bottom row of sections is empty
+	print 'Testing small images'
+	small_image = newImageFromArray(np.array([[[255, 0, 0], [0, 255, 0], [0, 0, 255]]] * 2, dtype = np.uint8))
+	small_tests = [{'name': 'averageHueOfEachSection',
+						'args': (),
+						'expected': (0, 0, 0, 120, 120, 0, 240, 240, 0)},
+					{'name': 'binComparison',
+						'args': (2, 'avg', 'sum_to_one', 'sum_of_abs', 'rgb'),
+						'expected': (0, 1, 0, 0, 1, 0, 0, 1,
+									 1, 0, 0, 1, 0, 0, 1,
+									 1, 1, 0, 1, 1, 0,
+									 0, 1, 0, 0, 1,
+									 1, 0, 0, 1,
+									 1, 1, 0,
+									 0, 1,
+									 1)}]
+
+	for test in small_tests:
+		rv = getattr(small_image, test['name'])(*test['args'])
+		if len(rv) != len(test['expected']) or any(abs(o - e) > 0.0001 for o, e in zip(rv, test['expected'])):
+			raise Exception('Error in ' + test['name'] + '(): got ' + test['name'] + '(' + ', '.join(['3x2 image'] + list(map(str, test['args']))) + ') = ' + str(rv) + '; expected ' + str(test['expected']))
+	print 'Passed small image tests'
+
+	# Test depth of field on 32x32 images of red and green stripes, which have level 3 wavelet coefficients in every 8x8
+	# tile, in only the middle four tiles, or in no tiles. Only the hue changes, so the other channels are always 0.
+	print 'Testing DepthOfField()'
+	red, green = [255, 0, 0], [0, 255, 0]
+	solid = np.array([[red] * 32] * 32, dtype = np.uint8)
+	stripes = np.array([[red, green] * 16] * 32, dtype = np.uint8)
+	middle_stripes = solid.copy()
+	middle_stripes[8:24, 8:24] = stripes[8:24, 8:24]
+	depth_tests = [{'name': 'solid', 'im': newImageFromArray(solid), 'expected': (0.0, 0.0, 0.0)},
+					{'name': 'stripes', 'im': newImageFromArray(stripes), 'expected': (0.25, 0.0, 0.0)},
+					{'name': 'middle_stripes', 'im': newImageFromArray(middle_stripes), 'expected': (1.0, 0.0, 0.0)}]
+
+	for test in depth_tests:
+		for name, expected in zip(['hueDepthOfField', 'saturationDepthOfField', 'valueDepthOfField'], test['expected']):
+			rv = getattr(test['im'], name)()
+			if abs(rv[0] - expected) > 0.0001:
+				raise Exception('Error in ' + name + '(): got ' + name + '(' + test['name'] + ') = ' + str(rv[0]) + '; expected ' + str(expected))
+	print 'Passed DepthOfField() tests'
+
+	# Test the binComparison() options that the test images do not use. Each test image gives each of the nine sections,
+	# in the order of the section features, a single row of pixels, and the label of the histogram that row has.
+	print 'Testing binComparison() options'
+	def sectionImage(sections):
+		return newImageFromArray(np.array([[pixel for x in range(3) for pixel in sections[x * 3 + y]] for y in range(3)], dtype = np.uint8))
+
+	black, white, blue = [0, 0, 0], [255, 255, 255], [0, 0, 255]
+	gray = lambda v: [v, v, v]
+	option_tests = [{'name': 'earth_mover',
+						# One pixel in each section, in avg bins 0, 1, 2, 3, 3, 1, 0, 2, 3. The earth mover distance between
+						# two single pixel histograms is the distance between their bins.
+						'sections': [[gray(v)] for v in (0, 64, 128, 192, 255, 64, 0, 128, 192)],
+						'labels': (0, 1, 2, 3, 3, 1, 0, 2, 3),
+						'args': (4, 'avg', 'sum_to_one', 'earth_mover', 'rgb'),
+						'distance': lambda a, b: abs(a - b)},
+					{'name': 'euclidean',
+						# Histograms of (3, 0) and (2, 1) pixels, which normalize to (1, 0) and (2, 1) / sqrt(5)
+						'sections': [[black] * 3, [black, black, white]] * 4 + [[black] * 3],
+						'labels': (0, 1) * 4 + (0,),
+						'args': (2, 'avg', 'euclidean', 'sum_of_abs', 'rgb'),
+						'distance': lambda a, b: (0.0 if a == b else 1.0 - 1.0 / math.sqrt(5.0))},
+					{'name': 'hsv',
+						# Black and white have hue and saturation 0, and differ only in value, while blue has hue 240 and
+						# saturation 1, so with 2 bins per channel all three are in different 3d bins
+						'sections': [[black], [white], [blue]] * 3,
+						'labels': (0, 1, 2) * 3,
+						'args': (2, '3d', 'sum_to_one', 'sum_of_abs', 'hsv'),
+						'distance': lambda a, b: (0.0 if a == b else 2.0)}]
+
+	for test in option_tests:
+		rv = sectionImage(test['sections']).binComparison(*test['args'])
+		expected = [test['distance'](a, b) for i, a in enumerate(test['labels']) for b in test['labels'][i + 1:]]
+		if len(rv) != len(expected) or any(abs(o - e) > 0.0001 for o, e in zip(rv, expected)):
+			raise Exception('Error in binComparison(): got binComparison(' + ', '.join([test['name'] + ' image'] + list(map(str, test['args']))) + ') = ' + str(rv) + '; expected ' + str(expected))
+	print 'Passed binComparison() options tests'
+
+	# Test that ImageBatch outputs the same default features as Image for each image, up to summation order
+	print 'Testing ImageBatch'
+	batch_pixels = np.random.RandomState(0).randint(0, 256, (3, 20, 24, 3)).astype(np.uint8)
+	batch_features = ImageBatch(batch_pixels).extract()
+	extractor = FeatureExtractor()
+	for i in range(len(batch_pixels)):
+		error = np.abs(batch_features[i] - np.array(extractor.extract(newImageFromArray(batch_pixels[i])))).max()
+		if error > 1e-9:
+			raise Exception('Error in ImageBatch: got features of image ' + str(i) + ' that differ from Image by ' + str(error) + '; expected the same features')
+	print 'Passed ImageBatch tests'
+
+	# Test the features of synthetic corpus images against the values gen_test_image expects, including sizes with empty
+	# sections. Imported here since gen_test_image imports this module.
+	print 'Testing gen_test_image corpus'
+	import gen_test_image
+	for kind in ['quadrant', 'stripe', 'gradient']:
+		for width, height in [(5, 2), (2, 7), (31, 17)]:
+			pil_image, _, sections = gen_test_image.corpusImage(kind, width, height, 0)
+			corpus_image = Image(pil_image)
+			for name, args, expected in gen_test_image.expectedFeatureValues(width, height, sections):
+				# The middle features divide by the size of the middle section, so are undefined when it is empty
+				if name.endswith('OfMiddle') and min(width, height) < 3:
+					continue
+				rv = getattr(corpus_image, name)(*args)
+				if len(rv) != len(expected) or any(abs(o - e) > 0.0001 for o, e in zip(rv, expected)):
+					raise Exception('Error in ' + name + '(): got ' + name + '(' + ', '.join(['%s %dx%d image' % (kind, width, height)] + list(map(str, args))) + ') = ' + str(rv) + '; expected ' + str(expected))
+	print 'Passed gen_test_image corpus tests'
+
 	# List of test images with known outputted values
 	test_images = [{'filename': 'test_images/all_color.png',
 						'im': newImage('test_images/all_color.png'),
@@ -0,0 +1,96 @@
+
+import image_features
+
+import numpy as np
+
+import argparse
+import os
+import sys
+
+# A pixel store is a set of images decoded once and packed into three files sharing a prefix:
+#   <prefix>.pixels - the RGB pixels of every image, as uint8 in row major order, one image after another
+#   <prefix>.index.npy - (N, 5) int64 array with the byte offset, width, height, full width and full height of each image
+#   <prefix>.files.txt - the filename of each image, one per line, in the same order as the index
+# The pixels are read through a memory map, so images are never decoded again, and worker processes reading the same
+# store share the operating system's page cache.
+
+# Input:
+#   filenames - list of image files
+#   prefix - prefix of the pixel store files to create
+#   max_pixels - see image_features.Image.__init__()
+# Output: list of 2-tuples of the filename and error message of every image that could not be decoded
+def buildPixelStore(filenames, prefix, max_pixels = None):
+	index = []
+	stored = []
+	failed = []
+
+	offset = 0
+	with open(prefix + '.pixels', 'wb') as f:
+		for filename in filenames:
+			try:
+				im = image_features.newImage(filename, cache_conversions = False, max_pixels = max_pixels)
+				pixels = np.ascontiguousarray(im.pixels)
+			except Exception as e:
+				failed.append((filename, str(e)))
+				continue
+
+			f.write(pixels.tostring())
+			index.append((offset, im.width, im.height, im.full_width, im.full_height))
+			stored.append(filename)
+			offset += pixels.nbytes
+
+	np.save(prefix + '.index.npy', np.array(index, dtype = np.int64).reshape(len(index), 5))
+	with open(prefix + '.files.txt', 'w') as f:
+		for filename in stored:
+			f.write(filename + '\n')
+	return failed
+
+class PixelStore:
+	# Input: prefix - prefix of the files created by buildPixelStore()
+	def __init__(self, prefix):
+		self.index = np.load(prefix + '.index.npy')
+		with open(prefix + '.files.txt') as f:
+			self.filenames = [line.rstrip('\n') for line in f]
+		self.positions = dict((filename, i) for i, filename in enumerate(self.filenames))
+
+		if os.path.getsize(prefix + '.pixels') > 0:
+			self.data = np.memmap(prefix + '.pixels', dtype = np.uint8, mode = 'r')
+		else:
+			self.data = np.zeros(0, dtype = np.uint8)
+
+	def __len__(self):
+		return len(self.filenames)
+
+	# Input: key - position of the image in the store, or its filename
+	# Output: (H, W, 3) uint8 read-only view of the image's pixels in the memory map
+	def pixels(self, key):
+		i = (self.positions[key] if isinstance(key, basestring) else key)
+		offset, width, height = self.index[i, :3]
+		return self.data[offset:offset + width * height * 3].reshape(height, width, 3)
+
+	# Input:
+	#   key - position of the image in the store, or its filename
+	#   cache_conversions - see image_features.Image.__init__()
+	# Output: image_features.Image object that uses the stored pixels without copying them
+	def image(self, key, cache_conversions = True):
+		i = (self.positions[key] if isinstance(key, basestring) else key)
+		return image_features.newImageFromArray(self.pixels(i), cache_conversions = cache_conversions,
+												full_size = (int(self.index[i, 3]), int(self.index[i, 4])))
+
+if __name__ == '__main__':
+	from extract_features import findImages
+
+	parser = argparse.ArgumentParser(description = 'Decodes images once into a memory-mappable pixel store')
+
+	parser.add_argument('paths', metavar = 'PATH', type = str, nargs = '+', help = 'Image files or directories of images')
+	parser.add_argument('-r', '--recursive', help = 'If given, directories are searched recursively', action = 'store_true')
+	parser.add_argument('-m', '--max_pixels', metavar = 'N', type = int, default = None, help = 'If given, larger images are downscaled to at most this many pixels')
+	parser.add_argument('-o', '--out_prefix', metavar = 'PREFIX', type = str, required = True, help = 'Prefix of the pixel store files to create')
+
+	args = parser.parse_args()
+
+	failed = buildPixelStore(findImages(args.paths, args.recursive), args.out_prefix, args.max_pixels)
+	for filename, error in failed:
+		sys.stderr.write('Failed to decode ' + filename + ': ' + error + '\n')
+	if len(failed) > 0:
+		sys.exit(1)
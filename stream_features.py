@@ -0,0 +1,152 @@
+
+import image_features
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import argparse
+import json
+import Queue
+import sys
+import threading
+import time
+
+# Extracts features from a stream of encoded images, ex. blobs received by a service, instead of from files on disk.
+# The pipeline has three stages that run at the same time:
+#   1. a feeder thread reads (key, data) pairs from the source
+#   2. a pool of threads decodes the images (PIL releases the GIL while decoding)
+#   3. a pool of processes computes the features of the decoded pixels
+# At most max_pending images are between the source and the consumer at any time. When the consumer falls behind,
+# the feeder stops reading from the source, so memory usage is bounded no matter how fast images arrive.
+
+# Marks the end of the source in the results queue
+_end_of_source = object()
+
+# Runs in the worker processes
+# Input:
+#   pixels - (H, W, 3) uint8 array of RGB pixels
+#   full_size - see image_features.newImageFromArray()
+#   features - feature list given to image_features.FeatureExtractor
+# Output: list of the values of all features
+def _extractPixels(pixels, full_size, features):
+	return image_features.FeatureExtractor(features).extract(image_features.newImageFromArray(pixels, full_size = full_size))
+
+# Input: filenames - list of image files
+# Output: generator of 2-tuples of each filename and the contents of the file
+def fileSource(filenames):
+	for filename in filenames:
+		with open(filename, 'rb') as f:
+			yield filename, f.read()
+
+# Input:
+#   source - iterable of 2-tuples of a key identifying the image and its encoded data, as a string or file-like object
+#            (see image_features.newImageFromBytes())
+#   features - feature list given to image_features.FeatureExtractor
+#   num_decoders - number of threads decoding images
+#   num_workers - number of worker processes computing features. Defaults to the number of CPUs
+#   max_pending - maximum number of images that have been read from the source but not yet given to the consumer
+#   max_pixels - see image_features.Image.__init__()
+# Output: generator of 3-tuples of the key, the feature vector (None on failure) and an error message (None on success),
+#         in the order the images finish. Exceptions raised by the source are raised by the generator.
+def extractStream(source, features = image_features.default_features, num_decoders = 4, num_workers = None, max_pending = 32, max_pixels = None):
+	if max_pending < 1:
+		raise Exception('Invalid max_pending in extractStream: got ' + str(max_pending) + ', but must be at least 1')
+
+	results = Queue.Queue()
+	slots = threading.Semaphore(max_pending)
+	stopped = threading.Event()
+
+	decoders = ThreadPoolExecutor(max_workers = num_decoders)
+	workers = ProcessPoolExecutor(max_workers = num_workers)
+
+	def finished(key, future):
+		try:
+			results.put((key, future.result(), None))
+		except Exception as e:
+			results.put((key, None, str(e)))
+
+	def decode(key, data):
+		try:
+			im = image_features.newImageFromBytes(data, cache_conversions = False, max_pixels = max_pixels)
+			future = workers.submit(_extractPixels, im.pixels, (im.full_width, im.full_height), features)
+		except Exception as e:
+			results.put((key, None, str(e)))
+			return
+		future.add_done_callback(lambda future: finished(key, future))
+
+	def feed():
+		count = 0
+		error = None
+		try:
+			for key, data in source:
+				slots.acquire()
+				if stopped.is_set():
+					break
+				decoders.submit(decode, key, data)
+				count += 1
+		except Exception as e:
+			error = e
+		results.put((_end_of_source, count, error))
+
+	feeder = threading.Thread(target = feed)
+	feeder.daemon = True
+	feeder.start()
+
+	try:
+		count = None
+		error = None
+		num_done = 0
+		while count is None or num_done < count:
+			# A timeout keeps the wait interruptible by KeyboardInterrupt
+			try:
+				key, row, message = results.get(timeout = 1.0)
+			except Queue.Empty:
+				continue
+
+			if key is _end_of_source:
+				count, error = row, message
+				continue
+
+			num_done += 1
+			slots.release()
+			yield key, row, message
+
+		if error is not None:
+			raise error
+	finally:
+		# Unblocks the feeder if the consumer stopped early
+		stopped.set()
+		for _ in range(max_pending):
+			slots.release()
+		decoders.shutdown(wait = True)
+		workers.shutdown(wait = True)
+
+if __name__ == '__main__':
+	from extract_features import findImages
+
+	parser = argparse.ArgumentParser(description = 'Streams images through the decoding and feature extraction pipeline, writing JSONL to stdout')
+
+	parser.add_argument('paths', metavar = 'PATH', type = str, nargs = '+', help = 'Image files or directories of images')
+	parser.add_argument('-r', '--recursive', help = 'If given, directories are searched recursively', action = 'store_true')
+	parser.add_argument('-m', '--max_pixels', metavar = 'N', type = int, default = None, help = 'If given, larger images are downscaled to at most this many pixels')
+	parser.add_argument('-d', '--decoders', metavar = 'N', type = int, default = 4, help = 'Number of decoding threads')
+	parser.add_argument('-w', '--workers', metavar = 'N', type = int, default = None, help = 'Number of worker processes. Defaults to the number of CPUs')
+	parser.add_argument('-q', '--max_pending', metavar = 'N', type = int, default = 32, help = 'Maximum number of images in the pipeline at a time')
+
+	args = parser.parse_args()
+
+	start = time.time()
+	num_images = 0
+	num_failed = 0
+	for key, row, error in extractStream(fileSource(findImages(args.paths, args.recursive)), num_decoders = args.decoders,
+										num_workers = args.workers, max_pending = args.max_pending, max_pixels = args.max_pixels):
+		num_images += 1
+		if error is None:
+			sys.stdout.write(json.dumps({'filename': key, 'features': row}) + '\n')
+		else:
+			num_failed += 1
+			sys.stderr.write('Failed to extract features from ' + key + ': ' + error + '\n')
+
+	elapsed = time.time() - start
+	sys.stderr.write('%d images in %.2fs (%.1f images/s), %d failed\n' % (num_images, elapsed, num_images / elapsed if elapsed > 0 else 0.0, num_failed))
+	if num_failed > 0:
+		sys.exit(1)
@@ -0,0 +1,310 @@
+
+import image_features
+from image_features import RGBtoRGB, RGBtoHSV, RGBtoPAD
+
+from PIL import Image as PIL_Image
+import numpy as np
+
+import argparse
+import json
+import re
+import sys
+import time
+
+# Computes features of images that are too large to hold in memory, ex. gigapixel scans. The pixels are read in
+# horizontal strips, and each strip is converted and added to the per section sums, minimums, maximums and histograms
+# of a StripExtractor, then freed. Only the strips that have not been reduced yet are kept, which is at most about
+# image_features._strip_rows rows plus one strip as read.
+# The strips are reduced exactly the same way as Image reduces its sections (see image_features.sectionStrips()), so
+# the section, binComparison and grid features are the same as those of an Image of the whole image. averageBrightness and
+# the middle features are sums in a different order, so can differ in the last few digits.
+
+# The default features of image_features that can be computed from strips. The wavelet and depth of field features need
+# the whole image at once.
+default_features = [feature for feature in image_features.default_features
+						if re.search('Wavelet|DepthOfField', (feature if isinstance(feature, basestring) else feature[0])) is None]
+
+# Input:
+#   filename - image file
+#   strip_rows - number of rows to read at a time, when the format allows it
+# Output: generator of (rows, W, 3) uint8 arrays of the RGB pixels of consecutive strips of the image, from the top down.
+#         Uncompressed images (ex. TIFF, BMP and PPM) are read strip_rows rows at a time, and uncompressed TIFFs stored
+#         as many strips or tiles are read one row of strips or tiles at a time. Other formats (ex. JPEG, PNG and
+#         compressed TIFFs) are decoded whole, so only the conversions and reductions of them use bounded memory.
+def readStrips(filename, strip_rows = 256):
+	image = PIL_Image.open(filename)
+	bands = _tileBands(image, strip_rows)
+	if bands is None:
+		pixels = np.asarray(image.convert('RGB'))
+		for start in range(0, pixels.shape[0], strip_rows):
+			yield pixels[start:start + strip_rows]
+		return
+
+	for upper, lower, tiles in bands:
+		yield _decodeTiles(filename, upper, lower, tiles)
+
+# Input:
+#   image - PIL.Image object that has not been loaded
+#   strip_rows - see readStrips()
+# Output: list of 3-tuples of the first row, the row after the last, and the PIL tiles of each band of rows that can be
+#         decoded on its own, or None if the image must be decoded whole
+def _tileBands(image, strip_rows):
+	width, height = image.size
+	tiles = image.tile
+
+	# An uncompressed image is one tile, which is split into strips by moving the file offset
+	if len(tiles) == 1 and tiles[0][0] == 'raw' and tuple(tiles[0][1]) == (0, 0, width, height):
+		args = (tiles[0][3] if isinstance(tiles[0][3], tuple) else (tiles[0][3],))
+		rawmode = args[0]
+		stride = (args[1] if len(args) > 1 else 0)
+		orientation = (args[2] if len(args) > 2 else 1)
+		if orientation not in (1, -1):
+			return None
+		if stride == 0:
+			try:
+				stride = len(PIL_Image.new(image.mode, (width, 1)).tobytes('raw', rawmode))
+			except Exception:
+				return None
+
+		rv = []
+		for upper in range(0, height, strip_rows):
+			lower = min(upper + strip_rows, height)
+			# Bottom up images store the last row first
+			offset = tiles[0][2] + (upper if orientation == 1 else height - lower) * stride
+			rv.append((upper, lower, [('raw', (0, upper, width, lower), offset, (rawmode, stride, orientation))]))
+		return rv
+
+	if len(tiles) < 2 or any(tile[0] != 'raw' for tile in tiles):
+		return None
+
+	# Groups the tiles into rows of tiles, then merges rows until they have at least strip_rows rows
+	rows = {}
+	for tile in tiles:
+		rows.setdefault((tile[1][1], tile[1][3]), []).append(tile)
+	rv = []
+	for upper, lower in sorted(rows.keys()):
+		if upper != (rv[-1][1] if len(rv) > 0 else 0):
+			return None
+		if len(rv) > 0 and rv[-1][1] - rv[-1][0] < strip_rows:
+			rv[-1] = (rv[-1][0], lower, rv[-1][2] + rows[(upper, lower)])
+		else:
+			rv.append((upper, lower, rows[(upper, lower)]))
+	if rv[-1][1] < height:
+		return None
+	return [(upper, min(lower, height), band_tiles) for upper, lower, band_tiles in rv]
+
+# Input:
+#   filename - image file
+#   upper, lower - rows of the band
+#   tiles - PIL tiles covering the band, see _tileBands()
+# Output: (lower - upper, W, 3) uint8 array of the RGB pixels of the band
+def _decodeTiles(filename, upper, lower, tiles):
+	image = PIL_Image.open(filename)
+	width = image.size[0]
+
+	# The image is made to look like it only has the rows of the band, so only the band's tiles are read. Tiles on the
+	# edges can extend past the image, so the band is cropped after decoding.
+	size = (max(tile[1][2] for tile in tiles), max(tile[1][3] for tile in tiles) - upper)
+	if hasattr(image, '_size'):
+		image._size = size
+	else:
+		image.size = size
+	image.tile = [(name, (box[0], box[1] - upper, box[2], box[3] - upper), offset, args) for name, box, offset, args in tiles]
+	return np.asarray(image.convert('RGB'))[:lower - upper, :width]
+
+class StripExtractor:
+	# Maps the features of the middle section to the HSV channel they average, which is found from the section sums
+	middle_features = {'averageHueOfMiddle': 0, 'averageSaturationOfMiddle': 1}
+
+	# Input:
+	#   width, height - size of the image
+	#   features - list of features, in the same format as image_features.FeatureExtractor. The wavelet, depth of field,
+	#              region and percentile features are not supported.
+	#   full_size - 2-tuple of the width and height reported by the size features. Defaults to width and height.
+	def __init__(self, width, height, features = default_features, full_size = None):
+		extractor = image_features.FeatureExtractor(features)
+		self.features = extractor.features
+		self.columns = extractor.columns
+
+		self.width, self.height = width, height
+		self.full_size = ((width, height) if full_size is None else full_size)
+
+		# Maps the number of sections in each dimension to a dict mapping pixel functions to the names of the statistics
+		# needed, see image_features.Image._sectionStatistics()
+		self.statistics = {}
+		self.histogram_keys = []
+		self.brightness = False
+		for name, args in self.features:
+			self._plan(name, args)
+
+		# Rows added so far, and the (first row, pixels) of the strips added that are still needed
+		self.rows = 0
+		self.buffer = []
+
+		# For each number of sections, the strips to reduce (see image_features.sectionStrips()) and the index of the next
+		self.grids = {}
+		for num in self.statistics:
+			ws, hs = image_features.sectionRanges(width, height, num)
+			self.grids[num] = {'x_starts': [wr[0] for wr in ws],
+								'x_section': np.repeat(np.arange(num), [wr[1] - wr[0] for wr in ws]),
+								'strips': image_features.sectionStrips(hs),
+								'next': 0}
+
+		# The same as the caches of Image, but with a list of the reduction of each row of sections
+		self.section_statistics = dict(((num, pixel_f), dict((name, [None] * num) for name in names))
+										for num, functions in self.statistics.items() for pixel_f, names in functions.items())
+		self.section_histograms = dict((key, [None] * 3) for key in self.histogram_keys)
+		self.brightness_sum = 0.0
+
+	# Adds the statistics needed by a feature to the plan
+	def _plan(self, name, args):
+		def need(num, pixel_f, names):
+			self.statistics.setdefault(num, {}).setdefault(pixel_f, set()).update(names)
+
+		section = re.match('^(average|max|min)(.+)OfEachSection$', name)
+		if section is not None and section.group(2) in image_features.ImageBatch.channels:
+			need(3, image_features.ImageBatch.channels[section.group(2)][0], ['sum', 'min', 'max'])
+		elif name in ('aspectRatio', 'sumOfSizes', 'size'):
+			pass
+		elif name == 'averageBrightness':
+			need(3, RGBtoHSV, [])
+			self.brightness = True
+		elif name in StripExtractor.middle_features:
+			need(3, RGBtoHSV, ['sum'])
+		elif name == 'binComparison':
+			num_bins, bin_type, pixel_type = image_features._binComparisonKey(*args)
+			# The pixels binned are converted for the sections
+			need(3, (RGBtoRGB if pixel_type == 'rgb' else RGBtoHSV), [])
+			if (num_bins, bin_type, pixel_type) not in self.histogram_keys:
+				self.histogram_keys.append((num_bins, bin_type, pixel_type))
+		elif name in ('averageChannelOfGrid', 'statisticOfGrid'):
+			n, space = args[:2]
+			statistic = (args[3] if name == 'statisticOfGrid' else 'mean')
+			if statistic not in image_features.Image.grid_statistics:
+				raise Exception('Unsupported feature in StripExtractor: ' + name + str(args) + ', percentiles need the whole image')
+			if space not in image_features.pixel_spaces or n < 1 or n > self.width or n > self.height:
+				raise Exception('Invalid arguments in StripExtractor: got ' + name + str(args) + ', see Image.gridStatistics()')
+			need(n, image_features.pixel_spaces[space], {'std': ['sum', 'sum_of_squares'], 'mean': ['sum']}.get(statistic, [statistic]))
+		else:
+			raise Exception('Unsupported feature in StripExtractor: ' + str(name))
+
+	# Input: strip - (rows, W, 3) uint8 array of the RGB pixels of the rows after the rows already added
+	def add(self, strip):
+		strip = np.asarray(strip)
+		if strip.ndim != 3 or strip.shape[1:] != (self.width, 3) or self.rows + strip.shape[0] > self.height:
+			raise Exception('Invalid strip in add: got shape ' + str(strip.shape) + ', but must be (rows, ' + str(self.width) +
+							', 3) with at most ' + str(self.height - self.rows) + ' rows')
+		self.buffer.append((self.rows, strip))
+		self.rows += strip.shape[0]
+
+		for num, grid in sorted(self.grids.items()):
+			while grid['next'] < len(grid['strips']) and grid['strips'][grid['next']][1][1] <= self.rows:
+				i, rows = grid['strips'][grid['next']]
+				self._reduceStrip(num, i, self._bufferedRows(*rows))
+				grid['next'] += 1
+
+		# Frees the rows that every grid has reduced
+		needed = min([grid['strips'][grid['next']][1][0] for grid in self.grids.values() if grid['next'] < len(grid['strips'])] + [self.rows])
+		self.buffer = [(start, pixels) for start, pixels in self.buffer if start + pixels.shape[0] > needed]
+
+	# Input: start, stop - range of rows that have been added and not freed
+	# Output: (stop - start, W, 3) array of the pixels of the rows
+	def _bufferedRows(self, start, stop):
+		parts = [pixels[max(start - first, 0):stop - first] for first, pixels in self.buffer if first < stop and first + pixels.shape[0] > start]
+		return (parts[0] if len(parts) == 1 else np.concatenate(parts))
+
+	# Adds the statistics of a strip to the ith row of sections of the grid with num sections in each dimension
+	def _reduceStrip(self, num, i, rgb):
+		# The same conversions as Image._convert()
+		conversions = {RGBtoRGB: rgb}
+		if RGBtoHSV in self.statistics[num] or RGBtoPAD in self.statistics[num]:
+			conversions[RGBtoHSV] = image_features.arrayFunction(RGBtoHSV)(rgb)
+		if RGBtoPAD in self.statistics[num]:
+			conversions[RGBtoPAD] = image_features.HSVtoPADArray(conversions[RGBtoHSV])
+
+		grid = self.grids[num]
+		for pixel_f, names in self.statistics[num].items():
+			values = conversions[pixel_f]
+			exact_type = (np.int64 if values.dtype == np.uint8 else np.float64)
+			stats = self.section_statistics[(num, pixel_f)]
+			for name in names:
+				ufunc = {'sum': np.add, 'sum_of_squares': np.add, 'min': np.minimum, 'max': np.maximum}[name]
+				value = image_features.reduceStripSections(values, grid['x_starts'], ufunc, (exact_type if ufunc is np.add else None), name == 'sum_of_squares')
+				stats[name][i] = (value if stats[name][i] is None else ufunc(stats[name][i], value))
+
+		if num == 3:
+			for key in self.histogram_keys:
+				counts = image_features.countStripSections(conversions[RGBtoRGB if key[2] == 'rgb' else RGBtoHSV], grid['x_section'], 3, *key)
+				hists = self.section_histograms[key]
+				hists[i] = (counts if hists[i] is None else hists[i] + counts)
+			if self.brightness:
+				self.brightness_sum += conversions[RGBtoHSV][..., 2].sum(dtype = np.float64).item()
+
+	# Output: list of the values of all features, with the layout given by self.columns
+	def extract(self):
+		if self.rows != self.height:
+			raise Exception('Invalid strips in extract: got ' + str(self.rows) + ' rows, but the image has ' + str(self.height))
+
+		# The section features of an Image are computed from its cached statistics, so an Image given the accumulated
+		# statistics computes the same features. Its pixels are a broadcast view that uses no memory and is never read.
+		image = image_features.newImageFromArray(np.broadcast_to(np.zeros(3, dtype = np.uint8), (self.height, self.width, 3)), full_size = self.full_size)
+		for (num, pixel_f), stats in self.section_statistics.items():
+			if len(stats) == 0:
+				continue
+			image.section_statistics[(num, pixel_f)] = dict((name, np.array(rows).transpose(1, 0, 2).reshape(num * num, 3)) for name, rows in stats.items())
+		for key, rows in self.section_histograms.items():
+			counts = np.array(rows)
+			image.section_histograms[key] = counts.transpose(1, 0, 2).reshape(9, counts.shape[2])
+
+		ws, hs = image_features.sectionRanges(self.width, self.height, 3)
+		rv = []
+		for name, args in self.features:
+			if name == 'averageBrightness':
+				rv.append(self.brightness_sum / float(self.width * self.height))
+			elif name in StripExtractor.middle_features:
+				middle_sum = image.section_statistics[(3, RGBtoHSV)]['sum'][4, StripExtractor.middle_features[name]].item()
+				rv.append(middle_sum / float(ws[1][1] - ws[1][0]) / float(hs[1][1] - hs[1][0]))
+			elif name == 'averageChannelOfGrid':
+				rv.extend(image.statisticOfGrid(args[0], args[1], args[2], 'mean'))
+			else:
+				rv.extend(getattr(image, name)(*args))
+		return rv
+
+# Input:
+#   filename - image file
+#   features - see StripExtractor.__init__()
+#   strip_rows - see readStrips()
+# Output: list of the values of all features
+def extractFile(filename, features = default_features, strip_rows = 256):
+	width, height = PIL_Image.open(filename).size
+	extractor = StripExtractor(width, height, features)
+	for strip in readStrips(filename, strip_rows):
+		extractor.add(strip)
+	return extractor.extract()
+
+if __name__ == '__main__':
+	from extract_features import findImages
+
+	parser = argparse.ArgumentParser(description = 'Extracts features from images too large to fit in memory by reading them in strips, writing JSONL to stdout')
+
+	parser.add_argument('paths', metavar = 'PATH', type = str, nargs = '+', help = 'Image files or directories of images')
+	parser.add_argument('-r', '--recursive', help = 'If given, directories are searched recursively', action = 'store_true')
+	parser.add_argument('-s', '--strip_rows', metavar = 'N', type = int, default = 256, help = 'Number of rows to read at a time')
+
+	args = parser.parse_args()
+
+	start = time.time()
+	num_images = 0
+	num_failed = 0
+	for filename in findImages(args.paths, args.recursive):
+		num_images += 1
+		try:
+			sys.stdout.write(json.dumps({'filename': filename, 'features': extractFile(filename, strip_rows = args.strip_rows)}) + '\n')
+		except Exception as e:
+			num_failed += 1
+			sys.stderr.write('Failed to extract features from ' + filename + ': ' + str(e) + '\n')
+
+	elapsed = time.time() - start
+	sys.stderr.write('%d images in %.2fs (%.1f images/s), %d failed\n' % (num_images, elapsed, num_images / elapsed if elapsed > 0 else 0.0, num_failed))
+	if num_failed > 0:
+		sys.exit(1)